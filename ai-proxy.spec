@@ -14,12 +14,30 @@ a = Analysis(
     ],
     hiddenimports=[
         'config',
+        'metrics',
         'cert.utils',
         'cert.install',
         'cert.windows',
         'cert.linux',
+        'clients.balancer',
+        'routes.admission',
+        'routes.body',
+        'routes.cache',
+        'routes.disconnect',
+        'routes.embeddings',
+        'routes.forward',
+        'routes.hedging',
+        'routes.model_router',
+        'routes.retries',
+        'routes.singleflight',
+        'routes.streaming',
+        'server.admin',
+        'server.aio',
+        'server.compression',
         'server.handler',
-        'server.server'
+        'server.keepalive',
+        'server.server',
+        'server.workers'
     ],
     hookspath=[],
     hooksconfig={},
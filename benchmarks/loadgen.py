@@ -0,0 +1,92 @@
+"""
+Closed-loop load generator: `concurrency` workers each send chat completions back to
+back until `requests` have been sent, recording total latency and, for streams, the
+time to the first `data:` event.
+"""
+import asyncio
+import json
+import ssl
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p99 in milliseconds."""
+    p50 = percentile(values, 50)
+    p99 = percentile(values, 99)
+    return {
+        "p50": p50 * 1000 if p50 is not None else None,
+        "p99": p99 * 1000 if p99 is not None else None,
+    }
+
+class Result:
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.ttfts: List[float] = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        completed = len(self.latencies)
+        return {
+            "requests": completed,
+            "errors": self.errors,
+            "rps": completed / self.elapsed if self.elapsed else None,
+            "latency_ms": summarize(self.latencies),
+            "ttft_ms": summarize(self.ttfts),
+        }
+
+async def _one(client: httpx.AsyncClient, url: str, body: bytes, stream: bool, result: Result) -> None:
+    start = time.perf_counter()
+    first: Optional[float] = None
+    try:
+        async with client.stream("POST", url, content=body, headers={"Content-Type": "application/json"}) as response:
+            async for data in response.aiter_bytes():
+                if first is None and stream and b"data:" in data:
+                    first = time.perf_counter()
+            if response.status_code != 200:
+                result.errors += 1
+                return
+    except httpx.HTTPError:
+        result.errors += 1
+        return
+
+    end = time.perf_counter()
+    result.latencies.append(end - start)
+    if first is not None:
+        result.ttfts.append(first - start)
+
+async def run(url: str, concurrency: int, requests: int, stream: bool, verify: Any = True) -> Result:
+    body = json.dumps({
+        "model": "bench",
+        "messages": [{"role": "user", "content": "benchmark"}],
+        "stream": stream,
+        **({"stream_options": {"include_usage": True}} if stream else {}),
+    }).encode("utf-8")
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(verify=verify, limits=limits, timeout=120.0) as client:
+        result = Result()
+        remaining = requests
+
+        async def worker() -> None:
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                await _one(client, url, body, stream, result)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        result.elapsed = time.perf_counter() - start
+        return result
+
+def tls_context(cafile: str) -> ssl.SSLContext:
+    return ssl.create_default_context(cafile=cafile)
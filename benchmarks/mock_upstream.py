@@ -0,0 +1,131 @@
+"""
+Mock OpenAI-compatible upstream for benchmarks.
+
+Serves `/v1/chat/completions` (streaming and non-streaming) and `/v1/models` over plain
+HTTP/1.1 with keep-alive. Responses wait `latency` seconds before the first byte, then
+produce `tokens` tokens at `token_rate` tokens per second (0 for as fast as possible).
+Non-streaming responses carry `payload_bytes` of content.
+
+    python -m benchmarks.mock_upstream --port 18081 --tokens 64 --token-rate 200
+"""
+import argparse
+import http.server
+import json
+import time
+from typing import Any, Dict, Optional
+
+DEFAULT_SETTINGS: Dict[str, Any] = {
+    "latency": 0.0,
+    "tokens": 64,
+    "token_rate": 0.0,
+    "payload_bytes": 1024,
+}
+
+def completion(model: str, content: str, tokens: int) -> Dict[str, Any]:
+    return {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 8, "completion_tokens": tokens, "total_tokens": tokens + 8},
+    }
+
+def chunk(model: str, content: str, finish_reason: Optional[str] = None, usage: Optional[Dict[str, int]] = None) -> bytes:
+    data: Dict[str, Any] = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": {"content": content} if content else {}, "finish_reason": finish_reason}],
+    }
+    if usage is not None:
+        data["usage"] = usage
+    return b"data: " + json.dumps(data).encode("utf-8") + b"\n\n"
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings: Dict[str, Any] = DEFAULT_SETTINGS
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, value: Any) -> None:
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            return self.send_json(200, {"object": "list", "data": [{"id": "bench", "object": "model", "created": 0, "owned_by": "bench"}]})
+        self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.send_json(400, {"error": {"message": "invalid json"}})
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self.send_json(404, {"error": "Not found"})
+
+        settings = self.settings
+        model = str(body.get("model", "bench"))
+        tokens = int(settings["tokens"])
+        interval = 1.0 / settings["token_rate"] if settings["token_rate"] > 0 else 0.0
+
+        if settings["latency"] > 0:
+            time.sleep(settings["latency"])
+
+        if not body.get("stream"):
+            if interval:
+                time.sleep(interval * tokens)
+            content = "x" * int(settings["payload_bytes"])
+            return self.send_json(200, completion(model, content, tokens))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for i in range(tokens):
+            if interval and i:
+                time.sleep(interval)
+            self.write_chunk(chunk(model, "tok "))
+
+        usage = {"prompt_tokens": 8, "completion_tokens": tokens, "total_tokens": tokens + 8}
+        self.write_chunk(chunk(model, "", "stop", usage) + b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class MockServer(http.server.ThreadingHTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--latency", type=float, default=DEFAULT_SETTINGS["latency"], help="seconds before the first byte")
+    parser.add_argument("--tokens", type=int, default=DEFAULT_SETTINGS["tokens"], help="tokens per response")
+    parser.add_argument("--token-rate", type=float, default=DEFAULT_SETTINGS["token_rate"], help="tokens per second, 0 for unthrottled")
+    parser.add_argument("--payload-bytes", type=int, default=DEFAULT_SETTINGS["payload_bytes"], help="content size of non-streaming responses")
+    args = parser.parse_args()
+
+    MockHandler.settings = {"latency": args.latency, "tokens": args.tokens, "token_rate": args.token_rate, "payload_bytes": args.payload_bytes}
+    with MockServer(("127.0.0.1", args.port), MockHandler) as server:
+        print(f"Mock upstream on http://127.0.0.1:{args.port}/v1", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
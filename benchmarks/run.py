@@ -0,0 +1,220 @@
+"""
+Benchmark the proxy against a local mock upstream.
+
+For every mode (streaming, non-streaming) and concurrency level, the load generator
+first calls the mock upstream directly, then goes through a fresh proxy process over
+TLS with the same load. The report has requests per second, the p50/p99 latency and
+time to first token the proxy adds over the direct call, proxy CPU per streamed token
+and the proxy's peak RSS. Results are written as JSON so runs can be compared:
+
+    python -m benchmarks.run --concurrency 1,8,32 --requests 500 --output bench.json
+
+CPU is read from /proc and peak RSS from wait4, so both are only reported on Unix.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks import loadgen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"nothing is listening on port {port}")
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """User plus system CPU time of a process and its live children (`--workers`), from /proc."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            fields = f.read().rsplit(b")", 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime are fields 14 and 15; the split starts at field 3
+    total = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "rb") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        children = []
+    return total + sum(cpu_seconds(child) or 0.0 for child in children)
+
+def stop(proc: subprocess.Popen) -> Optional[float]:
+    """Terminate a process and return its peak RSS in MiB where wait4 is available."""
+    proc.terminate()
+    if not hasattr(os, "wait4"):
+        proc.wait()
+        return None
+
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss / scale
+
+def generate_cert(directory: str, key_type: str) -> Dict[str, str]:
+    sys.path.insert(0, ROOT)
+    from cert.utils import generate_self_signed_cert
+
+    return generate_self_signed_cert(
+        ["localhost"],
+        key_path=os.path.join(directory, "key.pem"),
+        cert_path=os.path.join(directory, "cert.pem"),
+        pfx_password=None,
+        key_type=key_type,
+    )
+
+def start_mock(args: argparse.Namespace) -> subprocess.Popen:
+    proc = subprocess.Popen([
+        sys.executable, "-m", "benchmarks.mock_upstream",
+        "--port", str(args.upstream_port),
+        "--latency", str(args.latency),
+        "--tokens", str(args.tokens),
+        "--token-rate", str(args.token_rate),
+        "--payload-bytes", str(args.payload_bytes),
+    ], cwd=ROOT, stdout=subprocess.DEVNULL)
+    wait_for_port(args.upstream_port)
+    return proc
+
+def start_proxy(args: argparse.Namespace, directory: str, cert: Dict[str, str]) -> subprocess.Popen:
+    settings = {
+        "proxy": {"hosts": []},
+        "openai": {
+            "api_key": "bench",
+            "base_url": f"http://127.0.0.1:{args.upstream_port}/v1",
+            "models": ["bench"],
+            "passthrough": args.passthrough,
+        },
+        "server": {"engine": args.engine},
+        "admin": {"port": 0},
+    }
+    with open(os.path.join(directory, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(settings, f)
+
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(ROOT, "benchmarks", "serve.py"),
+        "--port", str(args.proxy_port), "--cert", cert["cert"], "--key", cert["key"],
+        "--workers", str(args.workers),
+    ], cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(args.proxy_port)
+    return proc
+
+def difference(proxied: Dict[str, Optional[float]], direct: Dict[str, Optional[float]]) -> Dict[str, Optional[float]]:
+    return {
+        key: proxied[key] - direct[key] if proxied[key] is not None and direct[key] is not None else None  # type: ignore[operator]
+        for key in proxied
+    }
+
+def scenario(args: argparse.Namespace, directory: str, cert: Dict[str, str], stream: bool, concurrency: int) -> Dict[str, Any]:
+    direct_url = f"http://127.0.0.1:{args.upstream_port}/v1/chat/completions"
+    direct = asyncio.run(loadgen.run(direct_url, concurrency, args.requests, stream))
+
+    proxy_url = f"https://localhost:{args.proxy_port}/v1/chat/completions"
+    verify = loadgen.tls_context(cert["cert"])
+
+    proc = start_proxy(args, directory, cert)
+    try:
+        asyncio.run(loadgen.run(proxy_url, min(concurrency, args.warmup) or 1, args.warmup, stream, verify))
+        cpu_before = cpu_seconds(proc.pid)
+        proxied = asyncio.run(loadgen.run(proxy_url, concurrency, args.requests, stream, verify))
+        cpu_after = cpu_seconds(proc.pid)
+    finally:
+        peak_rss = stop(proc)
+
+    result = proxied.to_dict()
+    direct_result = direct.to_dict()
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    tokens = result["requests"] * args.tokens if stream else 0
+
+    return {
+        "stream": stream,
+        "concurrency": concurrency,
+        **result,
+        "direct": direct_result,
+        "added_latency_ms": difference(result["latency_ms"], direct_result["latency_ms"]),
+        "ttft_overhead_ms": difference(result["ttft_ms"], direct_result["ttft_ms"]) if stream else None,
+        "cpu_seconds": cpu,
+        "streamed_tokens": tokens,
+        "cpu_us_per_token": cpu / tokens * 1e6 if cpu is not None and tokens else None,
+        "cpu_us_per_request": cpu / result["requests"] * 1e6 if cpu is not None and result["requests"] else None,
+        "peak_rss_mb": peak_rss,
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,8,32", help="comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="requests through the proxy before measuring")
+    parser.add_argument("--mode", choices=["stream", "json", "both"], default="both")
+    parser.add_argument("--engine", choices=["thread", "pool", "asyncio"], default="thread")
+    parser.add_argument("--workers", type=int, default=1, help="proxy worker processes")
+    parser.add_argument("--key-type", choices=["rsa", "ecdsa"], default="rsa", help="proxy certificate key type")
+    parser.add_argument("--passthrough", action="store_true", help="run the proxy with openai.passthrough")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock upstream delay before the first byte")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per mock response")
+    parser.add_argument("--token-rate", type=float, default=0.0, help="mock tokens per second, 0 for unthrottled")
+    parser.add_argument("--payload-bytes", type=int, default=1024, help="content size of non-streaming mock responses")
+    parser.add_argument("--upstream-port", type=int, default=18081)
+    parser.add_argument("--proxy-port", type=int, default=18443)
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",") if level]
+    modes = {"stream": [True], "json": [False], "both": [False, True]}[args.mode]
+
+    started = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    scenarios: List[Dict[str, Any]] = []
+    with tempfile.TemporaryDirectory(prefix="ai-proxy-bench-") as directory:
+        cert = generate_cert(directory, args.key_type)
+        mock = start_mock(args)
+        try:
+            for stream in modes:
+                for concurrency in levels:
+                    result = scenario(args, directory, cert, stream, concurrency)
+                    scenarios.append(result)
+                    print(
+                        f"{'stream' if stream else 'json':6} c={concurrency:<4} "
+                        f"rps={result['rps'] or 0:8.1f} "
+                        f"added p50={result['added_latency_ms']['p50'] or 0:7.2f}ms "
+                        f"p99={result['added_latency_ms']['p99'] or 0:7.2f}ms "
+                        f"errors={result['errors']}",
+                        flush=True,
+                    )
+        finally:
+            stop(mock)
+
+    report = {
+        "started": started,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {k: v for k, v in vars(args).items() if k != "output"},
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""
+Start the proxy for a benchmark run, without touching the hosts file or installing
+certificates. Run it from the directory holding the run's `config.json`.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from server import aio, server, workers
+from server.handler import ProxyHandler
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--cert", required=True)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        workers.start(args.workers, args.port, certfile=args.cert, keyfile=args.key)
+    elif config.config.engine() == "asyncio":
+        aio.start(args.port, certfile=args.cert, keyfile=args.key)
+    else:
+        server.start(args.port, ProxyHandler, certfile=args.cert, keyfile=args.key)
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,14 @@
 所有操作均尽量以无交互方式执行并返回布尔结果与诊断信息。
 """
 import os
+import hashlib
 import subprocess
 import logging
 from typing import Tuple
 
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+
 from cert.utils import Platform, detect_platform, has_command
 
 logger = logging.getLogger(__name__)
@@ -37,6 +41,25 @@ def install_on_macos(cert_path: str) -> Tuple[bool, str]:
         return False, 'install_on_macos exception'
 
 
+def uninstall_on_macos(cert_path: str) -> Tuple[bool, str]:
+    """按 SHA-1 指纹从 System keychain 删除证书（需要管理员）。"""
+    if not has_command('security'):
+        return False, 'security command not available'
+
+    try:
+        with open(cert_path, 'rb') as f:
+            der = x509.load_pem_x509_certificate(f.read()).public_bytes(serialization.Encoding.DER)
+        sha1 = hashlib.sha1(der).hexdigest().upper()
+        subprocess.run(['sudo', 'security', 'delete-certificate', '-Z', sha1, '/Library/Keychains/System.keychain'], check=True)
+        return True, 'removed via security'
+    except subprocess.CalledProcessError as e:
+        logger.debug('macOS security command failed', exc_info=True)
+        return False, f'security failed: {e}'
+    except Exception:
+        logger.exception('uninstall_on_macos failed')
+        return False, 'uninstall_on_macos exception'
+
+
 def install_certificate_auto(cert_path: str) -> Tuple[bool, str]:
     """自动检测平台并尝试安装证书，返回 (成功?, 描述)。"""
     plat = detect_platform()
@@ -63,6 +86,31 @@ def install_certificate_auto(cert_path: str) -> Tuple[bool, str]:
         logger.exception('install_certificate_auto failed')
         return False, 'exception during install'
 
+def uninstall_certificate_auto(cert_path: str) -> Tuple[bool, str]:
+    """自动检测平台并尝试从信任存储删除证书，返回 (成功?, 描述)。"""
+    plat = detect_platform()
+
+    try:
+        if plat == Platform.WINDOWS:
+            from cert.windows import uninstall_certificate_windows
+
+            ok = uninstall_certificate_windows(cert_path)
+            return bool(ok), 'windows uninstaller result' if ok else 'windows uninstaller failed'
+
+        if plat == Platform.LINUX:
+            from cert.linux import uninstall_certificate_linux
+
+            ok = uninstall_certificate_linux(cert_path)
+            return bool(ok), 'linux uninstaller result' if ok else 'linux uninstaller failed'
+
+        if plat == Platform.DARWIN:
+            return uninstall_on_macos(cert_path)
+
+        return False, f'unsupported platform: {plat}'
+    except Exception:
+        logger.exception('uninstall_certificate_auto failed')
+        return False, 'exception during uninstall'
+
 if __name__ == '__main__':
     import sys
 
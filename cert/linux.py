@@ -10,11 +10,22 @@ import platform
 import logging
 from typing import List
 
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+
 from cert.utils import configure_hosts
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_HOSTS_PATH = "/etc/hosts"
+TRUST_DIRS = ("/usr/local/share/ca-certificates", "/etc/pki/ca-trust/source/anchors")
+
+def _der(path: str):
+    try:
+        with open(path, 'rb') as f:
+            return x509.load_pem_x509_certificate(f.read()).public_bytes(serialization.Encoding.DER)
+    except Exception:
+        return None
 
 
 def install_certificate_linux(cert_path: str):
@@ -82,6 +93,55 @@ def install_certificate_linux(cert_path: str):
         return False
 
 
+def uninstall_certificate_linux(cert_path: str):
+    """从系统信任存储删除证书。返回 True/False。
+
+    只删除信任目录中内容与该证书相同的文件，然后刷新信任存储。
+    """
+    try:
+        der = _der(cert_path)
+        if der is None:
+            logger.error("certificate unreadable: %s", cert_path)
+            return False
+
+        removed = False
+        for target_dir in TRUST_DIRS:
+            if not os.path.isdir(target_dir):
+                continue
+            for name in os.listdir(target_dir):
+                target = os.path.join(target_dir, name)
+                if os.path.isfile(target) and _der(target) == der:
+                    try:
+                        os.remove(target)
+                        removed = True
+                    except Exception:
+                        logger.debug("remove %s failed", target, exc_info=True)
+
+        # 运行系统命令来更新信任存储
+        try:
+            subprocess.run(["update-ca-certificates", "--fresh"], check=True)
+            return True
+        except Exception:
+            logger.debug("update-ca-certificates failed", exc_info=True)
+
+        try:
+            subprocess.run(["update-ca-trust", "extract"], check=True)
+            return True
+        except Exception:
+            logger.debug("update-ca-trust failed", exc_info=True)
+
+        try:
+            subprocess.run(["trust", "anchor", "--remove", cert_path], check=True)
+            return True
+        except Exception:
+            logger.debug("trust anchor --remove failed", exc_info=True)
+
+        return removed
+    except Exception:
+        logger.exception("uninstall_certificate_linux failed")
+        return False
+
+
 if __name__ == '__main__':
     cert_file = 'cert.pem'
     if len(sys.argv) > 1:
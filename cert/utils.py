@@ -1,26 +1,67 @@
 """
-证书工具：生成自签名证书、更新 hosts 文件等通用逻辑 
+证书工具：生成自签名证书、本地根 CA 签发证书、更新 hosts 文件等通用逻辑 
 
-此模块提供跨平台共享函数：`generate_self_signed_cert`、`generate_cert`、`configure_hosts` 
+此模块提供跨平台共享函数：`generate_self_signed_cert`、`generate_cert`、`provision_cert`、`configure_hosts` 
 使用时平台模块可以传入平台特有的 subject 字段 (如 state/locality) 
 """
 import enum
+import glob
+import hashlib
+import ipaddress
 import os
 import platform
 import shutil
 import logging
 import datetime
-from typing import List, Optional
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 
 from cryptography import x509
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from cryptography.hazmat.primitives.serialization import pkcs12
 from cryptography.hazmat.backends import default_backend
 from cryptography.x509.oid import NameOID
 
 logger = logging.getLogger(__name__)
 
+KEY_TYPES = ("rsa", "ecdsa")
+CA_DAYS = 3650
+LEAF_DAYS = 365
+# 剩余有效期不足时重新签发
+RENEW_BEFORE = datetime.timedelta(days=30)
+# 被替换的 CA 证书改名为 `<ca>.<指纹>.old`，等待从信任存储中删除
+RETIRED_SUFFIX = ".old"
+
+def generate_private_key(key_type: str = "rsa") -> Any:
+    """生成私钥：`ecdsa` 为 P-256（毫秒级），`rsa` 为 RSA-4096（秒级）"""
+    if key_type == "ecdsa":
+        return ec.generate_private_key(ec.SECP256R1())
+    if key_type == "rsa":
+        return rsa.generate_private_key(public_exponent=65537, key_size=4096, backend=default_backend())
+    raise ValueError(f"unsupported key type: {key_type}")
+
+def _open_private(path: str) -> BinaryIO:
+    """以仅所有者可读写（0600）的权限打开私钥文件用于写入 """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        # O_CREAT 的权限只作用于新文件，已有文件需要单独收紧
+        os.chmod(path, 0o600)
+    except OSError:
+        pass
+    return os.fdopen(fd, "wb")
+
+def _write_key(path: str, key: Any) -> None:
+    with _open_private(path) as f:
+        f.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        ))
+
+def _write_cert(path: str, cert: x509.Certificate) -> None:
+    with open(path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+
 def generate_self_signed_cert(
     hosts: List[str],
     key_path: str = "key.pem",
@@ -31,6 +72,7 @@ def generate_self_signed_cert(
     state: str = "Local",
     locality: str = "Local",
     organization: str = "Local Dev",
+    key_type: str = "rsa",
 ):
     """生成自签名证书并写入磁盘，返回包含路径的字典或抛出异常 
 
@@ -39,7 +81,7 @@ def generate_self_signed_cert(
     if not hosts:
         hosts = ["localhost"]
 
-    private_key = rsa.generate_private_key(public_exponent=65537, key_size=4096, backend=default_backend())
+    private_key = generate_private_key(key_type)
 
     subject = issuer = x509.Name([
         x509.NameAttribute(NameOID.COUNTRY_NAME, country),
@@ -66,7 +108,7 @@ def generate_self_signed_cert(
     )
 
     # 写入私钥和证书
-    with open(key_path, "wb") as f:
+    with _open_private(key_path) as f:
         f.write(private_key.private_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PrivateFormat.TraditionalOpenSSL,
@@ -99,6 +141,189 @@ def generate_cert(hosts: Optional[List[str]] = None, **kwargs):
         return None
 
 
+def ca_permits(ca_cert: x509.Certificate, hosts: List[str]) -> bool:
+    """CA 的名称约束是否允许为全部 hosts 签发证书；没有名称约束的旧 CA 不算 """
+    try:
+        constraints = ca_cert.extensions.get_extension_for_class(x509.NameConstraints).value
+    except x509.ExtensionNotFound:
+        return False
+    permitted = [n.value for n in constraints.permitted_subtrees or [] if isinstance(n, x509.DNSName)]
+    return all(any(h == p or h.endswith("." + p) for p in permitted) for h in hosts)
+
+def _retire_ca(ca_cert_path: str) -> None:
+    """把将被替换的 CA 证书改名保留，以便之后从信任存储中删除；读不出的证书无法识别，只能留在原处被覆盖 """
+    try:
+        retired = f"{ca_cert_path}.{fingerprint(ca_cert_path)[:16]}{RETIRED_SUFFIX}"
+        os.replace(ca_cert_path, retired)
+    except Exception:
+        logger.warning("old local CA at %s is unreadable and cannot be removed from the trust store", ca_cert_path, exc_info=True)
+
+def retired_cas(ca_cert_path: str = "ca.pem") -> List[str]:
+    """已被替换、尚未从信任存储删除的 CA 证书 """
+    return sorted(glob.glob(f"{glob.escape(ca_cert_path)}.*{RETIRED_SUFFIX}"))
+
+def load_or_create_ca(
+    ca_key_path: str = "ca-key.pem",
+    ca_cert_path: str = "ca.pem",
+    key_type: str = "rsa",
+    organization: str = "Local Dev",
+    hosts: Optional[List[str]] = None,
+) -> Tuple[Any, x509.Certificate]:
+    """读取本地根 CA，不存在、即将过期或名称约束不含 hosts 时生成新的（有效期 10 年） 
+
+    CA 带有名称约束，只能为 hosts 签发证书，私钥即使泄露也无法冒充其他站点；
+    hosts 改为约束之外的名称时需要新的 CA。被替换的旧 CA 证书改名为 `<ca>.<指纹>.old`，
+    由调用方从信任存储中删除 
+    """
+    hosts = hosts or ["localhost"]
+    if os.path.exists(ca_key_path) and os.path.exists(ca_cert_path):
+        try:
+            with open(ca_key_path, "rb") as f:
+                ca_key = serialization.load_pem_private_key(f.read(), password=None)
+            with open(ca_cert_path, "rb") as f:
+                ca_cert = x509.load_pem_x509_certificate(f.read())
+            if ca_cert.not_valid_after_utc - RENEW_BEFORE > datetime.datetime.now(datetime.timezone.utc) and ca_permits(ca_cert, hosts):
+                try:
+                    # 早期版本以默认权限写入了私钥
+                    os.chmod(ca_key_path, 0o600)
+                except OSError:
+                    pass
+                return ca_key, ca_cert
+        except Exception:
+            logger.warning("local CA at %s is unreadable, creating a new one", ca_cert_path, exc_info=True)
+    if os.path.exists(ca_cert_path):
+        _retire_ca(ca_cert_path)
+
+    ca_key = generate_private_key(key_type)
+    name = x509.Name([
+        x509.NameAttribute(NameOID.ORGANIZATION_NAME, organization),
+        x509.NameAttribute(NameOID.COMMON_NAME, "ai-proxy Local CA"),
+    ])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ca_cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(ca_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=CA_DAYS))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        # 只允许为 hosts 签发；叶子证书不含 IP 地址，排除全部 IP 以免泄露的私钥为任意地址签发
+        .add_extension(x509.NameConstraints(
+            permitted_subtrees=[x509.DNSName(h) for h in hosts],
+            excluded_subtrees=[x509.IPAddress(ipaddress.ip_network("0.0.0.0/0")), x509.IPAddress(ipaddress.ip_network("::/0"))],
+        ), critical=True)
+        .add_extension(x509.KeyUsage(
+            digital_signature=True, content_commitment=False, key_encipherment=False, data_encipherment=False,
+            key_agreement=False, key_cert_sign=True, crl_sign=True, encipher_only=False, decipher_only=False,
+        ), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(ca_key.public_key()), critical=False)
+        .sign(ca_key, hashes.SHA256())
+    )
+
+    _write_key(ca_key_path, ca_key)
+    _write_cert(ca_cert_path, ca_cert)
+    logger.info("created local CA %s", ca_cert_path)
+    return ca_key, ca_cert
+
+def leaf_is_current(cert_path: str, key_path: str, hosts: List[str], ca_cert: x509.Certificate, key_type: str) -> bool:
+    """已有叶子证书是否可以复用：同一 CA 签发、hosts 集合与密钥类型相同、且未临近过期 """
+    if not (os.path.exists(cert_path) and os.path.exists(key_path)):
+        return False
+    try:
+        with open(cert_path, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read())
+        cert.verify_directly_issued_by(ca_cert)
+        san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    except Exception:
+        return False
+
+    is_ecdsa = isinstance(cert.public_key(), ec.EllipticCurvePublicKey)
+    if is_ecdsa != (key_type == "ecdsa"):
+        return False
+    if set(san.get_values_for_type(x509.DNSName)) != set(hosts):
+        return False
+    return cert.not_valid_after_utc - RENEW_BEFORE > datetime.datetime.now(datetime.timezone.utc)
+
+def issue_leaf_cert(
+    hosts: List[str],
+    ca_key: Any,
+    ca_cert: x509.Certificate,
+    key_path: str = "key.pem",
+    cert_path: str = "cert.pem",
+    key_type: str = "rsa",
+) -> None:
+    """用本地 CA 为 hosts 签发服务器证书 """
+    key = generate_private_key(key_type)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hosts[0])]))
+        .issuer_name(ca_cert.subject)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=LEAF_DAYS))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(h) for h in hosts]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+        .add_extension(x509.ExtendedKeyUsage([x509.oid.ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(ca_cert.public_key()), critical=False)
+        .sign(ca_key, hashes.SHA256())
+    )
+
+    _write_key(key_path, key)
+    _write_cert(cert_path, cert)
+
+def provision_cert(
+    hosts: Optional[List[str]] = None,
+    key_type: str = "rsa",
+    key_path: str = "key.pem",
+    cert_path: str = "cert.pem",
+    ca_key_path: str = "ca-key.pem",
+    ca_cert_path: str = "ca.pem",
+) -> Optional[Dict[str, Any]]:
+    """准备服务器证书：复用本地 CA 和 hosts 未变化的叶子证书，需要时才签发 
+
+    返回 key/cert/ca 路径、`issued`（是否签发了新的叶子证书）以及 `retired`（被替换、
+    需要从信任存储删除的旧 CA 证书），失败时返回 None 
+    """
+    hosts = sorted(set(hosts or ["localhost"]))
+    try:
+        ca_key, ca_cert = load_or_create_ca(ca_key_path, ca_cert_path, key_type, hosts=hosts)
+        issued = not leaf_is_current(cert_path, key_path, hosts, ca_cert, key_type)
+        if issued:
+            issue_leaf_cert(hosts, ca_key, ca_cert, key_path, cert_path, key_type)
+    except Exception:
+        logger.exception("provision_cert failed")
+        return None
+
+    return {
+        "key": os.path.abspath(key_path),
+        "cert": os.path.abspath(cert_path),
+        "ca": os.path.abspath(ca_cert_path),
+        "issued": issued,
+        "retired": [os.path.abspath(path) for path in retired_cas(ca_cert_path)],
+    }
+
+def fingerprint(cert_path: str) -> str:
+    with open(cert_path, "rb") as f:
+        cert = x509.load_pem_x509_certificate(f.read())
+    return hashlib.sha256(cert.public_bytes(serialization.Encoding.DER)).hexdigest()
+
+def is_installed(cert_path: str, marker_path: str) -> bool:
+    """标记文件中记录的指纹与证书一致时，说明它已安装到信任存储 """
+    try:
+        with open(marker_path, "r", encoding="utf-8") as f:
+            return f.read().strip() == fingerprint(cert_path)
+    except OSError:
+        return False
+
+def mark_installed(cert_path: str, marker_path: str) -> None:
+    with open(marker_path, "w", encoding="utf-8") as f:
+        f.write(fingerprint(cert_path))
+
+
 def configure_hosts(hosts: List[str], path: str) -> bool:
     """
     将 hosts 添加到指定的 hosts 文件路径，返回 True/False 会创建备份文件 path.bak
@@ -68,6 +68,25 @@ def install_certificate_windows(cert_path: str):
         logger.exception("install_certificate_windows failed")
         return False
 
+def uninstall_certificate_windows(cert_path: str):
+    """按序列号从受信任的根存储区删除证书（当前用户与本地计算机）。返回True/False。"""
+    try:
+        with open(cert_path, 'rb') as f:
+            cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+        serial = format(cert.serial_number, 'x')
+
+        removed = False
+        for args in (['certutil', '-user', '-delstore', 'Root', serial], ['certutil', '-delstore', 'Root', serial]):
+            try:
+                subprocess.run(args, check=True)
+                removed = True
+            except Exception:
+                logger.debug("%s failed", ' '.join(args[:-2]), exc_info=True)
+        return removed
+    except Exception:
+        logger.exception("uninstall_certificate_windows failed")
+        return False
+
 if __name__ == '__main__':
     # 简单命令行入口：生成证书（可选）并尝试安装与更新hosts
     cert_file = 'cert.pem'
@@ -0,0 +1,293 @@
+"""
+Load balancing across several upstream endpoints and API keys.
+
+Upstreams are picked by least outstanding requests (weighted) or smooth weighted round
+robin. Health is tracked passively from the responses we relay: an upstream is taken out
+of rotation after repeated 5xx/timeouts, and put back once a background probe of
+`GET /models` succeeds. While every upstream of a group is out, requests to it fail fast
+locally (a circuit breaker) unless `fail_open` is set. A 429 is a rate limit, not an
+outage: the upstream is only passed over while others are free, for its `Retry-After` or
+`throttle` seconds. Upstreams can be named to form groups that model routes target.
+"""
+import email.utils
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional
+
+import httpx
+
+import config
+import metrics
+from clients.openai import AsyncOpenAIClient, OpenAIClient, get_async_client, get_client
+from routes.model_router import DEFAULT_UPSTREAM
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BALANCER: Dict[str, Any] = {
+    "strategy": "least_outstanding",
+    "max_failures": 3,
+    "cooldown": 10.0,
+    "max_cooldown": 300.0,
+    # Seconds an upstream is passed over after a 429 without `Retry-After`
+    "throttle": 1.0,
+    # Keep sending to the upstream due back first when every upstream is out of rotation
+    "fail_open": False,
+}
+
+def is_failure(status: int) -> bool:
+    """`0` stands for a connection error or timeout."""
+    return status == 0 or status >= 500
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+class Upstream:
+    def __init__(self, base_url: str, api_key: str, weight: float = 1, max_concurrency: int = 0) -> None:
+        self.base_url = base_url
+        self.api_key = api_key
+        self.weight = max(float(weight), 0.001)
+        self.max_concurrency = int(max_concurrency)
+
+        self.outstanding = 0
+        self.current_weight = 0.0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.throttled_until = 0.0
+        self.probing = False
+
+    def __repr__(self) -> str:
+        return f"Upstream({self.base_url})"
+
+    def saturated(self) -> bool:
+        return self.max_concurrency > 0 and self.outstanding >= self.max_concurrency
+
+class Lease:
+    """One request's use of an upstream. Handlers fill in `status` before it is released."""
+
+    def __init__(self, balancer: "Balancer", upstream: Upstream) -> None:
+        self.balancer = balancer
+        self.upstream = upstream
+        self.status = 0
+        self.retry_after: Optional[str] = None
+        self._released = False
+        metrics.annotate(upstream=upstream.base_url)
+
+    def client(self) -> OpenAIClient:
+        return get_client(self.upstream.api_key, self.upstream.base_url, config.config.pool())
+
+    def async_client(self) -> AsyncOpenAIClient:
+        return get_async_client(self.upstream.api_key, self.upstream.base_url, config.config.pool())
+
+    def record(self, status: int, headers: Optional[httpx.Headers] = None) -> None:
+        self.status = status
+        if headers is not None:
+            self.retry_after = headers.get("Retry-After")
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.balancer.release(self.upstream, self.status, parse_retry_after(self.retry_after))
+
+    def abandon(self) -> None:
+        """Release a request the proxy cancelled itself, without counting it for or against the upstream."""
+        if not self._released:
+            self._released = True
+            self.balancer.release(self.upstream, None)
+
+class Balancer:
+    def __init__(self, upstreams: List[Upstream], settings: Dict[str, Any], lock: Optional[threading.Lock] = None) -> None:
+        # Balancers whose groups share upstreams share the lock that guards their state
+        self._lock = lock or threading.Lock()
+        self.upstreams = upstreams
+        self.settings = settings
+        self._next = 0
+
+    def acquire(self, avoid: Optional[Upstream] = None, first: bool = True) -> Optional[Lease]:
+        """
+        None when every upstream is at its `max_concurrency`, or out of rotation (see
+        `retry_after`). `avoid` is only picked when no other upstream is available, and
+        throttled upstreams only when every other one is throttled too. `first` is False
+        for the retries and hedges of a request, which are not counted as rejected requests.
+        """
+        probes: List[Upstream] = []
+        with self._lock:
+            now = time.monotonic()
+            candidates: List[Upstream] = []
+            ejected: List[Upstream] = []
+            throttled: List[Upstream] = []
+            for upstream in self.upstreams:
+                if upstream.saturated():
+                    continue
+                if upstream.ejected_until:
+                    if now >= upstream.ejected_until and not upstream.probing:
+                        upstream.probing = True
+                        probes.append(upstream)
+                    ejected.append(upstream)
+                    continue
+                if upstream.throttled_until > now:
+                    throttled.append(upstream)
+                    continue
+                candidates.append(upstream)
+
+            candidates = candidates or throttled
+            if not candidates and ejected:
+                if self.settings["fail_open"]:
+                    candidates = [min(ejected, key=lambda u: u.ejected_until)]
+                elif first:
+                    metrics.inc("ai_proxy_upstream_rejected_total")
+            if avoid is not None and len(candidates) > 1:
+                candidates = [u for u in candidates if u is not avoid] or candidates
+
+            chosen = self._pick(candidates) if candidates else None
+            if chosen is not None:
+                chosen.outstanding += 1
+
+        for upstream in probes:
+            threading.Thread(target=self._probe, args=(upstream,), daemon=True).start()
+
+        return Lease(self, chosen) if chosen is not None else None
+
+    def retry_after(self) -> Optional[float]:
+        """Seconds until the first upstream is due back when every upstream is out of rotation, else None."""
+        with self._lock:
+            if self.settings["fail_open"] or not all(u.ejected_until for u in self.upstreams):
+                return None
+            return max(0.0, min(u.ejected_until for u in self.upstreams) - time.monotonic())
+
+    def _pick(self, candidates: List[Upstream]) -> Upstream:
+        if len(candidates) == 1:
+            return candidates[0]
+
+        if self.settings["strategy"] == "weighted_round_robin":
+            # Smooth weighted round robin, as used by nginx
+            total = sum(u.weight for u in candidates)
+            for upstream in candidates:
+                upstream.current_weight += upstream.weight
+            chosen = max(candidates, key=lambda u: u.current_weight)
+            chosen.current_weight -= total
+            return chosen
+
+        # Least outstanding requests relative to weight; rotate the start to spread ties
+        self._next = (self._next + 1) % len(candidates)
+        rotated = candidates[self._next:] + candidates[:self._next]
+        return min(rotated, key=lambda u: u.outstanding / u.weight)
+
+    def release(self, upstream: Upstream, status: Optional[int], retry_after: Optional[float] = None) -> None:
+        """`status` None leaves the health of the upstream as it is."""
+        with self._lock:
+            upstream.outstanding -= 1
+            if status is None:
+                return
+
+            if status == 429:
+                delay = retry_after if retry_after is not None else float(self.settings["throttle"])
+                upstream.throttled_until = time.monotonic() + min(delay, float(self.settings["max_cooldown"]))
+                return
+            if not is_failure(status):
+                upstream.failures = 0
+                return
+
+            upstream.failures += 1
+            if upstream.ejected_until:
+                return
+            if upstream.failures >= self.settings["max_failures"]:
+                self._eject(upstream, retry_after)
+
+    def _eject(self, upstream: Upstream, retry_after: Optional[float] = None) -> None:
+        upstream.ejections += 1
+        cooldown = self.settings["cooldown"] * (2 ** min(upstream.ejections - 1, 10))
+        if retry_after is not None:
+            cooldown = retry_after
+        cooldown = min(cooldown, self.settings["max_cooldown"])
+
+        upstream.ejected_until = time.monotonic() + cooldown
+        logger.warning("upstream %s ejected for %.1fs after %d failures", upstream.base_url, cooldown, upstream.failures)
+
+    def _probe(self, upstream: Upstream) -> None:
+        healthy = False
+        try:
+            client = get_client(upstream.api_key, upstream.base_url, config.config.pool())
+            response = client.send_raw("GET", "models")
+            response.close()
+            healthy = not is_failure(response.status_code)
+        except httpx.HTTPError:
+            logger.debug("probe of %s failed", upstream.base_url, exc_info=True)
+
+        with self._lock:
+            upstream.probing = False
+            if healthy:
+                logger.info("upstream %s is back in rotation", upstream.base_url)
+                upstream.failures = 0
+                upstream.ejections = 0
+                upstream.ejected_until = 0.0
+            else:
+                self._eject(upstream)
+
+def balancer_settings(settings: Mapping[str, Any]) -> Dict[str, Any]:
+    merged = dict(DEFAULT_BALANCER)
+    merged.update({k: v for k, v in settings.items() if k in DEFAULT_BALANCER})
+    return merged
+
+def build_upstreams(entries: List[Mapping[str, Any]]) -> List[Upstream]:
+    return [
+        Upstream(
+            entry.get("base_url", "https://api.openai.com/v1"),
+            entry.get("api_key", ""),
+            weight=entry.get("weight", 1),
+            max_concurrency=entry.get("max_concurrency", 0),
+        )
+        for entry in entries
+    ]
+
+def build_balancers(entries: List[Mapping[str, Any]], settings: Dict[str, Any]) -> Dict[str, Balancer]:
+    """
+    One balancer per upstream `name`; upstreams sharing a name are balanced together.
+    Unnamed upstreams form the default group, which is the whole pool when every upstream is
+    named. Each upstream is built once, so its health and load are the same in every group.
+    """
+    upstreams = build_upstreams(entries)
+    groups: Dict[str, List[Upstream]] = {}
+    for entry, upstream in zip(entries, upstreams):
+        groups.setdefault(entry.get("name", DEFAULT_UPSTREAM), []).append(upstream)
+    if DEFAULT_UPSTREAM not in groups:
+        groups[DEFAULT_UPSTREAM] = upstreams
+
+    lock = threading.Lock()
+    return {name: Balancer(group, settings, lock) for name, group in groups.items()}
+
+_lock = threading.Lock()
+_balancers: Dict[str, Balancer] = {}
+_source: Any = None
+
+def _build(snapshot: config.ConfigSnapshot) -> Dict[str, Balancer]:
+    """Balancers for a snapshot; a reload that leaves the upstreams alone keeps their health state."""
+    global _balancers, _source
+
+    source = (snapshot.upstreams, snapshot.balancer)
+    with _lock:
+        if source != _source:
+            _balancers = build_balancers(list(snapshot.upstreams), balancer_settings(snapshot.balancer))
+            _source = source
+        return _balancers
+
+def get_balancer(name: str = DEFAULT_UPSTREAM) -> Balancer:
+    """The balancer for an upstream group, rebuilt when the upstream config changes."""
+    balancers = config.config.snapshot().derive("balancers", _build)
+    balancer = balancers.get(name)
+    if balancer is None:
+        logger.debug("unknown upstream %r, using the default group", name)
+        balancer = balancers[DEFAULT_UPSTREAM]
+    return balancer
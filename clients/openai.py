@@ -1,7 +1,350 @@
-from openai import OpenAI
+import asyncio
+import contextlib
+import contextvars
+import importlib.util
+import logging
+import socket
+import threading
+import time
+from typing import Any, AsyncIterable, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Type, Union
+
+import httpcore
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# A whole body, or chunks streamed to the upstream as they are read from the client
+RequestContent = Union[bytes, Iterable[bytes], AsyncIterable[bytes]]
+
+DEFAULT_POOL: Dict[str, Any] = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 60.0,
+    "http2": False,
+}
+
+def upstream_url(base_url: Any, path: str) -> str:
+    return str(base_url).rstrip("/") + "/" + path.lstrip("/")
+
+def request_headers(auth_headers: Mapping[str, str], headers: Optional[Mapping[str, str]] = None) -> httpx.Headers:
+    """
+    The upstream key and a JSON content type, with `headers` on top. Names match without
+    regard to case, so a client's `content-type` replaces the default instead of adding to it.
+    """
+    merged = httpx.Headers({**auth_headers, "Content-Type": "application/json"})
+    merged.update(headers or {})
+    return merged
 
 class OpenAIClient(OpenAI):
-    def __init__(self, api_key: str, base_url: str):
+    def __init__(self, api_key: str, base_url: str, http_client: Optional[httpx.Client] = None):
         self.api_key = api_key
         self.base_url = base_url
-        super().__init__(api_key=self.api_key, base_url=self.base_url)
\ No newline at end of file
+        # Retries are left to routes.retries, which knows what has reached the client
+        super().__init__(api_key=self.api_key, base_url=self.base_url, http_client=http_client, max_retries=0)
+        self.http_client: httpx.Client = self._client
+
+    def send_raw(self, method: str, path: str, content: Optional[RequestContent] = None, headers: Optional[Dict[str, str]] = None, timeout: Optional[httpx.Timeout] = None) -> httpx.Response:
+        """
+        Send a request over the pooled connection without going through the SDK models.
+        The response body is left unread; the caller must close it. `timeout` replaces the
+        client's timeouts for this request.
+        """
+        request = self.http_client.build_request(
+            method,
+            upstream_url(self.base_url, path),
+            content=content,
+            headers=request_headers(self.auth_headers, headers),
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+        )
+        return self.http_client.send(request, stream=True)
+
+class AsyncOpenAIClient(AsyncOpenAI):
+    def __init__(self, api_key: str, base_url: str, http_client: Optional[httpx.AsyncClient] = None):
+        self.api_key = api_key
+        self.base_url = base_url
+        # Retries are left to routes.retries, which knows what has reached the client
+        super().__init__(api_key=self.api_key, base_url=self.base_url, http_client=http_client, max_retries=0)
+        self.http_client: httpx.AsyncClient = self._client
+
+    async def send_raw(self, method: str, path: str, content: Optional[RequestContent] = None, headers: Optional[Dict[str, str]] = None, timeout: Optional[httpx.Timeout] = None) -> httpx.Response:
+        request = self.http_client.build_request(
+            method,
+            upstream_url(self.base_url, path),
+            content=content,
+            headers=request_headers(self.auth_headers, headers),
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+        )
+        return await self.http_client.send(request, stream=True)
+
+def pool_settings(pool: Mapping[str, Any]) -> Dict[str, Any]:
+    """Merge the `openai.pool` config section over the defaults."""
+    settings = dict(DEFAULT_POOL)
+    settings.update({k: v for k, v in pool.items() if k in DEFAULT_POOL})
+    return settings
+
+def http2_available() -> bool:
+    """httpx only speaks HTTP/2 when the optional `h2` package is installed."""
+    return importlib.util.find_spec("h2") is not None
+
+def _client_options(settings: Dict[str, Any]) -> Dict[str, Any]:
+    http2 = bool(settings["http2"])
+    if http2 and not http2_available():
+        logger.warning("http2 requested but the h2 package is not installed, falling back to HTTP/1.1")
+        http2 = False
+
+    limits = httpx.Limits(
+        max_connections=settings["max_connections"],
+        max_keepalive_connections=settings["max_keepalive_connections"],
+        keepalive_expiry=settings["keepalive_expiry"],
+    )
+    return {"limits": limits, "http2": http2}
+
+class ConnectTrace:
+    """httpcore trace callback that records how long new upstream connections take to open."""
+
+    PHASES = {"connection.connect_tcp": "tcp", "connection.start_tls": "tls"}
+
+    def __init__(self, request: httpx.Request) -> None:
+        self.labels = (("upstream", f"{request.url.scheme}://{request.url.netloc.decode('ascii')}"),)
+        self.started: Dict[str, float] = {}
+
+    def __call__(self, event: str, info: Dict[str, Any]) -> None:
+        step, _, state = event.rpartition(".")
+        phase = self.PHASES.get(step)
+        if phase is None:
+            return
+        if state == "started":
+            self.started[phase] = time.perf_counter()
+        elif state == "complete" and phase in self.started:
+            metrics.observe("ai_proxy_upstream_connect_seconds", self.labels + (("phase", phase),), time.perf_counter() - self.started[phase])
+
+class AsyncConnectTrace(ConnectTrace):
+    async def __call__(self, event: str, info: Dict[str, Any]) -> None:  # type: ignore[override]
+        super().__call__(event, info)
+
+def _trace_connect(request: httpx.Request) -> None:
+    request.extensions["trace"] = ConnectTrace(request)
+
+async def _trace_connect_async(request: httpx.Request) -> None:
+    request.extensions["trace"] = AsyncConnectTrace(request)
+
+class Abort:
+    """
+    Lets another thread abort one upstream attempt of the thread engines, which cannot be
+    interrupted otherwise. While the attempt's thread runs `aborting` it, a read or write on
+    an HTTP/1.1 upstream connection that is waiting, or starts after `abort`, fails with a
+    network error and the connection is not reused. HTTP/2 connections also carry other
+    requests and are left alone.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._socket: Optional[socket.socket] = None
+        self.aborted = False
+
+    def abort(self) -> None:
+        with self._lock:
+            self.aborted = True
+            if self._socket is not None:
+                # Under the lock, so the connection cannot have gone back to the pool meanwhile
+                try:
+                    socket.socket.shutdown(self._socket, socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _enter(self, sock: Optional[socket.socket], error: Type[Exception]) -> None:
+        with self._lock:
+            if self.aborted:
+                raise error("upstream call aborted")
+            self._socket = sock
+
+    def _exit(self) -> None:
+        with self._lock:
+            self._socket = None
+
+_abort: contextvars.ContextVar[Optional[Abort]] = contextvars.ContextVar("upstream_abort", default=None)
+
+@contextlib.contextmanager
+def aborting(abort: Abort) -> Iterator[Abort]:
+    """Make the upstream calls of this thread abortable by `abort`."""
+    token = _abort.set(abort)
+    try:
+        yield abort
+    finally:
+        _abort.reset(token)
+
+class AbortableStream(httpcore.NetworkStream):
+    def __init__(self, stream: httpcore.NetworkStream) -> None:
+        self._stream = stream
+
+    def _watched(self) -> Optional[Abort]:
+        abort = _abort.get()
+        if abort is None:
+            return None
+        ssl_object = self._stream.get_extra_info("ssl_object")
+        if ssl_object is not None and ssl_object.selected_alpn_protocol() == "h2":
+            return None
+        return abort
+
+    def read(self, max_bytes: int, timeout: Optional[float] = None) -> bytes:
+        abort = self._watched()
+        if abort is None:
+            return self._stream.read(max_bytes, timeout)
+        abort._enter(self._stream.get_extra_info("socket"), httpcore.ReadError)
+        try:
+            return self._stream.read(max_bytes, timeout)
+        finally:
+            abort._exit()
+
+    def write(self, buffer: bytes, timeout: Optional[float] = None) -> None:
+        abort = self._watched()
+        if abort is None:
+            return self._stream.write(buffer, timeout)
+        abort._enter(self._stream.get_extra_info("socket"), httpcore.WriteError)
+        try:
+            self._stream.write(buffer, timeout)
+        finally:
+            abort._exit()
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def start_tls(self, ssl_context: Any, server_hostname: Optional[str] = None, timeout: Optional[float] = None) -> httpcore.NetworkStream:
+        return AbortableStream(self._stream.start_tls(ssl_context, server_hostname, timeout))
+
+    def get_extra_info(self, info: str) -> Any:
+        return self._stream.get_extra_info(info)
+
+class AbortableBackend(httpcore.NetworkBackend):
+    """Opens upstream connections whose I/O an `Abort` can cut short."""
+
+    def __init__(self, backend: httpcore.NetworkBackend) -> None:
+        self._backend = backend
+
+    def connect_tcp(self, host: str, port: int, timeout: Optional[float] = None, local_address: Optional[str] = None, socket_options: Any = None) -> httpcore.NetworkStream:
+        return AbortableStream(self._backend.connect_tcp(host, port, timeout, local_address, socket_options))
+
+    def connect_unix_socket(self, path: str, timeout: Optional[float] = None, socket_options: Any = None) -> httpcore.NetworkStream:
+        return AbortableStream(self._backend.connect_unix_socket(path, timeout, socket_options))
+
+    def sleep(self, seconds: float) -> None:
+        self._backend.sleep(seconds)
+
+def build_http_client(settings: Dict[str, Any]) -> httpx.Client:
+    client = DefaultHttpxClient(event_hooks={"request": [_trace_connect]}, **_client_options(settings))
+    # httpx has no option for the network backend of its connection pool; the pool hands it
+    # to each connection it opens
+    pool = getattr(client._transport, "_pool", None)
+    if pool is not None and hasattr(pool, "_network_backend"):
+        pool._network_backend = AbortableBackend(pool._network_backend)
+    return client
+
+def build_async_http_client(settings: Dict[str, Any]) -> httpx.AsyncClient:
+    return DefaultAsyncHttpxClient(event_hooks={"request": [_trace_connect_async]}, **_client_options(settings))
+
+class ClientRegistry:
+    """
+    Process-wide registry of upstream clients keyed by (base_url, api_key).
+
+    Each client owns a keep-alive connection pool, so requests to the same upstream
+    reuse connections instead of paying for DNS and TLS every time. The registry is
+    rebuilt only when the pool settings change; in-flight requests keep their own
+    reference to the old client and finish on it. Replaced clients are retired and their
+    pools closed at the next change, or at shutdown.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[str, str], OpenAIClient] = {}
+        self._async_clients: Dict[Tuple[str, str], AsyncOpenAIClient] = {}
+        self._settings: Dict[str, Any] = dict(DEFAULT_POOL)
+        self._retired: List[OpenAIClient] = []
+        self._retired_async: List[AsyncOpenAIClient] = []
+        # Async clients due to be closed, on the event loop
+        self._stale_async: List[AsyncOpenAIClient] = []
+        self._closing: Set["asyncio.Task[None]"] = set()
+
+    def _reset_if_changed(self, settings: Dict[str, Any]) -> None:
+        if settings != self._settings:
+            logger.info("upstream pool settings changed, rebuilding clients")
+            # Clients retired by the previous change have had all this time to finish their requests
+            for client in self._retired:
+                client.close()
+            self._stale_async.extend(self._retired_async)
+            self._retired = list(self._clients.values())
+            self._retired_async = list(self._async_clients.values())
+            self._clients = {}
+            self._async_clients = {}
+            self._settings = settings
+
+    def get(self, api_key: str, base_url: str, pool: Optional[Mapping[str, Any]] = None) -> OpenAIClient:
+        settings = pool_settings(pool or {})
+        key = (base_url, api_key)
+
+        # Fast path: no lock when the client exists and the settings are unchanged
+        client = self._clients.get(key)
+        if client is not None and settings == self._settings:
+            return client
+
+        with self._lock:
+            self._reset_if_changed(settings)
+
+            client = self._clients.get(key)
+            if client is None:
+                client = OpenAIClient(api_key, base_url, http_client=build_http_client(settings))
+                self._clients[key] = client
+
+            return client
+
+    def get_async(self, api_key: str, base_url: str, pool: Optional[Mapping[str, Any]] = None) -> AsyncOpenAIClient:
+        """Async clients are bound to the event loop of the asyncio server engine."""
+        settings = pool_settings(pool or {})
+        key = (base_url, api_key)
+
+        client = self._async_clients.get(key)
+        if client is not None and settings == self._settings:
+            return client
+
+        with self._lock:
+            self._reset_if_changed(settings)
+
+            client = self._async_clients.get(key)
+            if client is None:
+                client = AsyncOpenAIClient(api_key, base_url, http_client=build_async_http_client(settings))
+                self._async_clients[key] = client
+
+            stale, self._stale_async = self._stale_async, []
+
+        for old in stale:
+            task = asyncio.get_running_loop().create_task(old.close())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+        return client
+
+    def close(self) -> None:
+        with self._lock:
+            for client in list(self._clients.values()) + self._retired:
+                client.close()
+            self._clients = {}
+            self._retired = []
+
+    async def aclose(self) -> None:
+        with self._lock:
+            clients = list(self._async_clients.values()) + self._retired_async + self._stale_async
+            self._async_clients = {}
+            self._retired_async = []
+            self._stale_async = []
+
+        for client in clients:
+            await client.close()
+
+registry = ClientRegistry()
+
+def get_client(api_key: str, base_url: str, pool: Optional[Mapping[str, Any]] = None) -> OpenAIClient:
+    return registry.get(api_key, base_url, pool)
+
+def get_async_client(api_key: str, base_url: str, pool: Optional[Mapping[str, Any]] = None) -> AsyncOpenAIClient:
+    return registry.get_async(api_key, base_url, pool)
@@ -1,20 +1,120 @@
-import hashlib
+import contextlib
+import contextvars
 import json
+import os
 import sys
-from typing import Any, Dict, List, Optional
+import threading
+import time
+import types
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
 from pathlib import Path
 
-def calculate_md5(path: str) -> str:
-    """计算文件的MD5值"""
-    with open(path, 'rb') as f:
-        content = f.read()
+def _freeze(value: Any) -> Any:
+    """Read-only copy of parsed JSON: objects become mapping proxies and lists tuples, all the way down."""
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
 
-    return hashlib.md5(content).hexdigest()
+def _frozen(value: Optional[Dict[str, Any]]) -> Mapping[str, Any]:
+    return _freeze(dict(value or {}))
+
+def _require(condition: bool, message: str) -> None:
+    if not condition:
+        raise ValueError(message)
+
+def validate(data: Any) -> None:
+    """Reject a config whose known sections have the wrong shape before it replaces a working one."""
+    _require(isinstance(data, dict), "config must be a JSON object")
+    for section in ("proxy", "openai", "body", "admission", "hedging", "cache", "coalesce", "embeddings", "server", "admin"):
+        _require(isinstance(data.get(section, {}), dict), f"`{section}` must be an object")
+
+    openai = data.get("openai", {})
+    for key in ("api_key", "base_url"):
+        _require(isinstance(openai.get(key, ""), str), f"`openai.{key}` must be a string")
+    for key in ("models", "upstreams", "routes"):
+        _require(isinstance(openai.get(key, []), list), f"`openai.{key}` must be a list")
+    for key in ("balancer", "pool", "timeouts", "retries", "streaming"):
+        _require(isinstance(openai.get(key, {}), dict), f"`openai.{key}` must be an object")
+
+    for entry in openai.get("upstreams", []):
+        _require(isinstance(entry, dict) and isinstance(entry.get("base_url"), str), "`openai.upstreams` entries need a string `base_url`")
+    for entry in openai.get("routes", []):
+        _require(isinstance(entry, dict) and isinstance(entry.get("model"), str), "`openai.routes` entries need a string `model`")
+        _require(isinstance(entry.get("timeouts", {}), dict), "`openai.routes` `timeouts` must be an object")
+        _require(isinstance(entry.get("streaming", {}), dict), "`openai.routes` `streaming` must be an object")
+
+    _require(isinstance(data.get("proxy", {}).get("hosts", []), list), "`proxy.hosts` must be a list")
+    _require(data.get("proxy", {}).get("key_type", "rsa") in ("rsa", "ecdsa"), "`proxy.key_type` must be \"rsa\" or \"ecdsa\"")
+
+class ConfigSnapshot:
+    """
+    One version of the config file, parsed once and never modified.
+
+    A request reads plain attributes from a single snapshot instead of walking the raw
+    dict. Objects built from the config elsewhere (balancers, merged settings) are
+    memoized per snapshot with `derive`, so they are only rebuilt after a reload.
+    """
+
+    __slots__ = (
+        "data", "api_key", "base_url", "models", "hosts", "upstreams", "balancer", "pool", "timeouts",
+        "retries", "streaming", "passthrough", "routes", "body", "admission", "hedging", "cache", "coalesce", "embeddings", "server", "engine", "admin", "key_type", "_derived",
+    )
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        openai = data.get("openai", {})
+        api_key = openai.get("api_key", "")
+        base_url = openai.get("base_url", "https://api.openai.com/v1")
+        upstreams = openai.get("upstreams") or [{"base_url": base_url, "api_key": api_key}]
+
+        values: Dict[str, Any] = {
+            "data": _freeze(data),
+            "api_key": api_key,
+            "base_url": base_url,
+            "models": tuple(openai.get("models", [])),
+            "hosts": tuple(data.get("proxy", {}).get("hosts", [])),
+            "upstreams": tuple(_frozen(entry) for entry in upstreams),
+            "balancer": _frozen(openai.get("balancer")),
+            "pool": _frozen(openai.get("pool")),
+            "timeouts": _frozen(openai.get("timeouts")),
+            "retries": _frozen(openai.get("retries")),
+            "streaming": _frozen(openai.get("streaming")),
+            "passthrough": bool(openai.get("passthrough", False)),
+            "routes": tuple(_frozen(entry) for entry in openai.get("routes", [])),
+            "body": _frozen(data.get("body")),
+            "admission": _frozen(data.get("admission")),
+            "hedging": _frozen(data.get("hedging")),
+            "cache": _frozen(data.get("cache")),
+            "coalesce": bool(data.get("coalesce", {}).get("enabled", False)),
+            "embeddings": _frozen(data.get("embeddings")),
+            "server": _frozen(data.get("server")),
+            "engine": data.get("server", {}).get("engine", "thread"),
+            "admin": _frozen({"host": "127.0.0.1", "port": 9464, **data.get("admin", {})}),
+            "key_type": data.get("proxy", {}).get("key_type", "rsa"),
+            "_derived": {},
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError("config snapshots are immutable")
+
+    def derive[T](self, key: str, factory: Callable[["ConfigSnapshot"], T]) -> T:
+        """Build a value from this snapshot once and reuse it until the next reload."""
+        try:
+            return self._derived[key]
+        except KeyError:
+            return self._derived.setdefault(key, factory(self))
+
+_pinned: contextvars.ContextVar[Optional[ConfigSnapshot]] = contextvars.ContextVar("config_snapshot", default=None)
 
 class Config:
-    def __init__(self, file: Optional[str] = None, lock_file: str = "config.lock") -> None:
+    def __init__(self, file: Optional[str] = None) -> None:
         self._config_data : Dict[str,Any] = {}
         self._config_file = file
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._watcher: Optional[threading.Thread] = None
 
         if file:
             if Path(file).exists():
@@ -23,17 +123,13 @@ class Config:
                 self._load_default_config()
                 with open(file, "w", encoding='utf-8') as f:
                     json.dump(self._config_data, f, ensure_ascii=False, indent=2)
+            self._stamp = self._file_stamp()
         else:
             self._load_default_config()
 
-        self._lock_file = lock_file
-
-        if Path(lock_file).exists():
-            self._last_md5 = Path(lock_file).read_text(encoding='utf-8')
-        else:
-            self._last_md5 = ""
-            if file:
-                Path(lock_file).write_text(calculate_md5(file), encoding='utf-8')
+        # A bad file fails at startup, as it would be refused by a reload
+        validate(self._config_data)
+        self._snapshot = ConfigSnapshot(self._config_data)
 
     @staticmethod
     def _get_resource_path(filename: str) -> Path:
@@ -50,7 +146,7 @@ class Config:
         else:
             # 直接运行 Python 脚本
             resource_dir = Path(__file__).parent
-        
+
         return resource_dir / filename
 
     def _load_default_config(self) -> None:
@@ -72,34 +168,148 @@ class Config:
         with open(file, "r", encoding='utf-8') as f:
             self._config_data = json.load(f)
 
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        """mtime and size of the config file: cheap to poll, no read or hash."""
+        try:
+            stat = os.stat(self._config_file)  # type: ignore[arg-type]
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def snapshot(self) -> ConfigSnapshot:
+        """The snapshot pinned to the current request, or else the latest one."""
+        return _pinned.get() or self._snapshot
+
+    @contextlib.contextmanager
+    def pin(self) -> Iterator[ConfigSnapshot]:
+        """Serve a whole request from one snapshot, even if a reload lands halfway through."""
+        token = _pinned.set(self._snapshot)
+        try:
+            yield _pinned.get()  # type: ignore[misc]
+        finally:
+            _pinned.reset(token)
+
+    def reload_if_changed(self) -> bool:
+        """
+        Swap in a new snapshot if the file's mtime or size changed. A file that fails to
+        parse or validate is reported and the current snapshot stays in place.
+        """
+        if not self._config_file:
+            return False
+
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._stamp:
+            return False
+        self._stamp = stamp
+
+        try:
+            with open(self._config_file, "r", encoding='utf-8') as f:
+                data = json.load(f)
+            validate(data)
+            snapshot = ConfigSnapshot(data)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Failed to reload {self._config_file}, keeping the previous config: {e}")
+            return False
+
+        self._config_data = data
+        # A single reference assignment, so readers see either the old or the new snapshot
+        self._snapshot = snapshot
+        print(f"Reloaded {self._config_file}")
+        return True
+
+    def watch(self, interval: float = 1.0) -> None:
+        """Poll the config file every `interval` seconds from a daemon thread."""
+        if not self._config_file or self._watcher is not None:
+            return
+
+        def run() -> None:
+            while True:
+                time.sleep(interval)
+                self.reload_if_changed()
+
+        self._watcher = threading.Thread(target=run, name="config-watcher", daemon=True)
+        self._watcher.start()
+
     def get[T](self, key: str, default: Optional[T] = None) -> T:
-        return self._config_data.get(key, default)
-    
+        return self.snapshot().data.get(key, default)
+
     def api_key(self) -> str:
-        return self.get("openai", {}).get("api_key", "")
-    
+        return self.snapshot().api_key
+
     def base_url(self) -> str:
-        return self.get("openai", {}).get("base_url", "https://api.openai.com/v1")
+        return self.snapshot().base_url
+
+    def upstreams(self) -> List[Mapping[str, Any]]:
+        """The `openai.upstreams` pool, or the single `base_url`/`api_key` upstream."""
+        return list(self.snapshot().upstreams)
+
+    def balancer(self) -> Mapping[str, Any]:
+        return self.snapshot().balancer
+
+    def pool(self) -> Mapping[str, Any]:
+        return self.snapshot().pool
+
+    def timeouts(self) -> Mapping[str, Any]:
+        """Connect, first-byte and total deadlines of chat requests, unless their model route sets its own."""
+        return self.snapshot().timeouts
+
+    def retries(self) -> Mapping[str, Any]:
+        """How failed chat requests are retried before anything reaches the client."""
+        return self.snapshot().retries
+
+    def streaming(self) -> Mapping[str, Any]:
+        """How the chunks of relayed chat streams are joined into writes, unless their model route sets its own."""
+        return self.snapshot().streaming
+
+    def passthrough(self) -> bool:
+        """Relay upstream response bytes (streamed or not) as-is instead of re-encoding them through the SDK."""
+        return self.snapshot().passthrough
 
     def models(self) -> List[str]:
-        return self.get("openai", {}).get("models", [])
-    
+        return list(self.snapshot().models)
+
+    def model_routes(self) -> List[Mapping[str, Any]]:
+        """`openai.routes`; `routes.model_router.get_router` compiles them once per snapshot."""
+        return list(self.snapshot().routes)
+
     def hosts(self) -> List[str]:
-        return self.get("proxy", {}).get("hosts", [])
-    
-    def modified(self) -> bool:
-        if not self._config_file:
-            return False
+        return list(self.snapshot().hosts)
 
-        current_md5 = calculate_md5(self._config_file)
-        return current_md5 != self._last_md5
-    
-    def update_lock(self) -> None:
-        if not self._config_file:
-            return
+    def key_type(self) -> str:
+        """Key type of the local CA and server certificate: "rsa" (default) or "ecdsa"."""
+        return self.snapshot().key_type
+
+    def body(self) -> Mapping[str, Any]:
+        """How JSON request bodies are read: size limit and lazy parsing."""
+        return self.snapshot().body
+
+    def admission(self) -> Mapping[str, Any]:
+        """Rate limits and the wait queue applied before chat and embeddings requests go upstream."""
+        return self.snapshot().admission
+
+    def hedging(self) -> Mapping[str, Any]:
+        """When a slow chat request is sent again to a second upstream."""
+        return self.snapshot().hedging
+
+    def cache(self) -> Mapping[str, Any]:
+        return self.snapshot().cache
+
+    def embeddings(self) -> Mapping[str, Any]:
+        return self.snapshot().embeddings
+
+    def coalesce(self) -> bool:
+        """Share one upstream call between identical concurrent chat requests."""
+        return self.snapshot().coalesce
+
+    def server(self) -> Mapping[str, Any]:
+        return self.snapshot().server
+
+    def engine(self) -> str:
+        """Server engine: "thread" (default), "pool" or "asyncio"."""
+        return self.snapshot().engine
+
+    def admin(self) -> Mapping[str, Any]:
+        """Admin server for `/metrics`; `port` 0 turns it off."""
+        return self.snapshot().admin
 
-        if self.modified():
-            self._last_md5 = calculate_md5(self._config_file)
-            Path(self._lock_file).write_text(self._last_md5, encoding='utf-8')
-    
-config = Config('config.json')
\ No newline at end of file
+config = Config('config.json')
@@ -1,58 +1,92 @@
-from typing import Tuple
+import argparse
+import multiprocessing
+import os
+from typing import List, Tuple
 import cert.utils
 import config
 from server.handler import ProxyHandler
-from server import server
-from cert.install import install_certificate_auto
-from cert.utils import Platform, detect_platform, generate_cert
+from server import admin, aio, server, workers
+from clients.openai import registry
+from cert.install import install_certificate_auto, uninstall_certificate_auto
+from cert.utils import Platform, detect_platform, is_installed, mark_installed, provision_cert
 import cert.windows
 import cert.linux
 
 PORT = 443
+CA_MARKER = 'ca.installed'
 
-def configure_cert(cert_path: str, key_path: str) -> Tuple[str, str]:
-    res = generate_cert(config.config.hosts())
+def configure_cert(hosts: List[str]) -> Tuple[str, str]:
+    res = provision_cert(hosts, key_type=config.config.key_type())
     if not res:
         raise ValueError("generate cert failed")
-    
-    cert_path = res["cert"]
-    key_path = res["key"]
-    
-    if cert_path and key_path:
-        install_certificate_auto(cert_path)
 
-        return cert_path, key_path
-    else:
-        raise ValueError("cert and key path must be provided")
+    # A replaced CA leaves the trust store before its successor goes in; kept on disk until that succeeds
+    for retired in res["retired"]:
+        if is_installed(retired, CA_MARKER):
+            removed, message = uninstall_certificate_auto(retired)
+            if not removed:
+                print(f"Warning: Failed to remove the replaced local CA {retired}: {message}")
+                continue
+        os.remove(retired)
+
+    # Only the local CA goes into the trust store, once; leaf certs it signs need no install
+    if not is_installed(res["ca"], CA_MARKER):
+        installed, message = install_certificate_auto(res["ca"])
+        if installed:
+            mark_installed(res["ca"], CA_MARKER)
+        else:
+            print(f"Warning: Failed to install the local CA {res['ca']}: {message}")
+
+    return res["cert"], res["key"]
 
-def update_hosts():
+def update_hosts(hosts: List[str]):
     plat = detect_platform()
     if plat == Platform.WINDOWS:
-        cert.utils.configure_hosts(config.config.hosts(), cert.windows.DEFAULT_HOSTS_PATH)
+        cert.utils.configure_hosts(hosts, cert.windows.DEFAULT_HOSTS_PATH)
     elif plat == Platform.LINUX:
-        cert.utils.configure_hosts(config.config.hosts(), cert.linux.DEFAULT_HOSTS_PATH)
+        cert.utils.configure_hosts(hosts, cert.linux.DEFAULT_HOSTS_PATH)
     else:
         raise ValueError(f"unsupported platform: {plat}")
     
-def remove_hosts():
+def remove_hosts(hosts: List[str]):
     plat = detect_platform()
     if plat == Platform.WINDOWS:
-        cert.utils.remove_hosts(config.config.hosts(), cert.windows.DEFAULT_HOSTS_PATH)
+        cert.utils.remove_hosts(hosts, cert.windows.DEFAULT_HOSTS_PATH)
     elif plat == Platform.LINUX:
-        cert.utils.remove_hosts(config.config.hosts(), cert.linux.DEFAULT_HOSTS_PATH)
+        cert.utils.remove_hosts(hosts, cert.linux.DEFAULT_HOSTS_PATH)
     else:
         raise ValueError(f"unsupported platform: {plat}")
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Local proxy for OpenAI-compatible APIs")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the port with SO_REUSEPORT (default 1)")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and not workers.supported():
+        parser.error("--workers needs SO_REUSEPORT, which this platform does not have")
+    return args
+
 if __name__ == "__main__":
-    cert_path = 'cert.pem'
-    key_path = 'key.pem'
+    multiprocessing.freeze_support()
+    args = parse_args()
 
-    if config.config.modified():
-        cert_path, key_path = configure_cert(cert_path, key_path)
-        config.config.update_lock()
-    
-    update_hosts()
+    # Hosts, the certificate, the engine and the admin server are set up once; the rest of
+    # the config is reloaded while running
+    hosts = config.config.hosts()
+    cert_path, key_path = configure_cert(hosts)
+    update_hosts(hosts)
+    config.config.watch()
 
-    server.start(PORT, ProxyHandler, certfile=cert_path, keyfile=key_path)
+    admin_settings = config.config.admin()
+    admin.start(admin_settings["host"], admin_settings["port"])
+
+    if args.workers > 1:
+        workers.start(args.workers, PORT, certfile=cert_path, keyfile=key_path)
+    elif config.config.engine() == "asyncio":
+        aio.start(PORT, certfile=cert_path, keyfile=key_path)
+    else:
+        server.start(PORT, ProxyHandler, certfile=cert_path, keyfile=key_path)
 
-    remove_hosts()
\ No newline at end of file
+    registry.close()
+    remove_hosts(hosts)
\ No newline at end of file
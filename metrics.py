@@ -0,0 +1,235 @@
+"""
+Prometheus metrics, rendered in the text exposition format by the admin server.
+
+Recording takes no lock: every thread writes into its own shard, and a scrape sums the
+shards. When a thread exits its shard is folded into a shared total, so counters never
+go backwards. Per-request labels (route, model, upstream, status) are carried in a
+context variable, which follows the request into asyncio tasks and executor threads.
+With `--workers`, the supervisor adds the values of its worker processes to each scrape.
+"""
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# name -> (type, help, buckets)
+METRICS: Dict[str, Tuple[str, str, Tuple[float, ...]]] = {
+    "ai_proxy_requests_total": ("counter", "Requests by route, model, upstream and status.", ()),
+    "ai_proxy_request_duration_seconds": ("histogram", "Time from dispatch until the response is complete.", LATENCY_BUCKETS),
+    "ai_proxy_upstream_connect_seconds": ("histogram", "Time to open a new upstream connection, by phase (tcp, tls).", LATENCY_BUCKETS),
+    "ai_proxy_time_to_first_token_seconds": ("histogram", "Time from dispatch until the first streamed chunk is written.", LATENCY_BUCKETS),
+    "ai_proxy_inter_chunk_seconds": ("histogram", "Gap between consecutive streamed chunks.", GAP_BUCKETS),
+    "ai_proxy_stream_chunks_total": ("counter", "Streamed chunks written to clients.", ()),
+    "ai_proxy_stream_writes_total": ("counter", "Writes of streamed chunks to clients; chunks close together share one.", ()),
+    "ai_proxy_stream_tokens_total": ("counter", "Completion tokens of streams that reported usage.", ()),
+    "ai_proxy_tls_handshake_seconds": ("histogram", "TLS handshake time of accepted connections, by whether the session was resumed.", LATENCY_BUCKETS),
+    "ai_proxy_tls_handshake_failures_total": ("counter", "Connections dropped during the TLS handshake, by reason (timeout, error, busy).", ()),
+    "ai_proxy_admission_rejected_total": ("counter", "Requests answered with a local 429, by the limit that was hit (client, model, queue).", ()),
+    "ai_proxy_admission_wait_seconds": ("histogram", "Time queued requests waited for admission, by priority.", LATENCY_BUCKETS),
+    "ai_proxy_admission_queued": ("gauge", "Requests waiting for admission.", ()),
+    "ai_proxy_hedges_total": ("counter", "Chat requests sent a second time because the first upstream was slow, by the attempt that won (primary, hedge).", ()),
+    "ai_proxy_hedges_skipped_total": ("counter", "Hedges not sent, by reason (budget, busy).", ()),
+    "ai_proxy_upstream_retries_total": ("counter", "Chat requests sent again after a failed attempt, by reason (timeout, connection, status).", ()),
+    "ai_proxy_upstream_rejected_total": ("counter", "Requests failed fast because every upstream of their group was out of rotation.", ()),
+    "ai_proxy_cancelled_requests_total": ("counter", "Chat requests whose client disconnected, by phase (waiting for upstream, stream).", ()),
+    "ai_proxy_pool_queue_wait_seconds": ("histogram", "Time accepted connections waited for a worker of the pool engine.", LATENCY_BUCKETS),
+    "ai_proxy_pool_rejected_total": ("counter", "Connections answered with 503 because the pool engine's queue was full.", ()),
+    "ai_proxy_pool_workers": ("gauge", "Worker threads of the pool engine.", ()),
+    "ai_proxy_pool_busy_workers": ("gauge", "Pool engine workers serving a connection.", ()),
+    "ai_proxy_pool_queued": ("gauge", "Accepted connections waiting for a pool engine worker.", ()),
+    "ai_proxy_worker_restarts_total": ("counter", "Worker processes started again after they exited.", ()),
+    "ai_proxy_active_requests": ("gauge", "Requests being served.", ()),
+    "ai_proxy_active_streams": ("gauge", "Event streams being relayed.", ()),
+    "ai_proxy_threads": ("gauge", "Live Python threads.", ()),
+}
+
+_lock = threading.Lock()
+_retired: Dict[Tuple[str, Labels], Any] = {}
+_live: Dict[int, Dict[Tuple[str, Labels], Any]] = {}
+_local = threading.local()
+_sources: List[Callable[[], Dict[Tuple[str, Labels], Any]]] = []
+
+class _Shard:
+    def __init__(self) -> None:
+        self.values: Dict[Tuple[str, Labels], Any] = {}
+
+def _retire(values: Dict[Tuple[str, Labels], Any]) -> None:
+    with _lock:
+        _live.pop(id(values), None)
+        merge(_retired, values)
+
+def _values() -> Dict[Tuple[str, Labels], Any]:
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _local.shard = _Shard()
+        with _lock:
+            _live[id(shard.values)] = shard.values
+        weakref.finalize(shard, _retire, shard.values)
+    return shard.values
+
+def merge(into: Dict[Tuple[str, Labels], Any], values: Dict[Tuple[str, Labels], Any]) -> None:
+    for key, value in list(values.items()):
+        if isinstance(value, list):
+            current = into.get(key)
+            if current is None:
+                into[key] = list(value)
+            else:
+                for i, v in enumerate(value):
+                    current[i] += v
+        else:
+            into[key] = into.get(key, 0) + value
+
+def inc(name: str, labels: Labels = (), value: float = 1) -> None:
+    """Add to a counter or gauge."""
+    values = _values()
+    key = (name, labels)
+    values[key] = values.get(key, 0) + value
+
+def observe(name: str, labels: Labels, value: float) -> None:
+    values = _values()
+    key = (name, labels)
+    buckets = METRICS[name][2]
+    counts = values.get(key)
+    if counts is None:
+        # One slot per bucket, then +Inf, sum and count
+        counts = values[key] = [0.0] * (len(buckets) + 3)
+    counts[bisect.bisect_left(buckets, value)] += 1
+    counts[-2] += value
+    counts[-1] += 1
+
+class RequestMetrics:
+    """Labels and timings of the request being served."""
+
+    def __init__(self, route: str) -> None:
+        self.route = route
+        self.model = ""
+        self.upstream = ""
+        self.status = 0
+        self.start = time.perf_counter()
+
+    def labels(self) -> Labels:
+        return (("route", self.route), ("model", self.model), ("upstream", self.upstream), ("status", str(self.status)))
+
+_current: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar("request_metrics", default=None)
+
+def current() -> Optional[RequestMetrics]:
+    return _current.get()
+
+@contextlib.contextmanager
+def request(route: str) -> Iterator[RequestMetrics]:
+    """Count the request and its duration once the handler returns."""
+    metrics = RequestMetrics(route)
+    token = _current.set(metrics)
+    inc("ai_proxy_active_requests")
+    try:
+        yield metrics
+    finally:
+        inc("ai_proxy_active_requests", (), -1)
+        inc("ai_proxy_requests_total", metrics.labels())
+        observe("ai_proxy_request_duration_seconds", (("route", route),), time.perf_counter() - metrics.start)
+        _current.reset(token)
+
+def annotate(model: Optional[str] = None, upstream: Optional[str] = None) -> None:
+    metrics = _current.get()
+    if metrics is None:
+        return
+    if model is not None:
+        metrics.model = model
+    if upstream is not None:
+        metrics.upstream = upstream
+
+def record_status(code: int) -> None:
+    """Keep the first status sent for the current request."""
+    metrics = _current.get()
+    if metrics is not None and not metrics.status:
+        metrics.status = code
+
+class StreamMetrics:
+    """Per-chunk timings of one relayed stream; `chunk` is called on the hot loop."""
+
+    def __init__(self) -> None:
+        request_metrics = _current.get()
+        self.start = request_metrics.start if request_metrics else time.perf_counter()
+        self.labels: Labels = (("route", request_metrics.route), ("model", request_metrics.model)) if request_metrics else ()
+        self.last: Optional[float] = None
+        self.chunks = 0
+        inc("ai_proxy_active_streams")
+
+    def chunk(self) -> None:
+        now = time.perf_counter()
+        if self.last is None:
+            observe("ai_proxy_time_to_first_token_seconds", self.labels, now - self.start)
+        else:
+            observe("ai_proxy_inter_chunk_seconds", self.labels, now - self.last)
+        self.last = now
+        self.chunks += 1
+
+    def close(self, usage: Optional[Dict[str, Any]] = None, writes: Optional[int] = None) -> None:
+        inc("ai_proxy_active_streams", (), -1)
+        inc("ai_proxy_stream_chunks_total", self.labels, self.chunks)
+        inc("ai_proxy_stream_writes_total", self.labels, self.chunks if writes is None else writes)
+        tokens = (usage or {}).get("completion_tokens")
+        if isinstance(tokens, int):
+            inc("ai_proxy_stream_tokens_total", self.labels, tokens)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def snapshot() -> Dict[Tuple[str, Labels], Any]:
+    """All values recorded in this process."""
+    totals: Dict[Tuple[str, Labels], Any] = {}
+    with _lock:
+        merge(totals, _retired)
+        for values in list(_live.values()):
+            merge(totals, values)
+    totals[("ai_proxy_threads", ())] = threading.active_count()
+    return totals
+
+def add_source(source: Callable[[], Dict[Tuple[str, Labels], Any]]) -> None:
+    """Add the values `source` returns (those of other processes) to every scrape."""
+    _sources.append(source)
+
+def render() -> bytes:
+    totals = snapshot()
+    for source in _sources:
+        merge(totals, source())
+
+    by_name: Dict[str, List[Tuple[Labels, Any]]] = {}
+    for (name, labels), value in totals.items():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines: List[str] = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(by_name.get(name, []), key=lambda item: item[0]):
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+
+            cumulative = 0.0
+            for bound, count in zip(buckets + (float("inf"),), value):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', le),))} {_format_value(cumulative)}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-2])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {_format_value(value[-1])}")
+
+    return ("\n".join(lines) + "\n").encode("utf-8")
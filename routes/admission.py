@@ -0,0 +1,315 @@
+"""
+Admission control for the JSON routes.
+
+Each request is charged to token buckets for its client (source address or API key) and
+for its model, one for requests per minute and one for estimated tokens per minute
+(request body size / 4 plus `max_tokens`). A request that finds the buckets short waits
+in a bounded queue, where interactive requests (streams, or `X-Priority: interactive`)
+go before batch ones and may take the place of a queued batch request when the queue is
+full. A request that would wait longer than `max_wait`, or finds no room in the queue,
+is answered at once with 429 and `Retry-After`, without calling upstream.
+"""
+import asyncio
+import fnmatch
+import http.server
+import itertools
+import json
+import math
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Tuple
+
+import config
+import metrics
+
+DEFAULT_ADMISSION: Dict[str, Any] = {
+    "enabled": False,
+    # "address" or "api_key"
+    "client_key": "address",
+    "client": {"rpm": 0, "tpm": 0},
+    # Model name or glob pattern -> {"rpm": ..., "tpm": ...}
+    "models": {},
+    "max_wait": 2.0,
+    "queue_size": 64,
+}
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+PRIORITY_HEADER = "X-Priority"
+
+# Longest sleep between checks of a queued request
+POLL_INTERVAL = 0.05
+# Buckets kept before full (idle) ones are dropped
+MAX_BUCKETS = 10000
+# Model names whose limits are remembered; others are looked up each time
+MAX_MODELS = 4096
+
+class TokenBucket:
+    """Holds up to one minute of `per_minute` and refills continuously."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, needed: float) -> float:
+        """Seconds until `needed` tokens are available; call `refill` first."""
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+# One charge of a request: the bucket, the amount and which limit it is ("client" or "model")
+Demand = Tuple[TokenBucket, float, str]
+
+class Ticket:
+    """A request waiting for admission, ordered by priority and then arrival."""
+
+    def __init__(self, priority: int, seq: int, demands: List[Demand], deadline: float) -> None:
+        self.key = (priority, seq)
+        self.demands = demands
+        self.deadline = deadline
+        self.start = time.perf_counter()
+        self.evicted = False
+
+def _limits(value: Any) -> Tuple[float, float]:
+    value = value or {}
+    return float(value.get("rpm", 0) or 0), float(value.get("tpm", 0) or 0)
+
+class Admission:
+    def __init__(self, settings: Dict[str, Any]) -> None:
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._queue: List[Ticket] = []
+        self._client_limits = _limits(settings["client"])
+        self._model_limits: Dict[str, Tuple[float, float]] = {}
+        self._buckets: Dict[Tuple[str, str, str], TokenBucket] = {}
+
+    def model_limits(self, model: str) -> Tuple[float, float]:
+        """Limits of the exact model name, or else of the first matching pattern."""
+        limits = self._model_limits.get(model)
+        if limits is None:
+            models = self.settings["models"]
+            if model in models:
+                limits = _limits(models[model])
+            else:
+                limits = next((_limits(v) for p, v in models.items() if fnmatch.fnmatchcase(model, p)), (0.0, 0.0))
+            if len(self._model_limits) < MAX_MODELS:
+                self._model_limits[model] = limits
+        return limits
+
+    def _bucket(self, scope: str, name: str, kind: str, per_minute: float) -> TokenBucket:
+        key = (scope, name, kind)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(per_minute)
+        return bucket
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        queued = {id(bucket) for ticket in self._queue for bucket, _, _ in ticket.demands}
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity and id(bucket) not in queued:
+                del self._buckets[key]
+
+    def _demands(self, client: str, model: str, tokens: float) -> List[Demand]:
+        demands: List[Demand] = []
+        for scope, name, (rpm, tpm) in (("client", client, self._client_limits), ("model", model, self.model_limits(model))):
+            if rpm > 0:
+                demands.append((self._bucket(scope, name, "requests", rpm), 1.0, scope))
+            if tpm > 0:
+                bucket = self._bucket(scope, name, "tokens", tpm)
+                # A request larger than a whole minute of tokens is let through once the bucket is full
+                demands.append((bucket, min(tokens, bucket.capacity), scope))
+        return demands
+
+    def _wait(self, ticket: Ticket) -> Tuple[float, str]:
+        """
+        Seconds until `ticket` can be admitted, counting what the queued requests ahead of
+        it need from the same buckets, and the limit that holds it back.
+        """
+        now = time.monotonic()
+        wait, scope = 0.0, ""
+        for bucket, cost, bucket_scope in ticket.demands:
+            bucket.refill(now)
+            needed = cost + sum(c for t in self._queue if t.key < ticket.key for b, c, _ in t.demands if b is bucket)
+            bucket_wait = bucket.wait_time(needed)
+            if bucket_wait > wait:
+                wait, scope = bucket_wait, bucket_scope
+        return wait, scope
+
+    def _take(self, ticket: Ticket) -> None:
+        for bucket, cost, _ in ticket.demands:
+            bucket.tokens -= cost
+
+    def enter(self, client: str, model: str, tokens: float, priority: int) -> Tuple[Optional[Ticket], float, str]:
+        """
+        Admit a request at once (no ticket, no wait), queue it (a ticket and its expected
+        wait) or reject it (no ticket, the suggested retry delay and the reason).
+        """
+        with self._lock:
+            ticket = Ticket(priority, next(self._seq), self._demands(client, model, tokens), time.monotonic() + float(self.settings["max_wait"]))
+            if not ticket.demands:
+                return None, 0.0, ""
+
+            wait, scope = self._wait(ticket)
+            if wait == 0.0:
+                self._take(ticket)
+                return None, 0.0, ""
+            if wait > float(self.settings["max_wait"]):
+                return None, wait, scope
+            if len(self._queue) >= int(self.settings["queue_size"]):
+                # A full queue makes room for a higher priority request by dropping its last batch one
+                last = max(self._queue, key=lambda t: t.key)
+                if last.key[0] <= priority:
+                    return None, wait, "queue"
+                last.evicted = True
+                self._leave(last)
+
+            self._queue.append(ticket)
+            metrics.inc("ai_proxy_admission_queued")
+            return ticket, wait, scope
+
+    def poll(self, ticket: Ticket) -> Tuple[bool, float, str]:
+        """
+        Check a queued ticket. Returns (False, wait, reason) while it should keep waiting,
+        (True, 0, "") once admitted, and (True, retry delay, reason) when it cannot be
+        admitted before its deadline or was pushed out by a higher priority request.
+        """
+        with self._lock:
+            if ticket.evicted:
+                return True, self._wait(ticket)[0], "queue"
+            wait, scope = self._wait(ticket)
+            if wait == 0.0:
+                self._take(ticket)
+                self._leave(ticket)
+                metrics.observe("ai_proxy_admission_wait_seconds", (("priority", _priority_name(ticket.key[0])),), time.perf_counter() - ticket.start)
+                return True, 0.0, ""
+            if time.monotonic() + wait > ticket.deadline:
+                self._leave(ticket)
+                return True, wait, scope
+            return False, wait, scope
+
+    def _leave(self, ticket: Ticket) -> None:
+        self._queue.remove(ticket)
+        metrics.inc("ai_proxy_admission_queued", (), -1)
+
+def _priority_name(priority: int) -> str:
+    return next(name for name, value in PRIORITIES.items() if value == priority)
+
+def client_key(request: http.server.BaseHTTPRequestHandler, mode: str) -> str:
+    if mode == "api_key":
+        key = request.headers.get("Authorization") or request.headers.get("X-Api-Key")
+        if key:
+            return key
+    return request.client_address[0] if request.client_address else ""
+
+def priority(request: http.server.BaseHTTPRequestHandler, json_data: Mapping[str, Any]) -> int:
+    """`X-Priority` when given, else interactive for streams and batch for the rest."""
+    name = request.headers.get(PRIORITY_HEADER, "").strip().lower()
+    if name in PRIORITIES:
+        return PRIORITIES[name]
+    return PRIORITIES["interactive" if json_data.get("stream", False) else "batch"]
+
+def estimate_tokens(request: http.server.BaseHTTPRequestHandler, json_data: Mapping[str, Any]) -> float:
+    """Prompt tokens guessed from the body size, plus the completion tokens the request allows."""
+    try:
+        size = int(request.headers.get("Content-Length", 0))
+    except ValueError:
+        size = 0
+    completion = json_data.get("max_completion_tokens") or json_data.get("max_tokens") or 0
+    return size / 4 + (completion if isinstance(completion, (int, float)) else 0)
+
+def too_many_requests(request: http.server.BaseHTTPRequestHandler, retry_after: float, reason: str) -> None:
+    metrics.inc("ai_proxy_admission_rejected_total", (("reason", reason),))
+    message = {
+        "client": "Rate limit exceeded for this client",
+        "model": "Rate limit exceeded for this model",
+        "queue": "Too many requests waiting",
+    }[reason]
+    body = json.dumps({"error": message}).encode('utf-8')
+
+    # The rejection of a coalescing leader is for its own client; the followers then go on alone
+    request = getattr(request, "unshared", request)
+    request.send_response(429)
+    request.send_header("Content-Type", "application/json")
+    request.send_header("Retry-After", str(max(1, math.ceil(retry_after))))
+    request.send_header("Content-Length", str(len(body)))
+    request.end_headers()
+
+    request.wfile.write(body)
+
+_lock = threading.Lock()
+_admission: Optional[Admission] = None
+
+def _merge_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_ADMISSION)
+    settings.update({k: v for k, v in snapshot.admission.items() if k in DEFAULT_ADMISSION})
+    return settings
+
+def get_admission() -> Optional[Admission]:
+    """The process-wide limiter, rebuilt (with full buckets) when the `admission` config section changes."""
+    global _admission
+
+    settings = config.config.snapshot().derive("admission", _merge_settings)
+    if not settings["enabled"]:
+        return None
+
+    admission = _admission
+    if admission is not None and admission.settings == settings:
+        return admission
+
+    with _lock:
+        if _admission is None or _admission.settings != settings:
+            _admission = Admission(settings)
+        return _admission
+
+def _enter(admission: Admission, json_data: Mapping[str, Any], request: http.server.BaseHTTPRequestHandler) -> Tuple[Optional[Ticket], float, str]:
+    return admission.enter(
+        client_key(request, admission.settings["client_key"]),
+        str(json_data.get("model", "")),
+        estimate_tokens(request, json_data),
+        priority(request, json_data),
+    )
+
+def admitted(handler: Callable[[Dict[str,Any], http.server.BaseHTTPRequestHandler], None]) -> Callable[[Dict[str,Any], http.server.BaseHTTPRequestHandler], None]:
+    """Call `handler` once the request is admitted, or answer 429."""
+    def wrapper(json_data: Dict[str,Any], request: http.server.BaseHTTPRequestHandler) -> None:
+        admission = get_admission()
+        if admission is None:
+            return handler(json_data, request)
+
+        ticket, wait, reason = _enter(admission, json_data, request)
+        while ticket is not None:
+            time.sleep(min(wait, POLL_INTERVAL))
+            done, wait, reason = admission.poll(ticket)
+            if done:
+                break
+        if reason:
+            return too_many_requests(request, wait, reason)
+        handler(json_data, request)
+    return wrapper
+
+def admitted_async(handler: Callable[[Dict[str,Any], Any], Awaitable[None]]) -> Callable[[Dict[str,Any], Any], Awaitable[None]]:
+    async def wrapper(json_data: Dict[str,Any], request: Any) -> None:
+        admission = get_admission()
+        if admission is None:
+            return await handler(json_data, request)
+
+        ticket, wait, reason = _enter(admission, json_data, request)
+        while ticket is not None:
+            await asyncio.sleep(min(wait, POLL_INTERVAL))
+            done, wait, reason = admission.poll(ticket)
+            if done:
+                break
+        if reason:
+            return too_many_requests(request, wait, reason)
+        await handler(json_data, request)
+    return wrapper
@@ -1,25 +1,81 @@
 import http.server
 import json
-from typing import Any, Callable, Dict, Optional
+from typing import Any, Awaitable, Callable, Dict, Mapping, Optional
+
+from routes.body import body_settings, parse
 
 class BaseRoute[K]:
     def __init__(self, path: str, handler: Callable[[http.server.BaseHTTPRequestHandler], K]) -> None:
         self.path = path
         self.handler = handler
 
+def content_length(request: http.server.BaseHTTPRequestHandler) -> int:
+    try:
+        return int(request.headers.get('Content-Length', 0))
+    except ValueError:
+        return 0
+
+def reject(request: http.server.BaseHTTPRequestHandler, code: int, message: str) -> None:
+    body = json.dumps({"error": message}).encode('utf-8')
+
+    request.send_response(code)
+    request.send_header("Content-Type", "application/json")
+    request.send_header("Content-Length", str(len(body)))
+    request.end_headers()
+
+    request.wfile.write(body)
+
+def check_length(request: http.server.BaseHTTPRequestHandler) -> bool:
+    """Answer 413 before reading a body larger than `body.max_bytes`, and close the connection rather than read it."""
+    max_bytes = int(body_settings()["max_bytes"])
+    if max_bytes and content_length(request) > max_bytes:
+        request.close_connection = True
+        reject(request, 413, f"Request body is larger than {max_bytes} bytes")
+        return False
+    return True
+
+def read_json(request: http.server.BaseHTTPRequestHandler) -> Mapping[str,Any]:
+    body = request.rfile.read(content_length(request))
+    return parse(body)
+
 class ChatRoute(BaseRoute[None]):
-    def __init__(self, path: str, handler: Callable[[Dict[str,Any],http.server.BaseHTTPRequestHandler], None]) -> None:
+    def __init__(self, path: str, handler: Callable[[Dict[str,Any],http.server.BaseHTTPRequestHandler], None], async_handler: Optional[Callable[[Dict[str,Any],http.server.BaseHTTPRequestHandler], Awaitable[None]]] = None) -> None:
         self._handler = handler
+        self._async_handler = async_handler
         def wrapper(request: http.server.BaseHTTPRequestHandler) -> None:
-            content_length = int(request.headers.get('Content-Length', 0))
-            body = request.rfile.read(content_length)
-            json_data = json.loads(body.decode('utf-8'))
-            
-            self._handler(json_data, request)
+            if not check_length(request):
+                return
+            try:
+                json_data = read_json(request)
+            except ValueError:
+                return reject(request, 400, "Invalid JSON body")
+            self._handler(json_data, request)  # type: ignore[arg-type]
         super().__init__(path, wrapper)
 
+        self.async_handler: Optional[Callable[[http.server.BaseHTTPRequestHandler], Awaitable[None]]] = None
+        if async_handler:
+            # The asyncio engine calls `check_length` itself, before buffering the body
+            async def async_wrapper(request: http.server.BaseHTTPRequestHandler) -> None:
+                try:
+                    json_data = read_json(request)
+                except ValueError:
+                    return reject(request, 400, "Invalid JSON body")
+                await async_handler(json_data, request)  # type: ignore[arg-type]
+            self.async_handler = async_wrapper
+
+class EmbeddingsRoute(ChatRoute):
+    """JSON body route for `/embeddings`; its handlers batch concurrent requests upstream."""
+
 class ModelRoute(BaseRoute[Dict[str,Any]]):
     def __init__(self, path: str, list_handler: Callable[[http.server.BaseHTTPRequestHandler], Dict[str,Any]], model_handler: Callable[[str,http.server.BaseHTTPRequestHandler], Optional[Dict[str,Any]]]) -> None:
         self.list_handler = list_handler
         self.model_handler = model_handler
-        super().__init__(path, list_handler)
\ No newline at end of file
+        super().__init__(path, list_handler)
+class ProxyRoute(BaseRoute[None]):
+    """
+    Forwards every method for paths below `path` to the upstream. The handlers get the
+    rest of the path (with the query string) and read the request body themselves.
+    """
+    def __init__(self, path: str, handler: Callable[[str,http.server.BaseHTTPRequestHandler], None], async_handler: Optional[Callable[[str,Any], Awaitable[None]]] = None) -> None:
+        super().__init__(path, handler)  # type: ignore[arg-type]
+        self.async_handler = async_handler
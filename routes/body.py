@@ -0,0 +1,217 @@
+"""
+Lazy JSON request bodies.
+
+`RequestBody` keeps the bytes the client sent and finds where each top-level value
+starts and ends, skipping over strings and nested values without decoding them. Only
+the values the proxy asks for (`model`, `stream`, ...) are parsed, and the request is
+forwarded upstream as the original bytes, with the model name spliced in when a route
+rewrites it. For large requests (long contexts, base64 images) this avoids decoding the
+body to `str`, building the full dict and serializing it again.
+"""
+import hashlib
+import json
+import re
+from typing import Any, Dict, Iterator, Mapping, Optional, Tuple
+
+import config
+
+DEFAULT_BODY: Dict[str, Any] = {
+    "lazy": False,
+    "max_bytes": 32 * 1024 * 1024,
+}
+
+_WHITESPACE = b" \t\r\n"
+_STRUCTURE = re.compile(rb'["{}\[\]]')
+_SCALAR_END = re.compile(rb'[,}\]\s]')
+
+# Each escaped quote costs a step in Python; past this many the body is parsed in full instead
+MAX_ESCAPED_QUOTES = 1024
+
+class EscapeHeavy(ValueError):
+    """The body has too many escaped quotes to be scanned faster than `json.loads` parses it."""
+
+def _merge_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_BODY)
+    settings.update({k: v for k, v in snapshot.body.items() if k in DEFAULT_BODY})
+    return settings
+
+def body_settings() -> Dict[str, Any]:
+    """`body` merged over the defaults."""
+    return config.config.snapshot().derive("body", _merge_settings)
+
+class _Scanner:
+    """Finds value boundaries with `bytes.find` and regex searches, which run in C."""
+
+    def __init__(self, raw: bytes) -> None:
+        self.raw = raw
+        self.escaped_quotes = 0
+
+    def skip_whitespace(self, i: int) -> int:
+        raw = self.raw
+        while i < len(raw) and raw[i] in _WHITESPACE:
+            i += 1
+        return i
+
+    def string_end(self, start: int) -> int:
+        """Index after the closing quote of the string starting at `start`."""
+        raw = self.raw
+        i = start
+        while True:
+            i = raw.find(b'"', i + 1)
+            if i < 0:
+                raise ValueError("unterminated string in request body")
+            if raw[i - 1] != 0x5C:  # \
+                return i + 1
+            # The quote is escaped when an odd number of backslashes precede it
+            backslashes = 1
+            while raw[i - 1 - backslashes] == 0x5C:
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return i + 1
+            self.escaped_quotes += 1
+            if self.escaped_quotes > MAX_ESCAPED_QUOTES:
+                raise EscapeHeavy("request body has too many escaped quotes to scan")
+
+    def value_end(self, start: int) -> int:
+        """Index after the JSON value starting at `start`, without decoding it."""
+        raw = self.raw
+        first = raw[start:start + 1]
+        if first == b'"':
+            return self.string_end(start)
+
+        if first not in (b"{", b"["):
+            match = _SCALAR_END.search(raw, start)
+            end = match.start() if match else len(raw)
+            if end == start:
+                raise ValueError("missing value in request body")
+            return end
+
+        depth = 0
+        i = start
+        while True:
+            match = _STRUCTURE.search(raw, i)
+            if match is None:
+                raise ValueError("unterminated value in request body")
+            i = match.start()
+            c = raw[i]
+            if c == 0x22:  # "
+                i = self.string_end(i)
+                continue
+            depth += 1 if c in (0x7B, 0x5B) else -1  # { [
+            i += 1
+            if depth == 0:
+                return i
+
+def scan(raw: bytes) -> Dict[str, Tuple[int, int]]:
+    """Start and end of the value of each top-level key; a repeated key keeps its last value, as `json.loads` does."""
+    scanner = _Scanner(raw)
+    spans: Dict[str, Tuple[int, int]] = {}
+    i = scanner.skip_whitespace(0)
+    if raw[i:i + 1] != b"{":
+        raise ValueError("request body is not a JSON object")
+
+    i = scanner.skip_whitespace(i + 1)
+    if raw[i:i + 1] == b"}":
+        return spans
+
+    while True:
+        if raw[i:i + 1] != b'"':
+            raise ValueError("expected a key in request body")
+        key_end = scanner.string_end(i)
+        key = json.loads(raw[i:key_end])
+
+        i = scanner.skip_whitespace(key_end)
+        if raw[i:i + 1] != b":":
+            raise ValueError("expected ':' in request body")
+        start = scanner.skip_whitespace(i + 1)
+        end = scanner.value_end(start)
+        spans[key] = (start, end)
+
+        i = scanner.skip_whitespace(end)
+        separator = raw[i:i + 1]
+        if separator == b"}":
+            return spans
+        if separator != b",":
+            raise ValueError("expected ',' or '}' in request body")
+        i = scanner.skip_whitespace(i + 1)
+
+class RequestBody(Mapping[str, Any]):
+    """
+    A JSON object body that parses top-level values on first access and keeps the raw
+    bytes for forwarding. Behaves as a read-only mapping, so routes can use it in place
+    of the parsed dict.
+    """
+
+    def __init__(self, raw: bytes, spans: Optional[Dict[str, Tuple[int, int]]] = None) -> None:
+        self.raw = raw
+        self._spans = spans if spans is not None else scan(raw)
+        self._values: Dict[str, Any] = {}
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        start, end = self._spans[key]
+        value = self._values[key] = json.loads(self.raw[start:end])
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._spans)
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def replace(self, key: str, value: Any) -> "RequestBody":
+        """A copy with the top-level `key` set to `value`; only that value's bytes change."""
+        encoded = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        span = self._spans.get(key)
+        if span is None:
+            # Add the key right after the opening brace
+            at = self.raw.index(b"{") + 1
+            prefix = json.dumps(key).encode("utf-8") + b":"
+            insert = prefix + encoded + (b"," if self._spans else b"")
+            spans = {k: (s + len(insert), e + len(insert)) for k, (s, e) in self._spans.items()}
+            spans[key] = (at + len(prefix), at + len(prefix) + len(encoded))
+            return RequestBody(self.raw[:at] + insert + self.raw[at:], spans)
+
+        start, end = span
+        raw = self.raw[:start] + encoded + self.raw[end:]
+        shift = len(encoded) - (end - start)
+        spans = {
+            k: (s + shift, e + shift) if s >= end else (s, e)
+            for k, (s, e) in self._spans.items()
+        }
+        spans[key] = (start, start + len(encoded))
+        return RequestBody(raw, spans)
+
+def encode(json_data: Mapping[str, Any]) -> bytes:
+    """The body to send upstream: the original bytes of a `RequestBody`, or the serialized dict."""
+    if isinstance(json_data, RequestBody):
+        return json_data.raw
+    return json.dumps(json_data).encode('utf-8')
+
+def fingerprint(json_data: Mapping[str, Any]) -> bytes:
+    """
+    Bytes identifying a request for cache and coalescing keys. Parsed dicts are
+    serialized canonically; lazy bodies use their raw bytes, so they only match
+    byte-identical requests.
+    """
+    if isinstance(json_data, RequestBody):
+        return b"raw:" + hashlib.sha256(json_data.raw).digest()
+    return json.dumps(json_data, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode('utf-8')
+
+def parse(raw: bytes) -> Mapping[str, Any]:
+    """
+    Parse a JSON object request body fully, or lazily when `body.lazy` is on. Bodies
+    full of escaped quotes (source code, nested JSON) are parsed in full either way.
+    """
+    if body_settings()["lazy"]:
+        try:
+            return RequestBody(raw)
+        except EscapeHeavy:
+            pass
+    json_data = json.loads(raw.decode('utf-8'))
+    if not isinstance(json_data, dict):
+        raise ValueError("request body is not a JSON object")
+    return json_data
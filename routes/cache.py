@@ -0,0 +1,327 @@
+"""
+Response cache for deterministic chat completions.
+
+Requests are keyed by a hash of their canonical JSON body (the raw bytes for lazily
+parsed bodies) and of where their model route sends them. Entries live in a memory-bounded LRU with a TTL, optionally backed by
+a SQLite file so they survive restarts. Streamed responses are stored as the SSE bytes that were sent and replayed
+as one event stream.
+"""
+import collections
+import fnmatch
+import hashlib
+import http.server
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Mapping, NamedTuple, Optional, Tuple
+
+import config
+from routes.body import fingerprint
+from routes.model_router import RouteTarget, get_router
+from routes.sse import STREAM_ERROR_EVENT
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE: Dict[str, Any] = {
+    "enabled": False,
+    "max_bytes": 64 * 1024 * 1024,
+    "max_entry_bytes": 1024 * 1024,
+    "ttl": 3600,
+    "disk": None,
+    "models": [],
+    "max_temperature": 0.0,
+}
+
+class CachedResponse(NamedTuple):
+    status: int
+    content_type: str
+    stream: bool
+    body: bytes
+
+def cache_key(json_data: Mapping[str,Any], target: Optional[RouteTarget] = None) -> str:
+    """
+    Key of a request routed to `target` (resolved from its model by default): requests only
+    share a response when the same route sends them to the same upstream group and model.
+    """
+    if target is None:
+        target = get_router().resolve(str(json_data.get("model", "")))
+    route = "\n".join((target.name, target.upstream, target.model or "")).encode('utf-8')
+    return hashlib.sha256(route + b"\n" + fingerprint(json_data)).hexdigest()
+
+class MemoryCache:
+    """LRU bounded by the total size of the cached bodies, with a TTL per entry."""
+
+    def __init__(self, max_bytes: int, ttl: float) -> None:
+        self._lock = threading.Lock()
+        self._entries: collections.OrderedDict[str, Tuple[float, CachedResponse]] = collections.OrderedDict()
+        self._size = 0
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+
+            expires, entry = item
+            if expires < time.monotonic():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: CachedResponse, ttl: Optional[float] = None) -> None:
+        if len(entry.body) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), entry)
+            self._size += len(entry.body)
+
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        _, entry = self._entries.pop(key)
+        self._size -= len(entry.body)
+
+class DiskCache:
+    """SQLite tier; expiry uses wall-clock time so entries stay valid across restarts."""
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, expires REAL, status INTEGER, content_type TEXT, stream INTEGER, body BLOB)"
+        )
+        self._db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[Tuple[float, CachedResponse]]:
+        """Return the remaining TTL together with the entry."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT expires, status, content_type, stream, body FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        remaining = row[0] - time.time()
+        if remaining <= 0:
+            return None
+
+        return remaining, CachedResponse(row[1], row[2], bool(row[3]), row[4])
+
+    def put(self, key: str, entry: CachedResponse, ttl: float) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, expires, status, content_type, stream, body) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, time.time() + ttl, entry.status, entry.content_type, int(entry.stream), entry.body),
+            )
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+class ResponseCache:
+    def __init__(self, settings: Dict[str, Any]) -> None:
+        self.settings = settings
+        self.memory = MemoryCache(settings["max_bytes"], settings["ttl"])
+        self.disk: Optional[DiskCache] = None
+        if settings["disk"]:
+            try:
+                self.disk = DiskCache(settings["disk"])
+            except sqlite3.Error:
+                logger.exception("failed to open cache database %s", settings["disk"])
+
+    def eligible(self, json_data: Dict[str,Any]) -> bool:
+        settings = self.settings
+        if not settings["enabled"]:
+            return False
+
+        patterns = settings["models"]
+        model = str(json_data.get("model", ""))
+        if patterns and not any(fnmatch.fnmatchcase(model, p) for p in patterns):
+            return False
+
+        # The API default temperature is 1, so requests without one are not deterministic
+        temperature = json_data.get("temperature", 1.0)
+        return isinstance(temperature, (int, float)) and temperature <= settings["max_temperature"]
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        entry = self.memory.get(key)
+        if entry is not None or self.disk is None:
+            return entry
+
+        item = self.disk.get(key)
+        if item is None:
+            return None
+
+        remaining, entry = item
+        self.memory.put(key, entry, remaining)
+        return entry
+
+    def put(self, key: str, entry: CachedResponse) -> None:
+        self.memory.put(key, entry)
+        if self.disk is not None:
+            self.disk.put(key, entry, self.settings["ttl"])
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+_lock = threading.Lock()
+_cache: Optional[ResponseCache] = None
+
+def cache_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_CACHE)
+    settings.update(snapshot.cache)
+    return settings
+
+def get_cache() -> ResponseCache:
+    """The process-wide cache, rebuilt when the `cache` config section changes."""
+    global _cache
+
+    settings = config.config.snapshot().derive("cache", cache_settings)
+
+    cache = _cache
+    if cache is not None and cache.settings == settings:
+        return cache
+
+    with _lock:
+        if _cache is None or _cache.settings != settings:
+            if _cache is not None:
+                _cache.close()
+            _cache = ResponseCache(settings)
+        return _cache
+
+class RecordingRequest:
+    """
+    Wraps a request handler so the response a route writes can be stored.
+    Adds the `X-Cache: MISS` header and copies the body written after the headers.
+    """
+
+    # The stored body is replayed to other clients, so it must not be content-encoded
+    identity_body = True
+
+    def __init__(self, request: http.server.BaseHTTPRequestHandler, max_bytes: int) -> None:
+        self._request = request
+        self._max_bytes = max_bytes
+        self.wfile = self
+        self.status = 0
+        self.content_type = "application/json"
+        self.body = bytearray()
+        self.complete = True
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._request, name)
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        self.status = code
+        self._request.send_response(code, message)
+
+    def send_header(self, keyword: str, value: str) -> None:
+        if keyword.lower() == "content-type":
+            self.content_type = value
+        self._request.send_header(keyword, value)
+
+    def end_headers(self) -> None:
+        self._request.send_header("X-Cache", "MISS")
+        self._request.end_headers()
+
+    def write(self, data: bytes) -> int:
+        try:
+            written = self._request.wfile.write(data)
+        except Exception:
+            self.complete = False
+            raise
+
+        if self.complete:
+            if len(self.body) + len(data) > self._max_bytes:
+                self.complete = False
+                self.body = bytearray()
+            else:
+                self.body += data
+        return written
+
+    def flush(self) -> None:
+        self._request.wfile.flush()
+
+    async def drain(self) -> None:
+        await self._request.wfile.drain()
+
+    def entry(self) -> Optional[CachedResponse]:
+        if not self.complete or self.status != 200:
+            return None
+
+        stream = self.content_type.startswith("text/event-stream")
+        if stream and STREAM_ERROR_EVENT in self.body:
+            return None
+
+        return CachedResponse(self.status, self.content_type, stream, bytes(self.body))
+
+def replay(entry: CachedResponse, request: http.server.BaseHTTPRequestHandler) -> None:
+    request.send_response(entry.status)
+    request.send_header("Cache-Control", "no-cache")
+    request.send_header("Content-Type", entry.content_type)
+    request.send_header("Content-Length", str(len(entry.body)))
+    request.send_header("X-Cache", "HIT")
+    request.end_headers()
+
+    request.wfile.write(entry.body)
+    request.wfile.flush()
+
+def _lookup(json_data: Dict[str,Any], request: http.server.BaseHTTPRequestHandler) -> Tuple[Optional[ResponseCache], Optional[str], bool]:
+    cache = get_cache()
+    if not cache.eligible(json_data):
+        return None, None, False
+
+    key = cache_key(json_data)
+    entry = cache.get(key)
+    if entry is None:
+        return cache, key, False
+
+    replay(entry, request)
+    return cache, key, True
+
+def cached(handler: Callable[[Dict[str,Any], http.server.BaseHTTPRequestHandler], None]) -> Callable[[Dict[str,Any], http.server.BaseHTTPRequestHandler], None]:
+    """Serve eligible chat requests from the cache and store what `handler` writes on a miss."""
+    def wrapper(json_data: Dict[str,Any], request: http.server.BaseHTTPRequestHandler) -> None:
+        cache, key, hit = _lookup(json_data, request)
+        if hit:
+            return
+        if cache is None or key is None:
+            return handler(json_data, request)
+
+        recorder = RecordingRequest(request, cache.settings["max_entry_bytes"])
+        handler(json_data, recorder)  # type: ignore[arg-type]
+
+        entry = recorder.entry()
+        if entry is not None:
+            cache.put(key, entry)
+    return wrapper
+
+def cached_async(handler: Callable[[Dict[str,Any], Any], Awaitable[None]]) -> Callable[[Dict[str,Any], Any], Awaitable[None]]:
+    async def wrapper(json_data: Dict[str,Any], request: Any) -> None:
+        cache, key, hit = _lookup(json_data, request)
+        if hit:
+            return
+        if cache is None or key is None:
+            return await handler(json_data, request)
+
+        recorder = RecordingRequest(request, cache.settings["max_entry_bytes"])
+        await handler(json_data, recorder)
+
+        entry = recorder.entry()
+        if entry is not None:
+            cache.put(key, entry)
+    return wrapper
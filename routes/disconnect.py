@@ -0,0 +1,160 @@
+"""
+Chat requests whose client went away.
+
+A disconnect is noticed when a write to the client fails, and while a request that is not
+a stream waits for its upstream response, when the connection is checked every
+`CHECK_INTERVAL` (a stream's first write does that soon enough). The asyncio engine then
+cancels the upstream call at once. The thread engines wait for upstream in the handler
+thread; one shared watcher thread checks their clients and aborts the upstream attempts of
+those that left. Either way the leases are given back without counting for or against the
+upstream, and the request is counted in `ai_proxy_cancelled_requests_total`.
+"""
+import asyncio
+import contextlib
+import contextvars
+import threading
+from typing import Any, Awaitable, Callable, Iterator, List, Optional, Set, TypeVar
+
+import metrics
+from clients.openai import Abort, aborting
+
+T = TypeVar("T")
+
+CHECK_INTERVAL = 0.25
+# Status recorded for requests cancelled before a response was sent, as nginx logs them
+CLIENT_CLOSED = 499
+
+class ClientDisconnected(Exception):
+    """The client closed its connection while the request waited for upstream."""
+
+def cancelled(phase: str) -> None:
+    """Count a request cancelled by its client while "waiting" for upstream or during the "stream"."""
+    metrics.record_status(CLIENT_CLOSED)
+    metrics.inc("ai_proxy_cancelled_requests_total", (("phase", phase),))
+
+class Watch:
+    """The client of one request and the upstream attempts to abort when it leaves."""
+
+    def __init__(self, request: Any) -> None:
+        self.request = request
+        self.gone = False
+        self._lock = threading.Lock()
+        self._aborts: List[Abort] = []
+
+    def add(self, abort: Abort) -> None:
+        with self._lock:
+            self._aborts.append(abort)
+            gone = self.gone
+        if gone:
+            abort.abort()
+
+    def discard(self, abort: Abort) -> None:
+        with self._lock:
+            self._aborts.remove(abort)
+
+    def check(self) -> None:
+        if self.gone or not self.request.disconnected():
+            return
+        with self._lock:
+            self.gone = True
+            aborts = list(self._aborts)
+        for abort in aborts:
+            abort.abort()
+
+_watch: contextvars.ContextVar[Optional[Watch]] = contextvars.ContextVar("client_watch", default=None)
+
+class _Watcher:
+    """One daemon thread checking the clients of the watched requests."""
+
+    def __init__(self) -> None:
+        self._ready = threading.Condition()
+        self._watches: Set[Watch] = set()
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, watch: Watch) -> None:
+        with self._ready:
+            self._watches.add(watch)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="client-watcher", daemon=True)
+                self._thread.start()
+            elif len(self._watches) == 1:
+                self._ready.notify()
+
+    def discard(self, watch: Watch) -> None:
+        with self._ready:
+            self._watches.discard(watch)
+
+    def _run(self) -> None:
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: self._watches)
+                self._ready.wait(CHECK_INTERVAL)
+                watches = list(self._watches)
+            for watch in watches:
+                try:
+                    watch.check()
+                except Exception:
+                    pass
+
+_watcher = _Watcher()
+
+def gone() -> bool:
+    """Whether the watched client of the current request has left."""
+    watch = _watch.get()
+    return watch is not None and watch.gone
+
+@contextlib.contextmanager
+def attempt(abort: Optional[Abort] = None) -> Iterator[Abort]:
+    """
+    Run one upstream attempt in this thread, abortable by `abort` (a new one by default),
+    which is also aborted when the watched client of the request leaves.
+    """
+    abort = abort or Abort()
+    watch = _watch.get()
+    if watch is not None:
+        watch.add(abort)
+    try:
+        with aborting(abort):
+            yield abort
+    finally:
+        if watch is not None:
+            watch.discard(abort)
+
+def guard(request: Any, open_: Callable[[], T], close: Callable[[T], None]) -> T:
+    """
+    Run `open_` while the watcher checks the client of `request`. When the client is gone,
+    the attempts under way are aborted, a result that came in meanwhile is closed and
+    `ClientDisconnected` is raised.
+    """
+    watch = Watch(request)
+    token = _watch.set(watch)
+    _watcher.add(watch)
+    try:
+        result = open_()
+    except Exception:
+        if watch.gone:
+            raise ClientDisconnected()
+        raise
+    finally:
+        _watcher.discard(watch)
+        _watch.reset(token)
+
+    if watch.gone:
+        close(result)
+        raise ClientDisconnected()
+    return result
+
+async def guard_async(request: Any, awaitable: Awaitable[T]) -> T:
+    """Await `awaitable`, cancelling it and raising `ClientDisconnected` as soon as the client is gone."""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while not task.done():
+            await asyncio.wait((task,), timeout=CHECK_INTERVAL)
+            if not task.done() and request.disconnected():
+                task.cancel()
+                # Let the upstream call close its connection before the lease is given back
+                await asyncio.gather(task, return_exceptions=True)
+                raise ClientDisconnected()
+        return task.result()
+    finally:
+        task.cancel()
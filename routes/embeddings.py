@@ -0,0 +1,336 @@
+"""
+Micro-batching for `/v1/embeddings`.
+
+Concurrent requests for the same model and options are collected for a short window and
+sent upstream as one request with an array `input`. The first request of a batch (the
+leader) waits for the window, sends the batch and splits the result back into one
+response per caller, with `index` renumbered from 0 and `usage` shared out by each
+caller's estimated token count (exact for token-array inputs).
+
+If the batched request fails with a client error, every caller retries on its own so
+one bad input does not fail the others.
+"""
+import asyncio
+import http.server
+import json
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import httpx
+
+import config
+from clients.balancer import Balancer
+from routes.body import encode
+from routes.openai import route
+
+DEFAULT_EMBEDDINGS: Dict[str, Any] = {
+    "batch": False,
+    "window_ms": 10,
+    "max_batch_size": 256,
+    "max_batch_tokens": 8192,
+}
+
+class Reply(NamedTuple):
+    status: int
+    content_type: str
+    body: bytes
+
+def error_reply(status: int, message: str) -> Reply:
+    return Reply(status, "application/json", json.dumps({"error": message}).encode('utf-8'))
+
+def _merge_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_EMBEDDINGS)
+    settings.update({k: v for k, v in snapshot.embeddings.items() if k in DEFAULT_EMBEDDINGS})
+    return settings
+
+def embeddings_settings() -> Dict[str, Any]:
+    return config.config.snapshot().derive("embeddings", _merge_settings)
+
+def batch_inputs(json_data: Dict[str,Any]) -> Optional[Tuple[str, List[Any]]]:
+    """The request's inputs as a list, with their kind; None when it cannot be batched."""
+    value = json_data.get("input")
+    if isinstance(value, str):
+        return "text", [value]
+    if not isinstance(value, list) or not value:
+        return None
+
+    if all(isinstance(item, str) for item in value):
+        return "text", value
+    if all(isinstance(item, int) for item in value):
+        return "tokens", [value]
+    if all(isinstance(item, list) and all(isinstance(t, int) for t in item) for item in value):
+        return "tokens", value
+    return None
+
+def estimate_tokens(inputs: List[Any]) -> int:
+    return sum(len(item) if isinstance(item, list) else len(item) // 4 + 1 for item in inputs)
+
+def apportion(total: int, weights: List[int]) -> List[int]:
+    """Split `total` in proportion to `weights` so that the shares add up exactly."""
+    whole = sum(weights) or 1
+    shares: List[int] = []
+    cumulative = 0
+    previous = 0
+    for weight in weights:
+        cumulative += weight
+        current = round(total * cumulative / whole)
+        shares.append(current - previous)
+        previous = current
+    return shares
+
+class Batch:
+    def __init__(self, json_data: Dict[str,Any]) -> None:
+        self._cond = threading.Condition()
+        self.json_data = json_data
+        self.inputs: List[List[Any]] = []
+        self.weights: List[int] = []
+        self.replies: List[Optional[Reply]] = []
+        self.closed = False
+        self.done = False
+
+    def size(self) -> int:
+        return sum(len(inputs) for inputs in self.inputs)
+
+    def fits(self, inputs: List[Any], weight: int, settings: Dict[str, Any]) -> bool:
+        return (
+            self.size() + len(inputs) <= settings["max_batch_size"]
+            and sum(self.weights) + weight <= settings["max_batch_tokens"]
+        )
+
+    def add(self, inputs: List[Any], weight: int) -> int:
+        self.inputs.append(inputs)
+        self.weights.append(weight)
+        return len(self.inputs) - 1
+
+    def full(self, settings: Dict[str, Any]) -> bool:
+        return self.size() >= settings["max_batch_size"] or sum(self.weights) >= settings["max_batch_tokens"]
+
+    def close(self) -> None:
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def wait_closed(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+    def finish(self, replies: List[Optional[Reply]]) -> None:
+        with self._cond:
+            self.replies = replies
+            self.done = True
+            self._cond.notify_all()
+
+    def wait_done(self) -> None:
+        with self._cond:
+            while not self.done:
+                self._cond.wait()
+
+    def body(self) -> bytes:
+        json_data = dict(self.json_data)
+        json_data["input"] = [item for inputs in self.inputs for item in inputs]
+        return encode(json_data)
+
+    def split(self, reply: Reply) -> List[Optional[Reply]]:
+        """One reply per caller; None tells a caller to send its own request."""
+        if len(self.inputs) == 1:
+            return [reply]
+        if 400 <= reply.status < 500 and reply.status != 429:
+            return [None] * len(self.inputs)
+        if reply.status != 200:
+            return [reply] * len(self.inputs)
+
+        try:
+            result = json.loads(reply.body)
+            data = sorted(result["data"], key=lambda item: item.get("index", 0))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return [None] * len(self.inputs)
+        if len(data) != self.size():
+            return [None] * len(self.inputs)
+
+        usage = result.get("usage") or {}
+        prompt_tokens = apportion(usage.get("prompt_tokens", 0), self.weights)
+        total_tokens = apportion(usage.get("total_tokens", usage.get("prompt_tokens", 0)), self.weights)
+
+        replies: List[Optional[Reply]] = []
+        offset = 0
+        for i, inputs in enumerate(self.inputs):
+            items = [{**item, "index": n} for n, item in enumerate(data[offset:offset + len(inputs)])]
+            offset += len(inputs)
+            body = {
+                **result,
+                "data": items,
+                "usage": {**usage, "prompt_tokens": prompt_tokens[i], "total_tokens": total_tokens[i]},
+            }
+            replies.append(Reply(200, reply.content_type, json.dumps(body).encode('utf-8')))
+        return replies
+
+class AsyncBatch(Batch):
+    """`Batch` for the asyncio engine, where all callers share one event loop."""
+
+    def __init__(self, json_data: Dict[str,Any]) -> None:
+        super().__init__(json_data)
+        self._closed_event = asyncio.Event()
+        self._done_event = asyncio.Event()
+
+    def close(self) -> None:
+        self.closed = True
+        self._closed_event.set()
+
+    async def wait_closed_async(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._closed_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def finish(self, replies: List[Optional[Reply]]) -> None:
+        self.replies = replies
+        self.done = True
+        self._done_event.set()
+
+    async def wait_done_async(self) -> None:
+        await self._done_event.wait()
+
+_lock = threading.Lock()
+_batches: Dict[Any, Batch] = {}
+
+def batch_key(json_data: Dict[str,Any], balancer: Balancer, kind: str) -> Tuple[Any, ...]:
+    options = {k: v for k, v in json_data.items() if k != "input"}
+    return (id(balancer), kind, json.dumps(options, sort_keys=True))
+
+def _join(key: Any, json_data: Dict[str,Any], inputs: List[Any], settings: Dict[str, Any], factory: Any) -> Tuple[Batch, int, bool]:
+    weight = estimate_tokens(inputs)
+    with _lock:
+        batch = _batches.get(key)
+        leader = batch is None or not batch.fits(inputs, weight, settings)
+        if leader:
+            if batch is not None:
+                # Send the open batch now and start a new one
+                del _batches[key]
+                batch.close()
+            batch = _batches[key] = factory(json_data)
+
+        index = batch.add(inputs, weight)
+        if batch.full(settings):
+            del _batches[key]
+            batch.close()
+
+    return batch, index, leader
+
+def _seal(key: Any, batch: Batch) -> None:
+    with _lock:
+        if _batches.get(key) is batch:
+            del _batches[key]
+    batch.close()
+
+def embed(balancer: Balancer, body: bytes) -> Reply:
+    lease = balancer.acquire()
+    if lease is None:
+        return error_reply(503, "All upstreams are busy")
+
+    try:
+        response = lease.client().send_raw("POST", "embeddings", body)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+        lease.record(response.status_code, response.headers)
+        return Reply(response.status_code, response.headers.get("Content-Type", "application/json"), content)
+    except httpx.TimeoutException:
+        return error_reply(504, "Upstream timed out")
+    except httpx.HTTPError:
+        return error_reply(502, "Upstream connection failed")
+    finally:
+        lease.release()
+
+async def embed_async(balancer: Balancer, body: bytes) -> Reply:
+    lease = balancer.acquire()
+    if lease is None:
+        return error_reply(503, "All upstreams are busy")
+
+    try:
+        response = await lease.async_client().send_raw("POST", "embeddings", body)
+        try:
+            content = await response.aread()
+        finally:
+            await response.aclose()
+        lease.record(response.status_code, response.headers)
+        return Reply(response.status_code, response.headers.get("Content-Type", "application/json"), content)
+    except httpx.TimeoutException:
+        return error_reply(504, "Upstream timed out")
+    except httpx.HTTPError:
+        return error_reply(502, "Upstream connection failed")
+    finally:
+        lease.release()
+
+def send_reply(reply: Reply, request: http.server.BaseHTTPRequestHandler) -> None:
+    request.send_response(reply.status)
+    request.send_header("Cache-Control", "no-cache")
+    request.send_header("Content-Type", reply.content_type)
+    request.send_header("Content-Length", str(len(reply.body)))
+    request.end_headers()
+
+    request.wfile.write(reply.body)
+
+def handle(json_data: Dict[str,Any], request: http.server.BaseHTTPRequestHandler) -> None:
+    json_data, balancer = route(json_data)
+    settings = embeddings_settings()
+
+    batchable = batch_inputs(json_data) if settings["batch"] else None
+    if batchable is None:
+        return send_reply(embed(balancer, encode(json_data)), request)
+
+    kind, inputs = batchable
+    key = batch_key(json_data, balancer, kind)
+    batch, index, leader = _join(key, json_data, inputs, settings, Batch)
+
+    if leader:
+        replies: List[Optional[Reply]] = []
+        try:
+            batch.wait_closed(settings["window_ms"] / 1000)
+            _seal(key, batch)
+            replies = batch.split(embed(balancer, batch.body()))
+        finally:
+            _seal(key, batch)
+            batch.finish(replies or [None] * len(batch.inputs))
+    else:
+        batch.wait_done()
+
+    reply = batch.replies[index]
+    if reply is None:
+        reply = embed(balancer, encode(json_data))
+    send_reply(reply, request)
+
+async def handle_async(json_data: Dict[str,Any], request: Any) -> None:
+    json_data, balancer = route(json_data)
+    settings = embeddings_settings()
+
+    batchable = batch_inputs(json_data) if settings["batch"] else None
+    if batchable is None:
+        return send_reply(await embed_async(balancer, encode(json_data)), request)
+
+    kind, inputs = batchable
+    key = ("async",) + batch_key(json_data, balancer, kind)
+    batch, index, leader = _join(key, json_data, inputs, settings, AsyncBatch)
+
+    if leader:
+        replies: List[Optional[Reply]] = []
+        try:
+            await batch.wait_closed_async(settings["window_ms"] / 1000)  # type: ignore[attr-defined]
+            _seal(key, batch)
+            replies = batch.split(await embed_async(balancer, batch.body()))
+        finally:
+            _seal(key, batch)
+            batch.finish(replies or [None] * len(batch.inputs))
+    else:
+        await batch.wait_done_async()  # type: ignore[attr-defined]
+
+    reply = batch.replies[index]
+    if reply is None:
+        reply = await embed_async(balancer, encode(json_data))
+    send_reply(reply, request)
@@ -0,0 +1,221 @@
+"""
+Generic passthrough for `/v1/*` endpoints without a dedicated route (embeddings,
+completions, moderations, audio, files...).
+
+Any method is forwarded to the default upstream group, under the `openai.timeouts`
+deadlines and with the `openai.retries` of the chat route. A request body up to
+`REPLAY_LIMIT` bytes is read first so that a failed attempt can be retried; a larger or
+chunked one is streamed to the upstream while it is read from the client, and that request
+is not retried. The response body is relayed as the raw upstream bytes, undecoded.
+"""
+import asyncio
+import http.server
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+import httpx
+
+from clients.balancer import Lease, get_balancer
+from routes import disconnect
+from routes.openai import handle502, handle503, handle504, send_error
+from routes.retries import UpstreamCall, route_timeouts
+
+CHUNK_SIZE = 64 * 1024
+# Larger bodies are streamed to the upstream instead of read first, and not retried
+REPLAY_LIMIT = 1024 * 1024
+
+HOP_BY_HOP = frozenset({
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade",
+})
+# The upstream key replaces the client's, and the length is set from the body we send
+SKIP_REQUEST_HEADERS = HOP_BY_HOP | {"host", "authorization", "content-length", "accept-encoding"}
+# `send_response` writes its own Server and Date headers
+SKIP_RESPONSE_HEADERS = HOP_BY_HOP | {"server", "date"}
+
+def is_chunked(headers: Any) -> bool:
+    return headers.get("Transfer-Encoding", "").lower() == "chunked"
+
+def valid_length(headers: Any) -> bool:
+    """Whether the body framing can be read: chunked, or no or a well-formed `Content-Length`."""
+    if is_chunked(headers):
+        return True
+    try:
+        return int(headers.get("Content-Length", 0)) >= 0
+    except ValueError:
+        return False
+
+def has_body(headers: Any) -> bool:
+    return is_chunked(headers) or int(headers.get("Content-Length", 0)) > 0
+
+def replayable(headers: Any) -> bool:
+    """Whether the body is small enough to read first and send again on a retry."""
+    return not is_chunked(headers) and int(headers.get("Content-Length", 0)) <= REPLAY_LIMIT
+
+def forward_headers(headers: Any) -> Dict[str, str]:
+    forwarded = {k: v for k, v in headers.items() if k.lower() not in SKIP_REQUEST_HEADERS}
+    # The body is relayed undecoded, so only ask for encodings the client accepts
+    forwarded["Accept-Encoding"] = headers.get("Accept-Encoding", "identity")
+    if not is_chunked(headers) and "Content-Length" in headers:
+        forwarded["Content-Length"] = headers["Content-Length"]
+    return forwarded
+
+def iter_body(rfile: Any, headers: Any) -> Iterator[bytes]:
+    """Read the request body in chunks, decoding `Transfer-Encoding: chunked` framing."""
+    if not is_chunked(headers):
+        remaining = int(headers.get("Content-Length", 0))
+        while remaining > 0:
+            data = rfile.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+        return
+
+    while True:
+        size = int(rfile.readline().split(b";")[0], 16)
+        if size == 0:
+            # Skip trailers
+            while rfile.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            return
+
+        while size > 0:
+            data = rfile.read(min(size, CHUNK_SIZE))
+            if not data:
+                return
+            size -= len(data)
+            yield data
+        rfile.readline()
+
+async def aiter_body(reader: asyncio.StreamReader, headers: Any) -> AsyncIterator[bytes]:
+    if not is_chunked(headers):
+        remaining = int(headers.get("Content-Length", 0))
+        while remaining > 0:
+            data = await reader.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+        return
+
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            return
+
+        while size > 0:
+            data = await reader.read(min(size, CHUNK_SIZE))
+            if not data:
+                return
+            size -= len(data)
+            yield data
+        await reader.readline()
+
+def start_response(response: httpx.Response, request: http.server.BaseHTTPRequestHandler) -> None:
+    request.send_response(response.status_code)
+    for keyword, value in response.headers.multi_items():
+        if keyword.lower() not in SKIP_RESPONSE_HEADERS:
+            request.send_header(keyword, value)
+    request.end_headers()
+
+def abandon(request: Any) -> None:
+    """The upstream failed after the response started: close the connection so the client sees a truncated body."""
+    request.close_connection = True
+
+def forward(path: str, request: http.server.BaseHTTPRequestHandler) -> None:
+    """Forward `request` to `path` below the upstream base URL."""
+    if not valid_length(request.headers):
+        return send_error(request, 400, "Invalid Content-Length")
+
+    balancer = get_balancer()
+    call = UpstreamCall(balancer, route_timeouts(), replayable=replayable(request.headers))
+    lease: Optional[Lease] = call.acquire()
+    if lease is None:
+        return handle503(request, balancer.retry_after())
+
+    response = None
+    try:
+        content: Any = None
+        if has_body(request.headers):
+            content = b"".join(iter_body(request.rfile, request.headers)) if call.replayable else iter_body(request.rfile, request.headers)
+        headers = forward_headers(request.headers)
+        lease, response = call.open(
+            lease,
+            lambda l: l.client().send_raw(request.command, path, content, headers, timeout=call.timeout()),
+            lambda r: r.close(),
+            lambda r: r,
+        )
+        lease.record(response.status_code, response.headers)
+
+        start_response(response, request)
+        for data in call.bounded(response.iter_raw()):
+            request.wfile.write(data)
+            request.wfile.flush()
+    except OSError:
+        # The client left: while its body was read, or while the response was written
+        disconnect.cancelled("waiting" if response is None else "stream")
+        abandon(request)
+    except httpx.TimeoutException:
+        if response is None:
+            handle504(request)
+        else:
+            abandon(request)
+    except httpx.HTTPError:
+        if response is None:
+            handle502(request)
+        else:
+            abandon(request)
+    finally:
+        if response is not None:
+            response.close()
+        call.release()
+
+async def forward_async(path: str, request: Any) -> None:
+    """Same as `forward`; the body is read from `request.reader`, which the engine leaves unread."""
+    if not valid_length(request.headers):
+        return send_error(request, 400, "Invalid Content-Length")
+
+    balancer = get_balancer()
+    call = UpstreamCall(balancer, route_timeouts(), replayable=replayable(request.headers))
+    lease = call.acquire()
+    if lease is None:
+        return handle503(request, balancer.retry_after())
+
+    response = None
+    try:
+        content: Any = None
+        if has_body(request.headers):
+            content = b"".join([data async for data in aiter_body(request.reader, request.headers)]) if call.replayable else aiter_body(request.reader, request.headers)
+        headers = forward_headers(request.headers)
+        lease, response = await call.open_async(
+            lease,
+            lambda l: l.async_client().send_raw(request.command, path, content, headers, timeout=call.timeout()),
+            lambda r: r.aclose(),
+            lambda r: r,
+        )
+        lease.record(response.status_code, response.headers)
+
+        start_response(response, request)
+        async for data in call.bounded_async(response.aiter_raw()):
+            request.wfile.write(data)
+            await request.wfile.drain()
+    except OSError:
+        # The client left: while its body was read, or while the response was written
+        disconnect.cancelled("waiting" if response is None else "stream")
+        abandon(request)
+    except httpx.TimeoutException:
+        if response is None:
+            handle504(request)
+        else:
+            abandon(request)
+    except httpx.HTTPError:
+        if response is None:
+            handle502(request)
+        else:
+            abandon(request)
+    finally:
+        if response is not None:
+            await response.aclose()
+        call.release()
@@ -0,0 +1,424 @@
+"""
+Hedged chat requests.
+
+When a chat request has not got its first byte from upstream (the response headers, and
+for a stream its first chunk) within the hedging delay, the same request is sent to a
+second upstream of its group, or to the same one when the group has no other. The
+attempt that gets there first is relayed and the other is cancelled.
+
+The delay is `delay` seconds when set, else the `percentile` of recent first-byte times
+for the model route and kind of request (stream or not), once `min_samples` are known. Each
+request earns `budget` of a hedge, so hedges stay under that share of requests over
+time. Responses of hedged requests carry `X-Hedge: primary` or `X-Hedge: hedge`, the
+attempt that won.
+
+On the thread engines the primary attempt runs in the request's thread and the hedge on
+one of at most `max_hedges` hedge threads; the losing attempt's upstream connection is
+shut down at once. A hedge is skipped while that many are under way.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import heapq
+import http.server
+import itertools
+import math
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Mapping, Optional, Tuple, TypeVar
+
+from openai import APIStatusError
+
+import config
+import metrics
+from clients.balancer import Balancer, Lease
+from clients.openai import Abort
+from routes import disconnect
+
+T = TypeVar("T")
+
+DEFAULT_HEDGING: Dict[str, Any] = {
+    "enabled": False,
+    # Fixed delay in seconds; None uses the observed first-byte times
+    "delay": None,
+    "percentile": 95,
+    "min_samples": 50,
+    # Extra requests allowed per request
+    "budget": 0.05,
+    # Hedges under way at once
+    "max_hedges": 16,
+}
+
+HEDGE_HEADER = "X-Hedge"
+
+# First-byte times kept per model route and kind of request
+WINDOW = 500
+# Hedges that may be saved up by quiet periods and spent at once
+MAX_CREDITS = 10.0
+
+class FirstByteTimes:
+    """Recent first-byte times of one kind of request."""
+
+    def __init__(self) -> None:
+        self.samples: Deque[float] = collections.deque(maxlen=WINDOW)
+        self._added = 0
+        self._sorted: List[float] = []
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self._added += 1
+
+    def percentile(self, p: float) -> float:
+        # Sorting is redone after every tenth sample, not on every request
+        if self._added >= 10 or len(self._sorted) != len(self.samples):
+            self._sorted = sorted(self.samples)
+            self._added = 0
+        return self._sorted[min(len(self._sorted) - 1, math.ceil(len(self._sorted) * p / 100) - 1)]
+
+class Hedger:
+    def __init__(self, settings: Dict[str, Any]) -> None:
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._times: Dict[Tuple[str, bool], FirstByteTimes] = {}
+        self._credits = 0.0
+        self._slots = threading.BoundedSemaphore(int(settings["max_hedges"]))
+        self._executor = concurrent.futures.ThreadPoolExecutor(int(settings["max_hedges"]), thread_name_prefix="hedge")
+
+    def delay(self, key: Tuple[str, bool]) -> Optional[float]:
+        """Seconds to wait for the first byte before hedging; None when too little is known."""
+        if self.settings["delay"] is not None:
+            return float(self.settings["delay"])
+        with self._lock:
+            times = self._times.get(key)
+            if times is None or len(times.samples) < int(self.settings["min_samples"]):
+                return None
+            return times.percentile(float(self.settings["percentile"]))
+
+    def record(self, key: Tuple[str, bool], seconds: float) -> None:
+        with self._lock:
+            times = self._times.get(key)
+            if times is None:
+                times = self._times[key] = FirstByteTimes()
+            times.add(seconds)
+
+    def earn(self) -> None:
+        with self._lock:
+            self._credits = min(MAX_CREDITS, self._credits + float(self.settings["budget"]))
+
+    def spend(self) -> bool:
+        with self._lock:
+            if self._credits < 1.0:
+                return False
+            self._credits -= 1.0
+            return True
+
+    def reserve(self) -> bool:
+        """Take a place for a hedge; False while `max_hedges` are under way."""
+        return self._slots.acquire(blocking=False)
+
+    def free(self) -> None:
+        self._slots.release()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> None:
+        """Run a hedge on a hedge thread; there is one per place, so it never waits."""
+        self._executor.submit(fn, *args)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+class _Timers:
+    """One daemon thread running callbacks when they are due, in the context they were scheduled from."""
+
+    def __init__(self) -> None:
+        self._ready = threading.Condition()
+        self._due: List[Tuple[float, int, contextvars.Context, Callable[[], None]]] = []
+        self._order = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, due: float, callback: Callable[[], None]) -> None:
+        with self._ready:
+            heapq.heappush(self._due, (due, next(self._order), contextvars.copy_context(), callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="hedge-timer", daemon=True)
+                self._thread.start()
+            elif self._due[0][3] is callback:
+                self._ready.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._ready:
+                while True:
+                    now = time.monotonic()
+                    if self._due and self._due[0][0] <= now:
+                        break
+                    self._ready.wait(self._due[0][0] - now if self._due else None)
+                _, _, context, callback = heapq.heappop(self._due)
+            try:
+                context.run(callback)
+            except Exception:
+                pass
+
+_timers = _Timers()
+
+_lock = threading.Lock()
+_hedger: Optional[Hedger] = None
+
+def _merge_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_HEDGING)
+    settings.update({k: v for k, v in snapshot.hedging.items() if k in DEFAULT_HEDGING})
+    return settings
+
+def get_hedger() -> Optional[Hedger]:
+    """The process-wide hedger, rebuilt when the `hedging` config section changes."""
+    global _hedger
+
+    settings = config.config.snapshot().derive("hedging", _merge_settings)
+    if not settings["enabled"]:
+        return None
+
+    hedger = _hedger
+    if hedger is not None and hedger.settings == settings:
+        return hedger
+
+    with _lock:
+        if _hedger is None or _hedger.settings != settings:
+            if _hedger is not None:
+                _hedger.shutdown()
+            _hedger = Hedger(settings)
+        return _hedger
+
+class HedgedRequest:
+    """Wraps a request handler to add the `X-Hedge` header to the response."""
+
+    def __init__(self, request: http.server.BaseHTTPRequestHandler, winner: str) -> None:
+        self._request = request
+        self._winner = winner
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._request, name)
+
+    def end_headers(self) -> None:
+        self._request.send_header(HEDGE_HEADER, self._winner)
+        self._request.end_headers()
+
+class Hedge:
+    """
+    The hedging of one chat request. `race` runs the attempts; the leases of the hedges
+    it took are released by `release` once the response is relayed.
+    """
+
+    def __init__(self, hedger: Hedger, balancer: Balancer, key: Tuple[str, bool]) -> None:
+        self.hedger = hedger
+        self.balancer = balancer
+        self.key = key
+        self.leases: List[Lease] = []
+        self.winner = ""
+        hedger.earn()
+
+    def _take(self, primary: Lease) -> Optional[Lease]:
+        """
+        The lease for a hedge, or None when the hedges under way, the budget or the upstreams
+        do not allow one. A hedge taken is given back to the hedger with `free`.
+        """
+        if not self.hedger.reserve():
+            metrics.inc("ai_proxy_hedges_skipped_total", (("reason", "limit"),))
+            return None
+        if not self.hedger.spend():
+            self.hedger.free()
+            metrics.inc("ai_proxy_hedges_skipped_total", (("reason", "budget"),))
+            return None
+        lease = self.balancer.acquire(avoid=primary.upstream, first=False)
+        if lease is None:
+            self.hedger.free()
+            metrics.inc("ai_proxy_hedges_skipped_total", (("reason", "busy"),))
+        else:
+            self.leases.append(lease)
+        return lease
+
+    def _won(self, name: str, lease: Lease, start: float, hedged: bool) -> None:
+        self.hedger.record(self.key, time.perf_counter() - start)
+        metrics.annotate(upstream=lease.upstream.base_url)
+        if hedged:
+            self.winner = name
+            metrics.inc("ai_proxy_hedges_total", (("winner", name),))
+
+    def wrap(self, request: Any) -> Any:
+        """`request`, with the `X-Hedge` header added when a hedge was sent."""
+        return HedgedRequest(request, self.winner) if self.winner else request
+
+    def race(self, primary: Lease, open_: Callable[[Lease], T], close: Callable[[T], None]) -> Tuple[Lease, T]:
+        """
+        Run `open_` on `primary` in this thread, and on a second lease if it is slow, on a
+        hedge thread of the hedger. Returns the lease and result of the first attempt to
+        succeed, the other being aborted; raises the primary's error when every attempt failed.
+        """
+        delay = self.hedger.delay(self.key)
+        start = time.perf_counter()
+        if delay is None:
+            with disconnect.attempt():
+                result = open_(primary)
+            self._won("primary", primary, start, False)
+            return primary, result
+
+        cond = threading.Condition()
+        leases = {"primary": primary}
+        aborts = {"primary": Abort()}
+        winners: List[Tuple[str, Lease, Any]] = []
+        failures: Dict[str, BaseException] = {}
+        settled = False
+
+        def finish(name: str, result: Any, error: Optional[BaseException]) -> bool:
+            """Record how an attempt ended; False when its result came too late and is to be closed."""
+            with cond:
+                cond.notify_all()
+                if winners:
+                    # Aborted for the winner, which is not a failure of its upstream
+                    return False
+                if error is not None:
+                    failures[name] = error
+                    return True
+                winners.append((name, leases[name], result))
+                for other, abort in aborts.items():
+                    if other != name:
+                        abort.abort()
+                return True
+
+        def hedge() -> None:
+            try:
+                with disconnect.attempt(aborts["hedge"]):
+                    result = open_(leases["hedge"])
+            except Exception as e:
+                finish("hedge", None, e)
+            else:
+                if not finish("hedge", result, None):
+                    close(result)
+            finally:
+                self.hedger.free()
+
+        def launch() -> None:
+            with cond:
+                if settled or winners or failures:
+                    return
+                lease = self._take(primary)
+                if lease is None:
+                    return
+                leases["hedge"] = lease
+                aborts["hedge"] = Abort()
+            # The hedge sees the request's pinned config, metrics labels and client watch
+            self.hedger.submit(contextvars.copy_context().run, hedge)
+
+        _timers.schedule(time.monotonic() + delay, launch)
+        try:
+            with disconnect.attempt(aborts["primary"]):
+                result = open_(primary)
+        except Exception as e:
+            finish("primary", None, e)
+        else:
+            if not finish("primary", result, None):
+                close(result)
+
+        with cond:
+            settled = True
+            cond.wait_for(lambda: winners or len(failures) == len(leases))
+            if not winners:
+                raise failures.get("primary") or failures["hedge"]
+            name, lease, result = winners[0]
+            self._cancel(leases, name, failures)
+
+        self._won(name, lease, start, len(leases) > 1)
+        return lease, result
+
+    def _cancel(self, leases: Mapping[str, Lease], winner: str, failures: Mapping[str, BaseException]) -> None:
+        # A losing attempt that failed counts for or against its upstream by its status when
+        # its lease is released; one that was cancelled does not
+        for name, lease in leases.items():
+            if name == winner:
+                continue
+            if name in failures:
+                record_error(lease, failures[name])
+            else:
+                lease.abandon()
+
+    async def race_async(self, primary: Lease, open_: Callable[[Lease], Awaitable[T]], close: Callable[[T], Awaitable[None]]) -> Tuple[Lease, T]:
+        """`race` for the asyncio engine, where the losing attempt is cancelled at once."""
+        delay = self.hedger.delay(self.key)
+        start = time.perf_counter()
+        if delay is None:
+            result = await open_(primary)
+            self._won("primary", primary, start, False)
+            return primary, result
+
+        tasks: Dict[asyncio.Future[Any], Tuple[str, Lease]] = {asyncio.ensure_future(open_(primary)): ("primary", primary)}
+        winner: Optional[asyncio.Future[Any]] = None
+        failures: Dict[str, BaseException] = {}
+        pending = set(tasks)
+        hedge: Optional[Lease] = None
+        try:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            hedge = self._take(primary) if not done else None
+            if hedge is not None:
+                task = asyncio.ensure_future(open_(hedge))
+                tasks[task] = ("hedge", hedge)
+                pending.add(task)
+
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda t: tasks[t][0] != "primary"):
+                    error = task.exception()
+                    if error is not None:
+                        failures[tasks[task][0]] = error
+                    elif winner is None:
+                        winner = task
+                    else:
+                        # Both arrived together; the primary is kept
+                        await close(task.result())
+        finally:
+            for task in pending:
+                task.cancel()
+            if hedge is not None:
+                self.hedger.free()
+
+        if winner is None:
+            raise failures.get("primary") or failures["hedge"]
+        name, lease = tasks[winner]
+        self._cancel(dict(tasks.values()), name, failures)
+
+        self._won(name, lease, start, len(tasks) > 1)
+        return lease, winner.result()
+
+    def release(self) -> None:
+        for lease in self.leases:
+            lease.release()
+
+def record_error(lease: Lease, error: BaseException) -> None:
+    """Keep the status of an attempt that failed with one, so it is not taken for an outage."""
+    if isinstance(error, APIStatusError):
+        lease.record(error.status_code, error.response.headers)
+
+def start(json_data: Mapping[str, Any], balancer: Balancer, route: str) -> Optional[Hedge]:
+    """The hedging of a chat request to the model route `route`, or None when hedging is off."""
+    hedger = get_hedger()
+    if hedger is None:
+        return None
+    return Hedge(hedger, balancer, (route, bool(json_data.get("stream", False))))
+
+def prefetch(chunks: Iterator[T]) -> Iterator[T]:
+    """Wait for the first item of `chunks`; returns an iterator over all of them."""
+    for first in chunks:
+        return itertools.chain((first,), chunks)
+    return iter(())
+
+async def _chain_async(first: T, chunks: AsyncIterator[T]) -> AsyncIterator[T]:
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+async def _empty_async() -> AsyncIterator[Any]:
+    return
+    yield
+
+async def prefetch_async(chunks: AsyncIterator[T]) -> AsyncIterator[T]:
+    async for first in chunks:
+        return _chain_async(first, chunks)
+    return _empty_async()
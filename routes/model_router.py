@@ -0,0 +1,89 @@
+"""
+Model routing table: maps requested model names or glob patterns to an upstream, a
+rewritten model name and the route's upstream timeouts and stream write settings.
+Per-model state (metrics labels, hedging times) is kept by the route's `name`, the
+routed name or pattern, so clients cannot grow it with made-up model names.
+"""
+import fnmatch
+import re
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional
+
+import config
+
+DEFAULT_UPSTREAM = "default"
+# Route name of the models no route matches
+OTHER_MODELS = "other"
+
+class RouteTarget(NamedTuple):
+    upstream: str
+    model: Optional[str]
+    timeouts: Optional[Mapping[str, Any]] = None
+    streaming: Optional[Mapping[str, Any]] = None
+    name: str = OTHER_MODELS
+
+DEFAULT_TARGET = RouteTarget(DEFAULT_UPSTREAM, None)
+
+def is_pattern(name: str) -> bool:
+    return any(c in name for c in "*?[")
+
+class ModelRouter:
+    """
+    Compiled once per config. Exact names are a dict lookup; glob patterns are joined
+    into one regex (first listed wins) and the result is memoized per model name, so
+    requests only pay for a dict lookup once a model has been seen.
+    """
+
+    MEMO_SIZE = 4096
+
+    def __init__(self, entries: List[Mapping[str, Any]]) -> None:
+        self.exact: Dict[str, RouteTarget] = {}
+        self._targets: List[RouteTarget] = []
+        self._memo: Dict[str, RouteTarget] = {}
+
+        patterns: List[str] = []
+        for entry in entries:
+            name = entry.get("model")
+            if not name:
+                continue
+
+            target = RouteTarget(entry.get("upstream", DEFAULT_UPSTREAM), entry.get("target"), entry.get("timeouts"), entry.get("streaming"), name)
+            if is_pattern(name):
+                patterns.append(f"(?P<r{len(self._targets)}>{fnmatch.translate(name)})")
+                self._targets.append(target)
+            else:
+                self.exact.setdefault(name, target)
+
+        self._pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def _match(self, model: str) -> Optional[RouteTarget]:
+        if self._pattern is None:
+            return None
+
+        match = self._pattern.match(model)
+        if match is None or match.lastgroup is None:
+            return None
+        return self._targets[int(match.lastgroup[1:])]
+
+    def resolve(self, model: str) -> RouteTarget:
+        target = self.exact.get(model) or self._memo.get(model)
+        if target is not None:
+            return target
+
+        target = self._match(model) or DEFAULT_TARGET
+        if len(self._memo) < self.MEMO_SIZE:
+            self._memo[model] = target
+        return target
+
+    def knows(self, model: str) -> bool:
+        return model in self.exact or self._match(model) is not None
+
+    def model_ids(self) -> List[str]:
+        """Routed names that can be listed; glob patterns are not."""
+        return list(self.exact)
+
+def _build_router(snapshot: config.ConfigSnapshot) -> ModelRouter:
+    return ModelRouter(list(snapshot.routes))
+
+def get_router() -> ModelRouter:
+    """`openai.routes` of the current config, compiled once per snapshot."""
+    return config.config.snapshot().derive("router", _build_router)
@@ -1,69 +1,432 @@
 import http.server
 import json
-from typing import Any, Dict, Optional
+import math
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Mapping, Optional, Tuple, TypeVar
 
-from clients.openai import OpenAIClient
+import httpx
+
+from clients.balancer import Balancer, Lease, get_balancer
+from openai import APIConnectionError, APIStatusError, APITimeoutError
 from openai.types.chat.chat_completion import ChatCompletion
+from routes import disconnect, hedging
+from routes.body import RequestBody, encode
+from routes.hedging import prefetch, prefetch_async
+from routes.model_router import RouteTarget, get_router
+from routes.retries import UpstreamCall, route_timeouts
+from routes.sse import DONE_EVENT, STREAM_ERROR_EVENT, EventStreamTail
+from routes.streaming import AsyncStreamWriter, StreamWriter, route_streaming
+from server.compression import relay_accepts
 import config
+import metrics
+
+T = TypeVar("T")
+
+def send_error(request: http.server.BaseHTTPRequestHandler, code: int, message: str, headers: Optional[Mapping[str, str]] = None) -> None:
+    body = json.dumps({"error": message}).encode('utf-8')
+
+    request.send_response(code)
+    request.send_header("Cache-Control", "no-cache")
+    request.send_header("Content-Type", "application/json")
+    for keyword, value in (headers or {}).items():
+        request.send_header(keyword, value)
+    request.send_header("Content-Length", str(len(body)))
+    request.end_headers()
+
+    request.wfile.write(body)
 
 def handle500(request: http.server.BaseHTTPRequestHandler) -> None:
-    request.send_response(500)
+    send_error(request, 500, "Internal server error")
+
+def handle502(request: http.server.BaseHTTPRequestHandler) -> None:
+    send_error(request, 502, "Upstream connection failed")
+
+def handle503(request: http.server.BaseHTTPRequestHandler, retry_after: Optional[float] = None) -> None:
+    """`retry_after` is given when every upstream is out of rotation rather than busy."""
+    if retry_after is None:
+        return send_error(request, 503, "All upstreams are busy")
+    send_error(request, 503, "Upstream unavailable", {"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+def handle504(request: http.server.BaseHTTPRequestHandler) -> None:
+    send_error(request, 504, "Upstream timed out")
+
+def send_completion(response: ChatCompletion, request: http.server.BaseHTTPRequestHandler) -> None:
+    # Compact JSON straight from the SDK model; no second parse and dump
+    result = response.to_json(indent=None).encode('utf-8')
+
+    request.send_response(200)
     request.send_header("Cache-Control", "no-cache")
     request.send_header("Content-Type", "application/json")
+    request.send_header("Content-Length", str(len(result)))
     request.end_headers()
-    
-    request.wfile.write(json.dumps({"error": "Internal server error"}).encode('utf-8'))
 
-def handle(json_data : Dict[str,Any], request: http.server.BaseHTTPRequestHandler) -> None:
-    ai_client = OpenAIClient(config.config.api_key(), config.config.base_url())
-    response : ChatCompletion = ai_client.chat.completions.create(**json_data)
-
-    stream = json_data.get("stream", False)
-
-    if not stream:
-        json_str = response.to_json()
-        json_value = json.loads(json_str)
-        result = json.dumps(json_value).encode('utf-8')
-
-        request.send_response(200)
-        request.send_header("Cache-Control", "no-cache")
-        request.send_header("Content-Type", "application/json")
-        request.end_headers()
-        
-        request.wfile.write(result)
-        return
-    
-    # If stream is True, we need to handle the stream response differently
+    request.wfile.write(result)
+
+def start_event_stream(request: http.server.BaseHTTPRequestHandler) -> None:
     request.send_response(200)
     request.send_header("Cache-Control", "no-cache")
     request.send_header("Content-Type", "text/event-stream")
-    request.send_header("Connection", "keep-alive")
     request.end_headers()
 
+def encode_chunk(chunk: Any) -> bytes:
+    chunk_dict = chunk.to_dict()
+    data_str = json.dumps(chunk_dict)
+
+    # Send as Server-Sent Events `data: <json>\n\n` so clients can stream-parse easily.
+    return f"data: {data_str}\n\n".encode("utf-8")
+
+def relay_response(response: httpx.Response, body: bytes, request: http.server.BaseHTTPRequestHandler, content_encoding: Optional[str] = None) -> None:
+    """Write an upstream response body as-is, keeping its status code."""
+    request.send_response(response.status_code)
+    request.send_header("Cache-Control", "no-cache")
+    request.send_header("Content-Type", response.headers.get("Content-Type", "application/json"))
+    if content_encoding:
+        request.send_header("Content-Encoding", content_encoding)
+    request.send_header("Content-Length", str(len(body)))
+    request.end_headers()
+
+    request.wfile.write(body)
+
+def finish_stream(writer: StreamWriter, data: bytes) -> None:
+    """Write the last events of a stream after the queued chunks; the client may already be gone."""
     try:
-        # The SDK may return an iterable streaming response. Handle several possible chunk types.
-        for chunk in response:
-            chunk_dict = chunk.to_dict() # type: ignore
-            data_str = json.dumps(chunk_dict)
+        if data:
+            writer.write(data)
+        writer.flush()
+    except Exception:
+        pass
+
+def relay_stream(response: httpx.Response, request: http.server.BaseHTTPRequestHandler, chunks: Optional[Iterator[bytes]] = None, streaming: Optional[Mapping[str, Any]] = None) -> None:
+    """
+    Relay the upstream event stream bytes unchanged.
+    Events are only looked at by `EventStreamTail` to know whether upstream already sent `[DONE]`.
+    `chunks` continues a body whose first chunk was already read. A failed write means the
+    client is gone: the relay stops at once so the caller closes the upstream stream.
+    """
+    start_event_stream(request)
 
-            # Send as Server-Sent Events `data: <json>\n\n` so clients can stream-parse easily.
-            payload = f"data: {data_str}\n\n".encode("utf-8")
-            request.wfile.write(payload)
-            request.wfile.flush()
+    tail = EventStreamTail()
+    stream = metrics.StreamMetrics()
+    writer = StreamWriter(request, streaming or route_streaming())
+    try:
+        for data in chunks if chunks is not None else response.iter_bytes():
+            tail.feed(data)
+            writer.write(data)
+            stream.chunk()
+    except OSError:
+        disconnect.cancelled("stream")
     except Exception:
-        # On any streaming error, attempt to close the connection gracefully.
+        finish_stream(writer, STREAM_ERROR_EVENT if tail.done else STREAM_ERROR_EVENT + DONE_EVENT)
+    else:
+        finish_stream(writer, b"" if tail.done else DONE_EVENT)
+    finally:
+        writer.close()
+        stream.close(tail.usage(), writer.writes)
+
+def send_passthrough(json_data : Dict[str,Any], lease: Lease, timeout: httpx.Timeout) -> Tuple[httpx.Response, Optional[Iterator[bytes]]]:
+    """
+    Send the request over the pooled connection. For a stream, also wait for its first
+    chunk, so that a stream stalling before it can still be retried or hedged.
+    """
+    response = lease.client().send_raw("POST", "chat/completions", encode(json_data), timeout=timeout)
+    if not json_data.get("stream", False) or response.status_code != 200:
+        return response, None
+    try:
+        return response, prefetch(response.iter_bytes())
+    except BaseException:
+        response.close()
+        raise
+
+def open_guarded(json_data : Dict[str,Any], request: http.server.BaseHTTPRequestHandler, open_: Callable[[], T], close: Callable[[T], None]) -> T:
+    """
+    `open_`, watching the client of a request that is not a stream; a stream finds out
+    its client left when its first chunk cannot be written.
+    """
+    if json_data.get("stream", False):
+        return open_()
+    return disconnect.guard(request, open_, close)
+
+def passthrough(json_data : Dict[str,Any], request: http.server.BaseHTTPRequestHandler, lease: Lease, call: UpstreamCall, streaming: Optional[Mapping[str, Any]] = None) -> None:
+    """Forward the request over the pooled connection and relay the upstream bytes without decoding them."""
+    response = None
+    try:
+        lease, (response, chunks) = open_guarded(json_data, request, lambda: call.open(
+            lease,
+            lambda l: send_passthrough(json_data, l, call.timeout()),
+            lambda r: r[0].close(),
+            lambda r: r[0],
+        ), lambda opened: opened[1][0].close())
+        request = call.wrap(request)
+        lease.record(response.status_code, response.headers)
+        encoding = response.headers.get("Content-Encoding")
+        if json_data.get("stream", False) and response.status_code == 200:
+            relay_stream(response, request, call.bounded(chunks if chunks is not None else response.iter_bytes()), streaming)
+        elif encoding and relay_accepts(request, encoding):
+            # The client takes the upstream's compression: skip decoding and re-encoding
+            relay_response(response, b"".join(response.iter_raw()), request, encoding)
+        else:
+            relay_response(response, response.read(), request)
+    except httpx.TimeoutException:
+        handle504(request)
+    except httpx.HTTPError:
+        handle502(request)
+    finally:
+        if response is not None:
+            response.close()
+
+def open_completion(json_data : Dict[str,Any], lease: Lease, timeout: httpx.Timeout) -> Tuple[Any, Optional[Iterator[Any]]]:
+    """Send the request through the SDK; for a stream, also wait for its first chunk."""
+    response = lease.client().chat.completions.create(**json_data, timeout=timeout)
+    if not json_data.get("stream", False):
+        return response, None
+    try:
+        return response, prefetch(iter(response))
+    except BaseException:
+        response.close()
+        raise
+
+def close_completion(opened: Tuple[Any, Any]) -> None:
+    close = getattr(opened[0], "close", None)
+    if close is not None:
+        close()
+
+def complete(json_data : Dict[str,Any], request: http.server.BaseHTTPRequestHandler, lease: Lease, call: UpstreamCall, streaming: Optional[Mapping[str, Any]] = None) -> None:
+    """Send the request through the SDK and re-encode the parsed response."""
+    try:
+        lease, (response, chunks) = open_guarded(
+            json_data,
+            request,
+            lambda: call.open(lease, lambda l: open_completion(json_data, l, call.timeout()), close_completion),
+            lambda opened: close_completion(opened[1]),
+        )
+    except APIStatusError as e:
+        lease.record(e.status_code, e.response.headers)
+        return relay_response(e.response, e.response.content, request)
+    except (APITimeoutError, httpx.TimeoutException):
+        return handle504(request)
+    except (APIConnectionError, httpx.HTTPError):
+        return handle502(request)
+
+    try:
+        request = call.wrap(request)
+        lease.record(200)
+
+        if not json_data.get("stream", False):
+            send_completion(response, request)
+            return
+
+        # If stream is True, we need to handle the stream response differently
+        start_event_stream(request)
+
+        stream = metrics.StreamMetrics()
+        writer = StreamWriter(request, streaming or route_streaming())
+        usage = None
         try:
-            request.wfile.write(b"data: {\"error\": \"streaming error\"}\n\n")
-            request.wfile.flush()
+            # The SDK may return an iterable streaming response. Handle several possible chunk types.
+            for chunk in call.bounded(chunks if chunks is not None else response):
+                writer.write(encode_chunk(chunk))
+                stream.chunk()
+                usage = getattr(chunk, "usage", None) or usage
+        except OSError:
+            disconnect.cancelled("stream")
         except Exception:
-            pass
+            # On any streaming error, attempt to close the connection gracefully.
+            finish_stream(writer, STREAM_ERROR_EVENT + DONE_EVENT)
+        else:
+            # Send final sentinel so clients know stream is complete and flush.
+            finish_stream(writer, DONE_EVENT)
+        finally:
+            writer.close()
+            stream.close(usage.to_dict() if usage is not None else None, writer.writes)
+    finally:
+        # Closing the SDK stream closes the upstream response, even when the client left early
+        close_completion((response, chunks))
+
+def resolve(json_data : Dict[str,Any]) -> Tuple[Dict[str,Any], Balancer, RouteTarget]:
+    """Apply the model routing table: pick the upstream group and rewrite the model name."""
+    target = get_router().resolve(str(json_data.get("model", "")))
+    metrics.annotate(model=target.name)
+    if target.model:
+        if isinstance(json_data, RequestBody):
+            json_data = json_data.replace("model", target.model)  # type: ignore[assignment]
+        else:
+            json_data = {**json_data, "model": target.model}
+    return json_data, get_balancer(target.upstream), target
+
+def route(json_data : Dict[str,Any]) -> Tuple[Dict[str,Any], Balancer]:
+    """`resolve` for routes that only need the upstream group."""
+    json_data, balancer, _ = resolve(json_data)
+    return json_data, balancer
+
+def handle(json_data : Dict[str,Any], request: http.server.BaseHTTPRequestHandler) -> None:
+    json_data, balancer, target = resolve(json_data)
+    call = UpstreamCall(balancer, route_timeouts(target.timeouts), hedging.start(json_data, balancer, target.name))
+    lease = call.acquire()
+    if lease is None:
+        return handle503(request, balancer.retry_after())
+
+    try:
+        if config.config.snapshot().passthrough:
+            passthrough(json_data, request, lease, call, route_streaming(target.streaming))
+        else:
+            complete(json_data, request, lease, call, route_streaming(target.streaming))
+    except disconnect.ClientDisconnected:
+        disconnect.cancelled("waiting")
+        call.abandon()
+    finally:
+        call.release()
+
+async def finish_stream_async(writer: AsyncStreamWriter, data: bytes) -> None:
+    try:
+        if data:
+            await writer.write(data)
+        await writer.flush()
+    except Exception:
+        pass
+
+async def relay_stream_async(response: httpx.Response, request: Any, chunks: Optional[AsyncIterator[bytes]] = None, streaming: Optional[Mapping[str, Any]] = None) -> None:
+    start_event_stream(request)
+
+    tail = EventStreamTail()
+    stream = metrics.StreamMetrics()
+    writer = AsyncStreamWriter(request, streaming or route_streaming())
+    try:
+        async for data in chunks if chunks is not None else response.aiter_bytes():
+            tail.feed(data)
+            await writer.write(data)
+            stream.chunk()
+    except OSError:
+        disconnect.cancelled("stream")
+    except Exception:
+        await finish_stream_async(writer, STREAM_ERROR_EVENT if tail.done else STREAM_ERROR_EVENT + DONE_EVENT)
+    else:
+        await finish_stream_async(writer, b"" if tail.done else DONE_EVENT)
+    finally:
+        writer.close()
+        stream.close(tail.usage(), writer.writes)
+
+async def send_passthrough_async(json_data : Dict[str,Any], lease: Lease, timeout: httpx.Timeout) -> Tuple[httpx.Response, Optional[AsyncIterator[bytes]]]:
+    response = await lease.async_client().send_raw("POST", "chat/completions", encode(json_data), timeout=timeout)
+    if not json_data.get("stream", False) or response.status_code != 200:
+        return response, None
+    try:
+        return response, await prefetch_async(response.aiter_bytes())
+    except BaseException:
+        await response.aclose()
+        raise
+
+async def close_passthrough_async(opened: Tuple[httpx.Response, Any]) -> None:
+    await opened[0].aclose()
+
+async def passthrough_async(json_data : Dict[str,Any], request: Any, lease: Lease, call: UpstreamCall, streaming: Optional[Mapping[str, Any]] = None) -> None:
+    response = None
+    try:
+        lease, (response, chunks) = await disconnect.guard_async(request, call.open_async(
+            lease,
+            lambda l: send_passthrough_async(json_data, l, call.timeout()),
+            close_passthrough_async,
+            lambda r: r[0],
+        ))
+        request = call.wrap(request)
+        lease.record(response.status_code, response.headers)
+        encoding = response.headers.get("Content-Encoding")
+        if json_data.get("stream", False) and response.status_code == 200:
+            await relay_stream_async(response, request, call.bounded_async(chunks if chunks is not None else response.aiter_bytes()), streaming)
+        elif encoding and relay_accepts(request, encoding):
+            relay_response(response, b"".join([data async for data in response.aiter_raw()]), request, encoding)
+        else:
+            relay_response(response, await response.aread(), request)
+    except httpx.TimeoutException:
+        handle504(request)
+    except httpx.HTTPError:
+        handle502(request)
     finally:
-        # Send final sentinel so clients know stream is complete and flush.
+        if response is not None:
+            await response.aclose()
+
+async def open_completion_async(json_data : Dict[str,Any], lease: Lease, timeout: httpx.Timeout) -> Tuple[Any, Optional[AsyncIterator[Any]]]:
+    response = await lease.async_client().chat.completions.create(**json_data, timeout=timeout)
+    if not json_data.get("stream", False):
+        return response, None
+    try:
+        return response, await prefetch_async(response.__aiter__())
+    except BaseException:
+        await response.close()
+        raise
+
+async def close_completion_async(opened: Tuple[Any, Any]) -> None:
+    close = getattr(opened[0], "close", None)
+    if close is not None:
+        await close()
+
+async def complete_async(json_data : Dict[str,Any], request: Any, lease: Lease, call: UpstreamCall, streaming: Optional[Mapping[str, Any]] = None) -> None:
+    try:
+        lease, (response, chunks) = await disconnect.guard_async(request, call.open_async(lease, lambda l: open_completion_async(json_data, l, call.timeout()), close_completion_async))
+    except APIStatusError as e:
+        lease.record(e.status_code, e.response.headers)
+        return relay_response(e.response, e.response.content, request)
+    except (APITimeoutError, httpx.TimeoutException):
+        return handle504(request)
+    except (APIConnectionError, httpx.HTTPError):
+        return handle502(request)
+
+    try:
+        request = call.wrap(request)
+        lease.record(200)
+
+        if not json_data.get("stream", False):
+            send_completion(response, request)
+            return
+
+        start_event_stream(request)
+
+        stream = metrics.StreamMetrics()
+        writer = AsyncStreamWriter(request, streaming or route_streaming())
+        usage = None
         try:
-            request.wfile.write(b"data: [DONE]\n\n")
-            request.wfile.flush()
+            async for chunk in call.bounded_async(chunks if chunks is not None else response):
+                await writer.write(encode_chunk(chunk))
+                stream.chunk()
+                usage = getattr(chunk, "usage", None) or usage
+        except OSError:
+            disconnect.cancelled("stream")
         except Exception:
-            pass
+            await finish_stream_async(writer, STREAM_ERROR_EVENT + DONE_EVENT)
+        else:
+            await finish_stream_async(writer, DONE_EVENT)
+        finally:
+            writer.close()
+            stream.close(usage.to_dict() if usage is not None else None, writer.writes)
+    finally:
+        await close_completion_async((response, chunks))
+
+async def handle_async(json_data : Dict[str,Any], request: Any) -> None:
+    """
+    Same as `handle`, for the asyncio server engine.
+    `request.wfile.drain()` applies backpressure from slow clients to the upstream stream.
+    """
+    json_data, balancer, target = resolve(json_data)
+    call = UpstreamCall(balancer, route_timeouts(target.timeouts), hedging.start(json_data, balancer, target.name))
+    lease = call.acquire()
+    if lease is None:
+        return handle503(request, balancer.retry_after())
+
+    try:
+        if config.config.snapshot().passthrough:
+            await passthrough_async(json_data, request, lease, call, route_streaming(target.streaming))
+        else:
+            await complete_async(json_data, request, lease, call, route_streaming(target.streaming))
+    except disconnect.ClientDisconnected:
+        disconnect.cancelled("waiting")
+        call.abandon()
+    finally:
+        call.release()
+
+def model_ids() -> List[str]:
+    """Configured models followed by the exact names in the routing table."""
+    snapshot = config.config.snapshot()
+    ids = dict.fromkeys(snapshot.models)
+    ids.update(dict.fromkeys(get_router().model_ids()))
+    return list(ids)
 
 def models(request: http.server.BaseHTTPRequestHandler) -> Dict[str,Any]:
     return {
@@ -75,18 +438,18 @@ def models(request: http.server.BaseHTTPRequestHandler) -> Dict[str,Any]:
                 "created": 1677610602,
                 "owned_by": "ai-proxy",
             }
-            for model_id in config.config.models()
+            for model_id in model_ids()
         ],
     }
 
 def model(model_id: str, _: http.server.BaseHTTPRequestHandler) -> Optional[Dict[str,Any]]:
-    models = config.config.models()
-    if model_id not in models:
+    snapshot = config.config.snapshot()
+    if model_id not in snapshot.models and not get_router().knows(model_id):
         return None
-    
+
     return {
         "id": model_id,
         "object": "model",
         "created": 1677610602,
         "owned_by": "ai-proxy",
-    }
\ No newline at end of file
+    }
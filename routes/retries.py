@@ -0,0 +1,239 @@
+"""
+Deadlines and retries of the upstream calls of chat requests.
+
+Each chat request has a `connect`, a `first_byte` and a `total` deadline, from
+`openai.timeouts` with the `timeouts` of its model route on top. `first_byte` also bounds
+the wait between two chunks of a stream, and a stream still running at the `total`
+deadline is ended with an error event. The SDK's own retries are off: an attempt that
+fails with a connection error, a timeout or a retryable status is retried here, on
+another upstream of the group when there is one, after a jittered exponential backoff.
+A retry on the upstream that answered with `Retry-After` waits at least that long, and is
+not made when that is longer than `max_backoff` or the time left. Retries only happen before anything was written to the client, and only while the
+`total` deadline leaves time for them.
+"""
+import asyncio
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Mapping, Optional, Tuple, TypeVar
+
+import httpx
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+import config
+import metrics
+from clients.balancer import Balancer, Lease, Upstream, parse_retry_after
+from routes import disconnect
+from routes.hedging import Hedge, record_error
+
+T = TypeVar("T")
+
+DEFAULT_TIMEOUTS: Dict[str, Any] = {
+    "connect": 5.0,
+    "first_byte": 600.0,
+    # None for no limit
+    "total": None,
+}
+
+DEFAULT_RETRIES: Dict[str, Any] = {
+    "max_retries": 2,
+    "backoff": 0.5,
+    "max_backoff": 8.0,
+}
+
+RETRY_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """The `total` deadline passed while the response was relayed."""
+
+def _merge_timeouts(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_TIMEOUTS)
+    settings.update({k: v for k, v in snapshot.timeouts.items() if k in DEFAULT_TIMEOUTS})
+    return settings
+
+def _merge_retries(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_RETRIES)
+    settings.update({k: v for k, v in snapshot.retries.items() if k in DEFAULT_RETRIES})
+    return settings
+
+def route_timeouts(route: Optional[Mapping[str, Any]] = None) -> Dict[str, Any]:
+    """`openai.timeouts`, with the `timeouts` of a model route on top."""
+    settings = config.config.snapshot().derive("timeouts", _merge_timeouts)
+    if route:
+        settings = {**settings, **{k: v for k, v in route.items() if k in DEFAULT_TIMEOUTS}}
+    return settings
+
+def retry_reason(error: BaseException) -> Optional[str]:
+    """Why a failed attempt may be retried ("timeout", "connection", "status"), or None when it may not."""
+    if isinstance(error, (httpx.TimeoutException, APITimeoutError)):
+        return "timeout"
+    if isinstance(error, (httpx.TransportError, APIConnectionError)):
+        return "connection"
+    if isinstance(error, APIStatusError) and error.status_code in RETRY_STATUSES:
+        return "status"
+    return None
+
+def _bounded(chunks: Iterator[T], deadline: float) -> Iterator[T]:
+    for chunk in chunks:
+        if time.monotonic() > deadline:
+            raise DeadlineExceeded("total deadline exceeded")
+        yield chunk
+
+async def _bounded_async(chunks: AsyncIterator[T], deadline: float) -> AsyncIterator[T]:
+    async for chunk in chunks:
+        if time.monotonic() > deadline:
+            raise DeadlineExceeded("total deadline exceeded")
+        yield chunk
+
+class UpstreamCall:
+    """
+    The upstream attempts of one chat request. The leases taken by `acquire` and `open`
+    are released by `release` once the response has been relayed.
+    """
+
+    def __init__(self, balancer: Balancer, timeouts: Mapping[str, Any], hedge: Optional[Hedge] = None, replayable: bool = True) -> None:
+        self.balancer = balancer
+        self.timeouts = timeouts
+        self.retries = config.config.snapshot().derive("retries", _merge_retries)
+        self.hedge = hedge
+        # False when the request body is streamed to the first attempt and cannot be sent again
+        self.replayable = replayable
+        total = timeouts["total"]
+        self.deadline = time.monotonic() + float(total) if total else None
+        self.leases: List[Lease] = []
+        self.abandoned = False
+
+    def acquire(self, avoid: Optional[Upstream] = None) -> Optional[Lease]:
+        lease = self.balancer.acquire(avoid, first=not self.leases)
+        if lease is not None:
+            self.leases.append(lease)
+        return lease
+
+    def release(self) -> None:
+        for lease in self.leases:
+            lease.release()
+        if self.hedge is not None:
+            self.hedge.release()
+
+    def abandon(self) -> None:
+        """Release the leases of a request its client cancelled, without counting it for or against the upstreams."""
+        self.abandoned = True
+        for lease in self.leases + (self.hedge.leases if self.hedge is not None else []):
+            lease.abandon()
+
+    def wrap(self, request: Any) -> Any:
+        return self.hedge.wrap(request) if self.hedge is not None else request
+
+    def remaining(self) -> Optional[float]:
+        return self.deadline - time.monotonic() if self.deadline is not None else None
+
+    def timeout(self) -> httpx.Timeout:
+        """Timeouts of the next attempt, cut short by the `total` deadline."""
+        connect = float(self.timeouts["connect"])
+        first_byte = float(self.timeouts["first_byte"])
+        remaining = self.remaining()
+        if remaining is not None:
+            remaining = max(remaining, 0.001)
+            connect, first_byte = min(connect, remaining), min(first_byte, remaining)
+        return httpx.Timeout(first_byte, connect=connect, pool=connect)
+
+    def bounded(self, chunks: Iterator[T]) -> Iterator[T]:
+        """`chunks`, ended with `DeadlineExceeded` once the `total` deadline has passed."""
+        return _bounded(chunks, self.deadline) if self.deadline is not None else chunks
+
+    def bounded_async(self, chunks: AsyncIterator[T]) -> AsyncIterator[T]:
+        return _bounded_async(chunks, self.deadline) if self.deadline is not None else chunks
+
+    def _backoff(self, retry: int) -> Optional[float]:
+        """Seconds to wait before retry number `retry` (from 0), or None when it is not allowed."""
+        if not self.replayable or retry >= int(self.retries["max_retries"]):
+            return None
+        # Full jitter keeps retries from many requests from arriving together
+        delay = random.uniform(0, min(float(self.retries["max_backoff"]), float(self.retries["backoff"]) * 2 ** retry))
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        return delay
+
+    def _retry(self, lease: Lease, retry: int, reason: Optional[str]) -> Optional[Tuple[Lease, float]]:
+        """
+        Release the lease of a failed attempt and take one for the next attempt, preferring
+        another upstream. Returns it with the delay to wait first, or None for no retry.
+        """
+        delay = self._backoff(retry) if reason is not None and not self.abandoned and not disconnect.gone() else None
+        if delay is None:
+            return None
+        lease.release()
+        next_lease = self.acquire(avoid=lease.upstream)
+        if next_lease is None:
+            return None
+        retry_after = parse_retry_after(lease.retry_after)
+        if retry_after is not None and next_lease.upstream is lease.upstream:
+            # Asking again before the upstream said it would take the request only earns another refusal
+            delay = max(delay, retry_after)
+            remaining = self.remaining()
+            if delay > float(self.retries["max_backoff"]) or (remaining is not None and delay >= remaining):
+                next_lease.abandon()
+                return None
+        metrics.inc("ai_proxy_upstream_retries_total", (("reason", reason),))
+        return next_lease, delay
+
+    def open(self, lease: Lease, open_: Callable[[Lease], T], close: Callable[[T], None], response: Callable[[T], Optional[httpx.Response]] = lambda _: None) -> Tuple[Lease, T]:
+        """
+        Open the upstream response on `lease`, hedged when the request is, and retry the
+        attempts that fail. `response` gives the HTTP response of a result, whose status
+        may also call for a retry. Returns the lease and result of the attempt to relay;
+        raises the error of the last attempt when none succeeded.
+        """
+        retry = 0
+        while True:
+            try:
+                if self.hedge is not None:
+                    lease, result = self.hedge.race(lease, open_, close)
+                else:
+                    with disconnect.attempt():
+                        result = open_(lease)
+            except Exception as e:
+                record_error(lease, e)
+                retried = self._retry(lease, retry, retry_reason(e))
+                if retried is None:
+                    raise
+            else:
+                failed = response(result)
+                if failed is None or failed.status_code not in RETRY_STATUSES:
+                    return lease, result
+                lease.record(failed.status_code, failed.headers)
+                retried = self._retry(lease, retry, "status")
+                if retried is None:
+                    return lease, result
+                close(result)
+
+            lease, delay = retried
+            time.sleep(delay)
+            retry += 1
+
+    async def open_async(self, lease: Lease, open_: Callable[[Lease], Awaitable[T]], close: Callable[[T], Awaitable[None]], response: Callable[[T], Optional[httpx.Response]] = lambda _: None) -> Tuple[Lease, T]:
+        retry = 0
+        while True:
+            try:
+                if self.hedge is not None:
+                    lease, result = await self.hedge.race_async(lease, open_, close)
+                else:
+                    result = await open_(lease)
+            except Exception as e:
+                record_error(lease, e)
+                retried = self._retry(lease, retry, retry_reason(e))
+                if retried is None:
+                    raise
+            else:
+                failed = response(result)
+                if failed is None or failed.status_code not in RETRY_STATUSES:
+                    return lease, result
+                lease.record(failed.status_code, failed.headers)
+                retried = self._retry(lease, retry, "status")
+                if retried is None:
+                    return lease, result
+                await close(result)
+
+            lease, delay = retried
+            await asyncio.sleep(delay)
+            retry += 1
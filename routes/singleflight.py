@@ -0,0 +1,337 @@
+"""
+Single-flight coalescing of identical in-flight chat requests.
+
+The first request for a canonical body (the leader) goes upstream; identical requests
+that arrive while it runs (followers) are served from what the leader writes, including
+streamed chunks. Followers that join late first get every chunk buffered so far. Once a
+response passes `MAX_BUFFER` bytes nobody joins it any more, and the chunks every follower
+has written are dropped, so a long stream is not kept in memory to its end.
+"""
+import asyncio
+import http.server
+import itertools
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import config
+from routes import disconnect
+from routes.cache import cache_key
+
+MAX_BUFFER = 8 * 1024 * 1024
+
+class Flight:
+    """Response of one upstream call, shared with the followers waiting on it."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self.status: Optional[int] = None
+        self.headers: List[Tuple[str, str]] = []
+        self.chunks: List[bytes] = []
+        # Index of chunks[0] among all the chunks appended, and the bytes held in chunks
+        self.offset = 0
+        self.size = 0
+        self.full = False
+        self.done = False
+        self.followers = 0
+        self._ids = itertools.count()
+        # Index of the next chunk of each follower
+        self._readers: Dict[int, int] = {}
+
+    def attach(self) -> Optional[int]:
+        """Register a follower; None once the response is past what is kept for late joiners."""
+        with self._cond:
+            if self.full:
+                return None
+            reader = next(self._ids)
+            self._readers[reader] = 0
+            return reader
+
+    def detach(self, reader: int) -> None:
+        with self._cond:
+            self._readers.pop(reader, None)
+            self._trim()
+
+    def _append(self, data: bytes) -> None:
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        if self.size > MAX_BUFFER:
+            self.full = True
+        self._trim()
+
+    def _trim(self) -> None:
+        """Once full, drop the chunks every follower has written."""
+        if not self.full:
+            return
+        drop = min(self._readers.values(), default=self.offset + len(self.chunks)) - self.offset
+        if drop > 0:
+            self.size -= sum(len(chunk) for chunk in self.chunks[:drop])
+            del self.chunks[:drop]
+            self.offset += drop
+
+    def _read(self, reader: int, index: int) -> List[bytes]:
+        self._readers[reader] = index
+        self._trim()
+        return self.chunks[index - self.offset:]
+
+    def start(self, status: int, headers: List[Tuple[str, str]]) -> None:
+        with self._cond:
+            self.status = status
+            self.headers = headers
+            self._cond.notify_all()
+
+    def append(self, data: bytes) -> None:
+        with self._cond:
+            self._append(data)
+            self._cond.notify_all()
+
+    def finish(self) -> None:
+        with self._cond:
+            self.done = True
+            self._cond.notify_all()
+
+    def wait_start(self) -> bool:
+        """False when the leader finished without sending a response."""
+        with self._cond:
+            while self.status is None and not self.done:
+                self._cond.wait()
+            return self.status is not None
+
+    def wait_chunks(self, reader: int, index: int) -> Tuple[List[bytes], bool]:
+        """The chunks from `index` on, which also tells that `reader` has written those before it."""
+        with self._cond:
+            while index >= self.offset + len(self.chunks) and not self.done:
+                self._cond.wait()
+            return self._read(reader, index), self.done
+
+class AsyncFlight(Flight):
+    """`Flight` for the asyncio engine, where leader and followers share one event loop."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._event = asyncio.Event()
+
+    def _notify(self) -> None:
+        event, self._event = self._event, asyncio.Event()
+        event.set()
+
+    def start(self, status: int, headers: List[Tuple[str, str]]) -> None:
+        self.status = status
+        self.headers = headers
+        self._notify()
+
+    def append(self, data: bytes) -> None:
+        self._append(data)
+        self._notify()
+
+    def finish(self) -> None:
+        self.done = True
+        self._notify()
+
+    async def wait_start_async(self) -> bool:
+        while self.status is None and not self.done:
+            await self._event.wait()
+        return self.status is not None
+
+    async def wait_chunks_async(self, reader: int, index: int) -> Tuple[List[bytes], bool]:
+        while index >= self.offset + len(self.chunks) and not self.done:
+            await self._event.wait()
+        return self._read(reader, index), self.done
+
+class TeeRequest:
+    """
+    Wraps the leader's request so everything written to it is also published to the flight.
+    If the leader's own client goes away while followers are attached, the upstream call
+    keeps running for them.
+    """
+
+    # Followers may not accept the leader's encoding
+    identity_body = True
+
+    def __init__(self, request: http.server.BaseHTTPRequestHandler, flight: Flight) -> None:
+        self._request = request
+        self._flight = flight
+        self._status = 0
+        self._headers: List[Tuple[str, str]] = []
+        self._detached = False
+        self.wfile = self
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._request, name)
+
+    @property
+    def unshared(self) -> http.server.BaseHTTPRequestHandler:
+        """The leader's own request, for an answer the followers should not get."""
+        return self._request
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        self._status = code
+        self._request.send_response(code, message)
+
+    def send_header(self, keyword: str, value: str) -> None:
+        self._headers.append((keyword, value))
+        self._request.send_header(keyword, value)
+
+    def end_headers(self) -> None:
+        self._flight.start(self._status, self._headers)
+        self._guard(self._request.end_headers)
+
+    def write(self, data: bytes) -> int:
+        self._flight.append(data)
+        self._guard(self._request.wfile.write, data)
+        return len(data)
+
+    def flush(self) -> None:
+        self._guard(self._request.wfile.flush)
+
+    async def drain(self) -> None:
+        if self._detached:
+            return
+        try:
+            await self._request.wfile.drain()
+        except Exception:
+            if not self._flight.followers:
+                raise
+            self._detached = True
+
+    def disconnected(self) -> bool:
+        return not self._flight.followers and self._request.disconnected()
+
+    def _guard(self, func: Callable[..., Any], *args: Any) -> None:
+        if self._detached:
+            return
+        try:
+            func(*args)
+        except Exception:
+            if not self._flight.followers:
+                raise
+            self._detached = True
+
+def _send_start(flight: Flight, request: http.server.BaseHTTPRequestHandler) -> None:
+    request.send_response(flight.status or 200)
+    for keyword, value in flight.headers:
+        request.send_header(keyword, value)
+    request.end_headers()
+
+def follow(flight: Flight, reader: int, request: http.server.BaseHTTPRequestHandler) -> bool:
+    """Relay the leader's response; False when there was none. A client that left only detaches itself."""
+    if not flight.wait_start():
+        return False
+
+    try:
+        _send_start(flight, request)
+
+        index = 0
+        while True:
+            chunks, done = flight.wait_chunks(reader, index)
+            if chunks:
+                index += len(chunks)
+                request.wfile.write(b"".join(chunks))
+                request.wfile.flush()
+            if done:
+                return True
+    except OSError:
+        disconnect.cancelled("stream")
+        request.close_connection = True
+        return True
+
+async def follow_async(flight: AsyncFlight, reader: int, request: Any) -> bool:
+    if not await flight.wait_start_async():
+        return False
+
+    try:
+        _send_start(flight, request)
+
+        index = 0
+        while True:
+            chunks, done = await flight.wait_chunks_async(reader, index)
+            if chunks:
+                index += len(chunks)
+                request.wfile.write(b"".join(chunks))
+                await request.wfile.drain()
+            if done:
+                return True
+    except OSError:
+        disconnect.cancelled("stream")
+        request.close_connection = True
+        return True
+
+_lock = threading.Lock()
+_flights: Dict[str, Flight] = {}
+
+def _join(key: str, factory: Callable[[], Flight]) -> Tuple[Optional[Flight], Optional[int]]:
+    """
+    The flight for `key` and the follower id, None for its leader. The flight is None when
+    the running one is too far along to join.
+    """
+    with _lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = factory()
+            return flight, None
+
+        reader = flight.attach()
+        if reader is None:
+            return None, None
+        flight.followers += 1
+        return flight, reader
+
+def _leave(key: str, flight: Flight, reader: Optional[int]) -> None:
+    with _lock:
+        if reader is None:
+            # Unregister before finishing so nobody joins a completed flight
+            del _flights[key]
+        else:
+            flight.followers -= 1
+
+    if reader is None:
+        flight.finish()
+    else:
+        flight.detach(reader)
+
+def coalesced(handler: Callable[[Dict[str,Any], http.server.BaseHTTPRequestHandler], None]) -> Callable[[Dict[str,Any], http.server.BaseHTTPRequestHandler], None]:
+    """Share one upstream call between concurrent requests with the same canonical body."""
+    def wrapper(json_data: Dict[str,Any], request: http.server.BaseHTTPRequestHandler) -> None:
+        if not config.config.snapshot().coalesce:
+            return handler(json_data, request)
+
+        key = cache_key(json_data)
+        flight, reader = _join(key, Flight)
+        if flight is None:
+            return handler(json_data, request)
+
+        joined = False
+        try:
+            if reader is None:
+                handler(json_data, TeeRequest(request, flight))  # type: ignore[arg-type]
+                return
+            joined = follow(flight, reader, request)
+        finally:
+            _leave(key, flight, reader)
+
+        # The leader failed before responding: go upstream on our own
+        if not joined:
+            handler(json_data, request)
+    return wrapper
+
+def coalesced_async(handler: Callable[[Dict[str,Any], Any], Awaitable[None]]) -> Callable[[Dict[str,Any], Any], Awaitable[None]]:
+    async def wrapper(json_data: Dict[str,Any], request: Any) -> None:
+        if not config.config.snapshot().coalesce:
+            return await handler(json_data, request)
+
+        key = "async:" + cache_key(json_data)
+        flight, reader = _join(key, AsyncFlight)
+        if flight is None:
+            return await handler(json_data, request)
+
+        joined = False
+        try:
+            if reader is None:
+                await handler(json_data, TeeRequest(request, flight))  # type: ignore[arg-type]
+                return
+            joined = await follow_async(flight, reader, request)  # type: ignore[arg-type]
+        finally:
+            _leave(key, flight, reader)
+
+        if not joined:
+            await handler(json_data, request)
+    return wrapper
@@ -0,0 +1,61 @@
+"""
+Helpers for relaying `text/event-stream` bodies without decoding every event.
+"""
+import json
+from typing import Any, Dict, Optional
+
+DONE_EVENT = b"data: [DONE]\n\n"
+STREAM_ERROR_EVENT = b"data: {\"error\": \"streaming error\"}\n\n"
+
+DONE_EVENTS = (b"data: [DONE]", b"data:[DONE]")
+
+class EventStreamTail:
+    """
+    Watches relayed SSE bytes at event boundaries only.
+
+    Each `feed` does a couple of `rfind` calls over the new bytes to find the last
+    complete event; nothing is JSON-decoded until `usage()` is asked for at the end.
+    CRLF line endings are turned into LF first, so `\r\n\r\n` ends an event too.
+    """
+
+    def __init__(self) -> None:
+        self._partial = b""
+        self.last_data: Optional[bytes] = None
+        self.done = False
+
+    def feed(self, data: bytes) -> None:
+        if self._partial:
+            data = self._partial + data
+        if b"\r" in data:
+            # A CR at the end stays in `_partial` until its LF comes
+            data = data.replace(b"\r\n", b"\n")
+
+        end = data.rfind(b"\n\n")
+        if end < 0:
+            self._partial = data
+            return
+
+        self._partial = data[end + 2:]
+
+        # Walk back over at most the trailing `[DONE]` to the last data event
+        while end > 0:
+            start = data.rfind(b"\n\n", 0, end)
+            event = data[start + 2 if start >= 0 else 0:end].strip()
+            if event in DONE_EVENTS:
+                self.done = True
+                end = start
+                continue
+
+            if event.startswith(b"data:"):
+                self.last_data = event
+            break
+
+    def usage(self) -> Optional[Dict[str, Any]]:
+        """Usage from the last data event, present when the client asked for `stream_options.include_usage`."""
+        if not self.last_data:
+            return None
+
+        try:
+            return json.loads(self.last_data[5:]).get("usage")
+        except ValueError:
+            return None
@@ -0,0 +1,222 @@
+"""
+Coalesced writes of relayed chat streams.
+
+Writing and flushing every chunk of a fast stream costs a syscall, and with TLS a record,
+per token. A stream's first chunk, and any chunk that comes at least `window` seconds
+after the last write, is written at once so time to first token is unchanged; chunks that
+follow closer together are joined and written when the window ends, or as soon as
+`max_bytes` of them are waiting. The settings are `openai.streaming`, with the
+`streaming` of the model route on top; a `window` of 0 writes every chunk as it comes.
+"""
+import asyncio
+import heapq
+import itertools
+import select
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import config
+
+DEFAULT_STREAMING: Dict[str, Any] = {
+    "window": 0.01,
+    "max_bytes": 16384,
+}
+
+def _merge_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_STREAMING)
+    settings.update({k: v for k, v in snapshot.streaming.items() if k in DEFAULT_STREAMING})
+    return settings
+
+def route_streaming(route: Optional[Mapping[str, Any]] = None) -> Dict[str, Any]:
+    """`openai.streaming`, with the `streaming` of a model route on top."""
+    settings = config.config.snapshot().derive("streaming", _merge_settings)
+    if route:
+        settings = {**settings, **{k: v for k, v in route.items() if k in DEFAULT_STREAMING}}
+    return settings
+
+def writable(connection: Any) -> bool:
+    """Whether a write to `connection` can start without waiting for the client to read."""
+    try:
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(connection, select.POLLOUT)
+            return bool(poller.poll(0))
+        return bool(select.select((), (connection,), (), 0)[1])
+    except (OSError, ValueError):
+        return False
+
+class _Pending:
+    """The chunks of one stream waiting to be written."""
+
+    def __init__(self, request: Any, settings: Mapping[str, Any]) -> None:
+        self.wfile = request.wfile
+        self.window = float(settings["window"])
+        self.max_bytes = int(settings["max_bytes"])
+        self.chunks: List[bytes] = []
+        self.size = 0
+        # Time of the last write, None before the first one
+        self.last: Optional[float] = None
+        self.error: Optional[BaseException] = None
+        self.writes = 0
+
+    def _add(self, data: bytes, now: float) -> bool:
+        """Queue `data`; True when the queued chunks are to be written now."""
+        if self.error is not None:
+            raise self.error
+        self.chunks.append(data)
+        self.size += len(data)
+        return self.last is None or self.size >= self.max_bytes or now - self.last >= self.window
+
+    def _take(self, now: float) -> bytes:
+        data = self.chunks[0] if len(self.chunks) == 1 else b"".join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        self.last = now
+        self.writes += 1
+        return data
+
+    def _fail(self, error: BaseException) -> None:
+        """Keep the error of a write made outside the relay loop, for its next write to raise."""
+        self.error = error
+        self.chunks.clear()
+
+class StreamWriter(_Pending):
+    """
+    Writes the chunks of one stream for the thread engines. Windows whose next chunk has not
+    come yet are ended by a shared flusher thread, which skips clients that are not reading
+    rather than wait for them and looks at them again after another window.
+    """
+
+    def __init__(self, request: Any, settings: Mapping[str, Any]) -> None:
+        super().__init__(request, settings)
+        self.connection = getattr(request, "connection", None)
+        self.lock = threading.Lock()
+        self.due: Optional[float] = None
+
+    def write(self, data: bytes) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if self._add(data, now):
+                self._write(now)
+            elif self.due is None and self.last is not None:
+                self.due = self.last + self.window
+                _flusher.schedule(self, self.due)
+
+    def _write(self, now: float) -> None:
+        self.due = None
+        self.wfile.write(self._take(now))
+        self.wfile.flush()
+
+    def flush(self) -> None:
+        """Write the queued chunks now."""
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            if self.chunks:
+                self._write(time.monotonic())
+
+    def close(self) -> None:
+        """Drop the queued chunks; nothing is written after this."""
+        with self.lock:
+            self.chunks.clear()
+            self.due = None
+
+    def expire(self) -> None:
+        """Called by the flusher when the window may have ended."""
+        if not self.lock.acquire(blocking=False):
+            # The relay loop is writing; look again once it is done
+            _flusher.schedule(self, time.monotonic() + self.window)
+            return
+
+        try:
+            now = time.monotonic()
+            if self.due is None or self.due > now or not self.chunks:
+                return
+            if self.connection is not None and not writable(self.connection):
+                # Not reading yet: look again after another window rather than wait for the next chunk
+                self.due = now + self.window
+                _flusher.schedule(self, self.due)
+                return
+            try:
+                self._write(now)
+            except Exception as e:
+                self._fail(e)
+        finally:
+            self.lock.release()
+
+class AsyncStreamWriter(_Pending):
+    """Same as `StreamWriter` for the asyncio engine, whose windows are ended by a timer of the event loop."""
+
+    def __init__(self, request: Any, settings: Mapping[str, Any]) -> None:
+        super().__init__(request, settings)
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def write(self, data: bytes) -> None:
+        now = time.monotonic()
+        if self._add(data, now):
+            await self._write(now)
+        elif self._timer is None and self.last is not None:
+            self._timer = asyncio.get_running_loop().call_later(self.last + self.window - now, self._expire)
+
+    async def _write(self, now: float) -> None:
+        self._cancel()
+        self.wfile.write(self._take(now))
+        await self.wfile.drain()
+
+    async def flush(self) -> None:
+        if self.error is not None:
+            raise self.error
+        if self.chunks:
+            await self._write(time.monotonic())
+
+    def close(self) -> None:
+        self._cancel()
+        self.chunks.clear()
+
+    def _cancel(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _expire(self) -> None:
+        self._timer = None
+        if not self.chunks:
+            return
+        try:
+            # No drain here: the relay loop's next write waits for the client
+            self.wfile.write(self._take(time.monotonic()))
+            self.wfile.flush()
+        except Exception as e:
+            self._fail(e)
+
+class _Flusher:
+    """One daemon thread ending the windows of `StreamWriter`s, earliest first."""
+
+    def __init__(self) -> None:
+        self._ready = threading.Condition()
+        self._due: List[Tuple[float, int, StreamWriter]] = []
+        self._order = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+
+    def schedule(self, writer: StreamWriter, due: float) -> None:
+        with self._ready:
+            heapq.heappush(self._due, (due, next(self._order), writer))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stream-flusher", daemon=True)
+                self._thread.start()
+            elif self._due[0][2] is writer:
+                self._ready.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._ready:
+                while True:
+                    now = time.monotonic()
+                    if self._due and self._due[0][0] <= now:
+                        break
+                    self._ready.wait(self._due[0][0] - now if self._due else None)
+                _, _, writer = heapq.heappop(self._due)
+            writer.expire()
+
+_flusher = _Flusher()
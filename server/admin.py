@@ -0,0 +1,44 @@
+"""
+Admin HTTP server for `/metrics`, on its own port so it is never exposed on the
+hijacked API hosts. Runs in a daemon thread next to either server engine.
+"""
+import http.server
+import logging
+import threading
+from typing import Optional
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class AdminHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.partition("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start(host: str, port: int) -> Optional[http.server.ThreadingHTTPServer]:
+    """Serve in the background; returns None when the port is disabled or cannot be bound."""
+    if not port:
+        return None
+
+    try:
+        httpd = http.server.ThreadingHTTPServer((host, port), AdminHandler)
+    except OSError:
+        logger.exception("failed to start the admin server on %s:%d", host, port)
+        return None
+
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="admin", daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return httpd
@@ -0,0 +1,312 @@
+"""
+asyncio server engine.
+
+Serves the same routes as `ProxyHandler`, but each connection is a coroutine instead of
+an OS thread, so thousands of long-running SSE streams can share one process. Routes
+with an `async_handler` run on the event loop; sync-only routes run in the default
+executor.
+"""
+import asyncio
+import contextvars
+import email.utils
+import functools
+import http.client
+import http.server
+import io
+import logging
+import ssl
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import config
+import metrics
+from clients.openai import registry
+from routes.base_route import ChatRoute, ModelRoute, ProxyRoute, check_length
+from routes.forward import is_chunked
+from server.handler import ProxyHandler, handle_404, resolve, route_label, serve_route
+from server.compression import CompressingWriter, response_encoding
+from server.keepalive import AsyncBodyReader, ChunkedWriter, has_body, keepalive_settings, wants_close
+from server.server import create_ssl_context, record_handshake, record_handshake_failure, tls_settings
+
+logger = logging.getLogger(__name__)
+
+MAX_HEADER_SIZE = 64 * 1024
+HEADER_TIMEOUT = 30.0
+
+class StreamWriterFile:
+    """
+    File-like wrapper around `asyncio.StreamWriter` used as `request.wfile`.
+    `write` is safe to call from executor threads running sync routes.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter) -> None:
+        self._loop = loop
+        self._writer = writer
+        self._loop_thread = threading.get_ident()
+
+    def write(self, data: bytes) -> int:
+        if threading.get_ident() == self._loop_thread:
+            self._writer.write(data)
+        else:
+            self._loop.call_soon_threadsafe(self._writer.write, bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    async def drain(self) -> None:
+        await self._writer.drain()
+
+class AsyncRequest:
+    """The subset of `BaseHTTPRequestHandler` the routes use, backed by asyncio streams."""
+
+    protocol_version = "HTTP/1.1"
+    responses = http.server.BaseHTTPRequestHandler.responses
+
+    def __init__(self, reader: asyncio.StreamReader, wfile: StreamWriterFile, requestline: str, command: str, path: str, request_version: str, headers: http.client.HTTPMessage, client_address: Any) -> None:
+        self.reader: Any = reader
+        self.wfile: Any = wfile
+        self._stream = reader
+        self.rfile = io.BytesIO()
+        self.requestline = requestline
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.headers = headers
+        self.client_address = client_address
+        self.close_connection = wants_close(request_version, headers.get("Connection", ""))
+        self.last_request = False
+        self.response_status = 0
+        self.response_headers: Dict[str, str] = {}
+        self._close_after_headers = False
+        self._headers_buffer: list[bytes] = []
+
+        if is_chunked(headers):
+            self.close_connection = True
+        else:
+            try:
+                length = int(headers.get("Content-Length", 0))
+            except ValueError:
+                length = 0
+                self.close_connection = True
+            if length > 0:
+                self.reader = AsyncBodyReader(reader, length)
+
+    def disconnected(self) -> bool:
+        """Whether the client has closed or reset the connection; pipelined bytes left unread hide a close."""
+        return self._stream.at_eof() or self._stream.exception() is not None
+
+    async def read_body(self) -> None:
+        """Buffer the body into `rfile` for routes that parse it; passthrough routes stream `reader` instead."""
+        content_length = int(self.headers.get("Content-Length", 0))
+        if content_length > 0:
+            self.rfile = io.BytesIO(await self.reader.readexactly(content_length))
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        metrics.record_status(code)
+        self.response_status = code
+        self.log_request(code)
+        if message is None:
+            message = self.responses[code][0] if code in self.responses else ""
+        self._headers_buffer.append(f"{self.protocol_version} {code} {message}\r\n".encode("latin-1", "strict"))
+        self.send_header("Server", f"{ProxyHandler.server_version} {ProxyHandler.sys_version}")
+        self.send_header("Date", email.utils.formatdate(usegmt=True))
+
+    def send_header(self, keyword: str, value: str) -> None:
+        keyword_lower = keyword.lower()
+        self.response_headers[keyword_lower] = value
+        if keyword_lower == "connection" and value.lower() == "close":
+            self.close_connection = True
+        if keyword_lower != "content-length":
+            self._headers_buffer.append(f"{keyword}: {value}\r\n".encode("latin-1", "strict"))
+
+    def end_headers(self) -> None:
+        """Compress and frame the body the same way as `ProxyHandler.end_headers`."""
+        headers = self.response_headers
+        encoding = response_encoding(self.headers.get("Accept-Encoding", ""), headers) if has_body(self.command, self.response_status) else None
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+            if "vary" not in headers:
+                self.send_header("Vary", "Accept-Encoding")
+        elif "content-length" in headers:
+            self._headers_buffer.append(f"Content-Length: {headers['content-length']}\r\n".encode("latin-1", "strict"))
+
+        framed = "transfer-encoding" in headers or ("content-length" in headers and not encoding)
+        if not framed and has_body(self.command, self.response_status):
+            if self.request_version == "HTTP/1.1":
+                self.send_header("Transfer-Encoding", "chunked")
+                self.wfile = ChunkedWriter(self.wfile)
+            else:
+                self.close_connection = True
+        if (self.last_request or self.close_connection) and "connection" not in headers:
+            self.send_header("Connection", "close")
+        self._close_after_headers = self.close_connection
+
+        self._headers_buffer.append(b"\r\n")
+        raw = self.wfile.raw if isinstance(self.wfile, ChunkedWriter) else self.wfile
+        raw.write(b"".join(self._headers_buffer))
+        self._headers_buffer = []
+        if encoding:
+            self.wfile = CompressingWriter(self.wfile, encoding)
+
+    async def finish(self) -> None:
+        """Same as `ProxyHandler.finish_response`."""
+        complete = not self.close_connection or self._close_after_headers
+        if isinstance(self.wfile, CompressingWriter):
+            writer, self.wfile = self.wfile, self.wfile.raw
+            if complete:
+                writer.close()
+
+        if isinstance(self.wfile, ChunkedWriter):
+            writer, self.wfile = self.wfile, self.wfile.raw
+            if complete:
+                writer.close()
+
+        if isinstance(self.reader, AsyncBodyReader):
+            reader, self.reader = self.reader, self.reader.raw
+            if not self.close_connection and not await reader.drain():
+                self.close_connection = True
+
+        if not self.response_status or self.last_request:
+            self.close_connection = True
+
+    def send_error(self, code: int, message: Optional[str] = None) -> None:
+        body = (message or self.responses.get(code, ("",))[0]).encode("utf-8")
+        self.send_response(code, message)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code: int) -> None:
+        host = self.client_address[0] if self.client_address else "-"
+        sys.stderr.write(f'{host} - - [{time.strftime("%d/%b/%Y %H:%M:%S")}] "{self.requestline}" {code} -\n')
+
+async def read_request(reader: asyncio.StreamReader, wfile: StreamWriterFile, client_address: Any, idle_timeout: Optional[float] = None) -> Optional[AsyncRequest]:
+    """Read the next request head; a kept-alive connection waits `idle_timeout` for it instead of `HEADER_TIMEOUT`."""
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEADER_TIMEOUT if idle_timeout is None else idle_timeout)
+    line, _, raw_headers = head.partition(b"\r\n")
+    requestline = line.decode("iso-8859-1")
+    words = requestline.split()
+    if len(words) != 3:
+        return None
+
+    command, path, request_version = words
+    headers = http.client.parse_headers(io.BytesIO(raw_headers))
+
+    return AsyncRequest(reader, wfile, requestline, command, path, request_version, headers, client_address)
+
+async def dispatch(request: AsyncRequest) -> None:
+    route, arg = resolve(request.command, request.path)
+    with config.config.pin(), metrics.request(route_label(route, arg)):
+        if route is None:
+            handle_404(request)  # type: ignore[arg-type]
+            return
+
+        if isinstance(route, ProxyRoute) and route.async_handler:
+            await route.async_handler(arg, request)
+            return
+
+        if isinstance(route, ChatRoute) and not check_length(request):  # type: ignore[arg-type]
+            return
+
+        await request.read_body()
+        if isinstance(route, ChatRoute) and route.async_handler:
+            await route.async_handler(request)  # type: ignore[arg-type]
+        elif isinstance(route, ModelRoute):
+            serve_route(route, arg, request)  # type: ignore[arg-type]
+        else:
+            # Run in a copy of the context so the executor thread records into this request's metrics
+            context = contextvars.copy_context()
+            await asyncio.get_running_loop().run_in_executor(None, context.run, serve_route, route, arg, request)
+
+class TLSUpgrade:
+    """
+    Upgrades accepted connections to TLS in their own task, with a timeout and a cap on
+    concurrent handshakes; `start_server` itself never handshakes.
+    """
+
+    def __init__(self, context: ssl.SSLContext, max_handshakes: int, timeout: float) -> None:
+        self.context = context
+        self.slots = asyncio.Semaphore(max_handshakes)
+        self.timeout = timeout
+
+    async def __call__(self, writer: asyncio.StreamWriter) -> bool:
+        # Stop reading before the first await so the ClientHello is not buffered as plain data
+        writer.transport.pause_reading()  # type: ignore[attr-defined]
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            record_handshake_failure("busy")
+            return False
+
+        try:
+            await asyncio.wait_for(writer.start_tls(self.context), self.timeout - (time.perf_counter() - start))
+        except asyncio.TimeoutError:
+            record_handshake_failure("timeout")
+            return False
+        except (ssl.SSLError, OSError):
+            record_handshake_failure("error")
+            return False
+        finally:
+            self.slots.release()
+
+        ssl_object = writer.get_extra_info("ssl_object")
+        record_handshake(start, bool(ssl_object and ssl_object.session_reused))
+        return True
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, tls: Optional[TLSUpgrade] = None) -> None:
+    wfile = StreamWriterFile(asyncio.get_running_loop(), writer)
+    try:
+        if tls is not None and not await tls(writer):
+            return
+
+        peer = writer.get_extra_info("peername")
+        served = 0
+        while True:
+            settings = keepalive_settings()
+            request = await read_request(reader, wfile, peer, float(settings["idle_timeout"]) if served else None)
+            if request is None:
+                break
+
+            served += 1
+            request.last_request = served >= int(settings["max_requests"])
+            await dispatch(request)
+            await request.finish()
+            await wfile.drain()
+            if request.close_connection:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+        pass
+    except Exception:
+        logger.exception("asyncio request failed")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+async def serve(port: int, certfile: Optional[str] = None, keyfile: Optional[str] = None, reuse_port: bool = False) -> None:
+    tls: Optional[TLSUpgrade] = None
+    if certfile:
+        settings = tls_settings()
+        tls = TLSUpgrade(create_ssl_context(certfile, keyfile), int(settings["max_handshakes"]), float(settings["handshake_timeout"]))
+    server = await asyncio.start_server(functools.partial(handle_connection, tls=tls), port=port, reuse_address=True, reuse_port=reuse_port, limit=MAX_HEADER_SIZE)
+
+    proto = 'https' if tls else 'http'
+    print(f"Serving {proto} on port {port} (asyncio)")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await registry.aclose()
+
+def start(port: int, certfile: Optional[str] = None, keyfile: Optional[str] = None, reuse_port: bool = False) -> None:
+    try:
+        asyncio.run(serve(port, certfile=certfile, keyfile=keyfile, reuse_port=reuse_port))
+    except KeyboardInterrupt:
+        print("\nShutting down server...")
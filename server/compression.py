@@ -0,0 +1,179 @@
+"""
+Response compression, shared by both server engines.
+
+When `server.compression.enabled` is on, a response is compressed if the client's
+`Accept-Encoding` allows one of the configured encodings, its type is text or JSON, the
+route did not encode it already and its `Content-Length` (when known) is at least
+`min_bytes`. The compressed body replaces `Content-Length` with chunked framing, as its
+size is only known at the end. Every `flush`/`drain` a route makes ends a compressed
+block, so each event of a stream reaches the client as soon as it is written.
+
+zstd and brotli are offered when the optional `zstandard` and `brotli` packages are
+installed; gzip always is.
+"""
+import zlib
+from typing import Any, Dict, Mapping, Optional
+
+import config
+
+try:
+    import brotli  # type: ignore[import-not-found]
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard  # type: ignore[import-not-found]
+except ImportError:
+    zstandard = None
+
+DEFAULT_COMPRESSION: Dict[str, Any] = {
+    "enabled": False,
+    "min_bytes": 1024,
+    # Preferred first when the client accepts several
+    "encodings": ["zstd", "br", "gzip"],
+    "levels": {"zstd": 3, "br": 4, "gzip": 6},
+}
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml")
+
+def available(encoding: str) -> bool:
+    if encoding == "gzip":
+        return True
+    if encoding == "br":
+        return brotli is not None
+    if encoding == "zstd":
+        return zstandard is not None
+    return False
+
+def _merge_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_COMPRESSION)
+    settings.update({k: v for k, v in snapshot.server.get("compression", {}).items() if k in DEFAULT_COMPRESSION})
+    settings["levels"] = {**DEFAULT_COMPRESSION["levels"], **settings["levels"]}
+    settings["encodings"] = [e for e in settings["encodings"] if available(e)]
+    return settings
+
+def compression_settings() -> Dict[str, Any]:
+    """`server.compression` merged over the defaults, keeping only the encodings installed."""
+    return config.config.snapshot().derive("compression", _merge_settings)
+
+def accepted(accept_encoding: str) -> Dict[str, float]:
+    """Encodings in an `Accept-Encoding` header with their q-values."""
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name] = q
+    return weights
+
+def accepts(accept_encoding: str, encoding: str) -> bool:
+    weights = accepted(accept_encoding)
+    return weights.get(encoding.lower(), weights.get("*", 0.0)) > 0
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """The first configured encoding the client accepts, or None."""
+    if not accept_encoding:
+        return None
+    weights = accepted(accept_encoding)
+    for encoding in compression_settings()["encodings"]:
+        if weights.get(encoding, weights.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def response_encoding(accept_encoding: str, headers: Mapping[str, str]) -> Optional[str]:
+    """
+    The encoding to compress a response with. `headers` holds the response headers the
+    route set, with lowercase names.
+    """
+    settings = compression_settings()
+    if not settings["enabled"] or "content-encoding" in headers or "transfer-encoding" in headers:
+        return None
+    if not headers.get("content-type", "").lower().startswith(COMPRESSIBLE_TYPES):
+        return None
+    length = headers.get("content-length")
+    if length is not None and int(length) < int(settings["min_bytes"]):
+        return None
+    return negotiate(accept_encoding)
+
+def relay_accepts(request: Any, encoding: str) -> bool:
+    """
+    Whether a route may relay a body the upstream already encoded with `encoding` as-is.
+    Responses that are cached or shared with other clients are always relayed decoded.
+    """
+    if not compression_settings()["enabled"] or getattr(request, "identity_body", False):
+        return False
+    return accepts(request.headers.get("Accept-Encoding", ""), encoding)
+
+class Compressor:
+    """One streaming compressor: `compress` buffers, `flush` ends a block, `finish` ends the stream."""
+
+    def __init__(self, encoding: str, level: int) -> None:
+        self.encoding = encoding
+        if encoding == "zstd":
+            self._zstd = zstandard.ZstdCompressor(level=level).compressobj()
+        elif encoding == "br":
+            self._brotli = brotli.Compressor(quality=level)
+        else:
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == "zstd":
+            return self._zstd.compress(data)
+        if self.encoding == "br":
+            return self._brotli.process(data)
+        return self._zlib.compress(data)
+
+    def flush(self) -> bytes:
+        if self.encoding == "zstd":
+            return self._zstd.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == "br":
+            return self._brotli.flush()
+        return self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "zstd":
+            return self._zstd.flush()
+        if self.encoding == "br":
+            return self._brotli.finish()
+        return self._zlib.flush()
+
+class CompressingWriter:
+    """`wfile` wrapper that compresses the response body."""
+
+    def __init__(self, raw: Any, encoding: str) -> None:
+        self.raw = raw
+        self._compressor = Compressor(encoding, int(compression_settings()["levels"][encoding]))
+        self._pending = False
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self._pending = True
+            out = self._compressor.compress(data)
+            if out:
+                self.raw.write(out)
+        return len(data)
+
+    def _end_block(self) -> None:
+        if self._pending:
+            self._pending = False
+            self.raw.write(self._compressor.flush())
+
+    def flush(self) -> None:
+        self._end_block()
+        self.raw.flush()
+
+    async def drain(self) -> None:
+        self._end_block()
+        await self.raw.drain()
+
+    def close(self) -> None:
+        """Write the end of the compressed stream."""
+        self.raw.write(self._compressor.finish())
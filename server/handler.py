@@ -1,15 +1,31 @@
 import http.server
 import json
 import re
-from typing import Any, Dict, Optional, Tuple, TypeVar
+import selectors
+import socket
+import ssl
+from typing import Any, Dict, Generic, List, Optional, Tuple, TypeVar
 
 import config
-from routes import openai
-from routes.base_route import BaseRoute, ChatRoute, ModelRoute
+import metrics
+from routes import embeddings, forward, openai
+from routes.admission import admitted, admitted_async
+from routes.cache import cached, cached_async
+from routes.singleflight import coalesced, coalesced_async
+from routes.base_route import BaseRoute, ChatRoute, EmbeddingsRoute, ModelRoute, ProxyRoute
+from routes.forward import is_chunked
+from server.compression import CompressingWriter, response_encoding
+from server.keepalive import BodyReader, ChunkedWriter, has_body, keepalive_settings
 
 chat_routes = [
-    ChatRoute("/v1/chat/completions", openai.handle),
-    ChatRoute("/chat/completions", openai.handle),
+    # Admission inside coalescing: only the request that goes upstream is charged
+    ChatRoute("/v1/chat/completions", cached(coalesced(admitted(openai.handle))), cached_async(coalesced_async(admitted_async(openai.handle_async)))),
+    ChatRoute("/chat/completions", cached(coalesced(admitted(openai.handle))), cached_async(coalesced_async(admitted_async(openai.handle_async)))),
+]
+
+embeddings_routes = [
+    EmbeddingsRoute("/v1/embeddings", admitted(embeddings.handle), admitted_async(embeddings.handle_async)),
+    EmbeddingsRoute("/embeddings", admitted(embeddings.handle), admitted_async(embeddings.handle_async)),
 ]
 
 model_routes = [
@@ -17,67 +33,325 @@ model_routes = [
     ModelRoute("/models", openai.models, openai.model),
 ]
 
+proxy_routes = [
+    ProxyRoute("/v1", forward.forward, forward.forward_async),
+]
+
 def format_path(path: str) -> str:
+    # Fast path: already normalized paths skip the regex
+    if path.startswith("/") and "//" not in path:
+        return path
+
     no_to_much_slash = re.sub(r"/+", "/", path)
     with_prefix = "/" + no_to_much_slash if not no_to_much_slash.startswith("/") else no_to_much_slash
     return with_prefix
 
+def split_path(path: str) -> Tuple[str, str]:
+    """Normalized path and the query string (with its `?`)."""
+    path, mark, query = path.partition("?")
+    return format_path(path), mark + query
+
 def handle_404(request: http.server.BaseHTTPRequestHandler) -> None:
+    body = json.dumps({"error": "Not found"}).encode("utf-8")
     request.send_response(404)
     request.send_header("Content-type", "application/json")
+    request.send_header("Content-Length", str(len(body)))
     request.end_headers()
-    request.wfile.write(json.dumps({"error": "Not found"}).encode("utf-8"))
+    request.wfile.write(body)
 
 route_type = TypeVar('route_type', bound=BaseRoute)
 
-def match_route(routes: list[route_type], path: str) -> Tuple[Optional[route_type], Optional[str]]:
-    for route in routes:
-        if path == route.path:
+class RouteTable(Generic[route_type]):
+    """
+    Dispatch table built once from a list of routes.
+    A route matches its own path, or a longer path whose rest is passed as an argument
+    (a model id); lookups are dict hits on the path and then on each shorter prefix.
+    """
+
+    def __init__(self, routes: List[route_type]) -> None:
+        self.routes: Dict[str, route_type] = {}
+        for route in routes:
+            self.routes.setdefault(route.path, route)
+
+    def match(self, path: str) -> Tuple[Optional[route_type], Optional[str]]:
+        route = self.routes.get(path)
+        if route is not None:
             return route, None
-        elif path.startswith(route.path + "/") and len(path) > len(route.path) + 1:
-            return route, path[len(route.path) + 1:]
-    
+
+        end = path.rfind("/")
+        while end > 0:
+            route = self.routes.get(path[:end])
+            if route is not None:
+                rest = path[end + 1:]
+                return (route, rest) if rest else (None, None)
+            end = path.rfind("/", 0, end)
+
+        return None, None
+
+method_tables: Dict[str, RouteTable[Any]] = {
+    "GET": RouteTable(model_routes),
+    "POST": RouteTable(chat_routes + embeddings_routes),
+}
+proxy_table = RouteTable(proxy_routes)
+
+def resolve(command: str, path: str) -> Tuple[Optional[BaseRoute[Any]], Optional[str]]:
+    """
+    Model routes answer GET, chat and embeddings routes answer POST; any other `/v1/*` request goes to
+    the passthrough route with the rest of the path and the query string.
+    """
+    path, query = split_path(path)
+
+    table = method_tables.get(command)
+    if table is not None:
+        route, arg = table.match(path)
+        if route is not None:
+            return route, arg
+
+    route, rest = proxy_table.match(path)
+    if route is not None and rest:
+        return route, rest + query
+
     return None, None
 
+def handle_models(route: ModelRoute, id: Optional[str], request: http.server.BaseHTTPRequestHandler) -> None:
+    models = None
+    if id:
+        models = route.model_handler(id, request)
+    else:
+        models = route.list_handler(request)
+
+    if not models:
+        return handle_404(request)
+
+    body = json.dumps(models).encode("utf-8")
+    request.send_response(200)
+    request.send_header("Content-type", "application/json")
+    request.send_header("Content-Length", str(len(body)))
+    request.end_headers()
+    request.wfile.write(body)
+
+def serve_route(route: BaseRoute[Any], arg: Optional[str], request: http.server.BaseHTTPRequestHandler) -> None:
+    if isinstance(route, ModelRoute):
+        handle_models(route, arg, request)
+    elif isinstance(route, ProxyRoute):
+        route.handler(arg, request)  # type: ignore[call-arg]
+    else:
+        route.handler(request)
+
+def route_label(route: Optional[BaseRoute[Any]], arg: Optional[str]) -> str:
+    """Metrics label: the route path, plus the first segment for passthrough requests."""
+    if route is None:
+        return "unmatched"
+    if isinstance(route, ProxyRoute) and arg:
+        return route.path + "/" + arg.partition("?")[0].partition("/")[0]
+    return route.path
+
+def dispatch(request: http.server.BaseHTTPRequestHandler) -> None:
+    route, arg = resolve(request.command, request.path)
+    with config.config.pin(), metrics.request(route_label(route, arg)):
+        if route is None:
+            return handle_404(request)
+        serve_route(route, arg, request)
+
+def wait_for_request(connection: socket.socket, rfile: Any, timeout: float) -> bool:
+    """Wait up to `timeout` for the next request on a kept-alive connection; False on close or timeout."""
+    connection.settimeout(timeout)
+    try:
+        return bool(rfile.peek(1))
+    except OSError:
+        return False
+    finally:
+        connection.settimeout(None)
+
+# Linux TCP state of a socket whose peer has closed its side
+TCP_CLOSE_WAIT = 8
+
+def fin_received(connection: socket.socket) -> bool:
+    """Whether the client has closed its side of `connection`; only known on Linux."""
+    if not hasattr(socket, "TCP_INFO"):
+        return False
+    try:
+        return connection.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 1)[0] == TCP_CLOSE_WAIT
+    except OSError:
+        return False
+
+def peer_closed(connection: socket.socket) -> bool:
+    """
+    Whether the client has closed `connection` or reset it. The socket is only peeked at,
+    so request bytes the client sent ahead stay for the next request. A TLS client sends
+    close_notify before closing, which is data on the socket; for TLS the TCP state tells
+    whether the client closed its side after it.
+    """
+    with selectors.DefaultSelector() as selector:
+        selector.register(connection, selectors.EVENT_READ)
+        if not selector.select(0):
+            return False
+
+    try:
+        # The raw socket, below any TLS layer
+        data = socket.socket.recv(connection, 1, socket.MSG_PEEK | getattr(socket, "MSG_DONTWAIT", 0))
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+    if not data:
+        return True
+    return isinstance(connection, ssl.SSLSocket) and fin_received(connection)
+
 class ProxyHandler(http.server.BaseHTTPRequestHandler):
-    def do_GET(self):
+    """
+    Serves HTTP/1.1 with persistent connections. Responses without a `Content-Length` are
+    sent chunked (or close the connection for HTTP/1.0 clients), idle connections are
+    closed after `server.keepalive.idle_timeout` and each connection serves at most
+    `server.keepalive.max_requests` requests. Bodies are compressed as set by
+    `server.compression`.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def handle_one_request(self):
+        settings = keepalive_settings()
+        if self.requests_served:
+            with self.server.idle(self.connection):
+                ready = wait_for_request(self.connection, self.rfile, self.server.keepalive_timeout(float(settings["idle_timeout"])))
+            if not ready:
+                self.close_connection = True
+                return
+
+        self.requests_served += 1
+        self.last_request = self.requests_served >= int(settings["max_requests"])
+        self.response_status = 0
+        self.response_headers: Dict[str, str] = {}
+        self.close_after_headers = False
+        super().handle_one_request()
+        self.finish_response()
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+
+        if is_chunked(self.headers):
+            # Where a route stopped reading a chunked body is unknown, so never reuse the connection
+            self.close_connection = True
+        else:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+            except ValueError:
+                length = 0
+                self.close_connection = True
+            if length > 0:
+                self.rfile = BodyReader(self.rfile, length)
+        return True
+
+    def disconnected(self) -> bool:
+        return peer_closed(self.connection)
+
+    def send_response(self, code, message=None):
+        metrics.record_status(code)
+        self.response_status = code
+        super().send_response(code, message)
+
+    def send_header(self, keyword, value):
+        keyword_lower = keyword.lower()
+        self.response_headers[keyword_lower] = value
+        # Sent by `end_headers` unless the body is compressed
+        if keyword_lower != "content-length":
+            super().send_header(keyword, value)
+
+    def end_headers(self):
+        headers = self.response_headers
+        encoding = response_encoding(self.headers.get("Accept-Encoding", ""), headers) if has_body(self.command, self.response_status) else None
+        if encoding:
+            super().send_header("Content-Encoding", encoding)
+            if "vary" not in headers:
+                super().send_header("Vary", "Accept-Encoding")
+        elif "content-length" in headers:
+            super().send_header("Content-Length", headers["content-length"])
+
+        chunked = False
+        framed = "transfer-encoding" in headers or ("content-length" in headers and not encoding)
+        if not framed and has_body(self.command, self.response_status):
+            if self.request_version == "HTTP/1.1":
+                chunked = True
+                super().send_header("Transfer-Encoding", "chunked")
+            else:
+                # HTTP/1.0 has no chunked encoding: the end of the body is the end of the connection
+                self.close_connection = True
+        if (self.last_request or self.close_connection) and "connection" not in headers:
+            super().send_header("Connection", "close")
+        self.close_after_headers = self.close_connection
+        super().end_headers()
+
+        if chunked:
+            self.wfile = ChunkedWriter(self.wfile)
+        if encoding:
+            self.wfile = CompressingWriter(self.wfile, encoding)
+
+    def finish_response(self):
         """
-        Handle GET request.
-        For model routes, return models.
+        End the compressed and chunked body and drop what is left of the request body. A
+        route that sets `close_connection` after sending headers abandons its response:
+        the connection is closed without the last chunk so the client sees it as truncated.
         """
-        path = format_path(self.path)
+        complete = not self.close_connection or self.close_after_headers
+        if isinstance(self.wfile, CompressingWriter):
+            writer, self.wfile = self.wfile, self.wfile.raw
+            if complete:
+                try:
+                    writer.close()
+                except OSError:
+                    self.close_connection = True
+                    complete = False
 
-        route, id = match_route(model_routes, path)
+        if isinstance(self.wfile, ChunkedWriter):
+            writer, self.wfile = self.wfile, self.wfile.raw
+            if complete:
+                try:
+                    writer.close()
+                except OSError:
+                    self.close_connection = True
 
-        if not route:
-            return handle_404(self)
+        try:
+            self.wfile.flush()
+        except OSError:
+            self.close_connection = True
 
-        models = None
-        if id:
-            models = route.model_handler(id, self)
-        else:
-            models = route.list_handler(self)
-
-        if not models:
-            return handle_404(self)
-        
-        self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(models).encode("utf-8"))
-        return
-        
+        if isinstance(self.rfile, BodyReader):
+            reader, self.rfile = self.rfile, self.rfile.raw
+            if not self.close_connection and not reader.drain():
+                self.close_connection = True
+
+        if not self.response_status or self.last_request:
+            self.close_connection = True
+
+    def do_GET(self):
+        """
+        Handle GET request.
+        For model routes, return models; other `/v1/*` paths are forwarded upstream.
+        """
+        return dispatch(self)
 
     def do_POST(self):
         """
         Handle POST request.
-        For chat routes, return response from OpenAI API.
+        For chat routes, return response from OpenAI API; other `/v1/*` paths are forwarded upstream.
         """
-        path = format_path(self.path)
-        
-        route, _ = match_route(chat_routes, path)
-        if not route:
-            return handle_404(self)
-
-        # Call handler with request context
-        route.handler(self)
+        return dispatch(self)
+
+    def do_PUT(self):
+        return dispatch(self)
+
+    def do_PATCH(self):
+        return dispatch(self)
+
+    def do_DELETE(self):
+        return dispatch(self)
+
+    def do_HEAD(self):
+        return dispatch(self)
+
+    def do_OPTIONS(self):
+        return dispatch(self)
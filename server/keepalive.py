@@ -0,0 +1,125 @@
+"""
+HTTP/1.1 persistent connections, shared by both server engines.
+
+Responses that set `Content-Length` are sent as they are. Any other response with a body
+(event streams, relayed bodies of unknown length) is sent with `Transfer-Encoding:
+chunked` to HTTP/1.1 clients, and ends the connection for HTTP/1.0 clients. Before the
+next request is read, whatever the route left of the request body is drained, or the
+connection is closed when that would mean reading too much.
+"""
+from typing import Any, Dict
+
+import config
+
+DEFAULT_KEEPALIVE: Dict[str, Any] = {
+    "idle_timeout": 60.0,
+    "max_requests": 1000,
+}
+
+# Unread request body we are willing to discard to keep a connection open
+MAX_DRAIN = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+NO_BODY_STATUSES = frozenset({204, 304})
+
+def _merge_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_KEEPALIVE)
+    settings.update({k: v for k, v in snapshot.server.get("keepalive", {}).items() if k in DEFAULT_KEEPALIVE})
+    return settings
+
+def keepalive_settings() -> Dict[str, Any]:
+    """`server.keepalive` merged over the defaults."""
+    return config.config.snapshot().derive("keepalive", _merge_settings)
+
+def has_body(command: str, status: int) -> bool:
+    return command != "HEAD" and status >= 200 and status not in NO_BODY_STATUSES
+
+def wants_close(request_version: str, connection: str) -> bool:
+    """Whether the client asked for the connection to end after this request."""
+    connection = connection.lower()
+    if connection == "close":
+        return True
+    return request_version != "HTTP/1.1" and connection != "keep-alive"
+
+class ChunkedWriter:
+    """`wfile` wrapper that frames each write as one HTTP/1.1 chunk."""
+
+    def __init__(self, raw: Any) -> None:
+        self.raw = raw
+
+    def write(self, data: bytes) -> int:
+        if data:
+            self.raw.write(b"%x\r\n%s\r\n" % (len(data), data))
+        return len(data)
+
+    def flush(self) -> None:
+        self.raw.flush()
+
+    async def drain(self) -> None:
+        await self.raw.drain()
+
+    def close(self) -> None:
+        """Write the last chunk."""
+        self.raw.write(b"0\r\n\r\n")
+
+class BodyReader:
+    """
+    The request body of one request with a `Content-Length`. Reads stop at the end of the
+    body so the next request is never consumed by a route.
+    """
+
+    def __init__(self, raw: Any, length: int) -> None:
+        self.raw = raw
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.raw.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.raw.readline(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    def drain(self) -> bool:
+        """Discard the unread body; False when it is too large and the connection should close."""
+        if self.remaining > MAX_DRAIN:
+            return False
+        while self.remaining > 0:
+            if not self.read(min(self.remaining, CHUNK_SIZE)):
+                return False
+        return True
+
+class AsyncBodyReader:
+    """`BodyReader` over an `asyncio.StreamReader`."""
+
+    def __init__(self, raw: Any, length: int) -> None:
+        self.raw = raw
+        self.remaining = length
+
+    async def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = await self.raw.read(size) if size else b""
+        self.remaining -= len(data)
+        return data
+
+    async def readexactly(self, size: int) -> bytes:
+        if size > self.remaining:
+            raise ValueError("read past the end of the request body")
+        data = await self.raw.readexactly(size)
+        self.remaining -= len(data)
+        return data
+
+    async def drain(self) -> bool:
+        if self.remaining > MAX_DRAIN:
+            return False
+        while self.remaining > 0:
+            if not await self.read(min(self.remaining, CHUNK_SIZE)):
+                return False
+        return True
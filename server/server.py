@@ -1,19 +1,292 @@
+import contextlib
 import ssl
 import http.server
-from typing import Optional, Type
+import queue
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
 
+import config
+import metrics
+
+DEFAULT_TLS: Dict[str, Any] = {
+    "handshake_timeout": 10.0,
+    "max_handshakes": 64,
+}
+
+DEFAULT_WORKER_POOL: Dict[str, Any] = {
+    "workers": 32,
+    "queue_size": 128,
+    # "reject" answers 503 when the queue is full, "block" stops accepting
+    "overflow": "reject",
+    # Keep-alive wait of a worker, shorter than the thread engine's as it holds a worker
+    "idle_timeout": 5.0,
+    "shutdown_timeout": 30.0,
+}
+
+OVERLOADED_BODY = b'{"error": "Server is overloaded"}'
+OVERLOADED_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Content-Length: %d\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: close\r\n\r\n%s" % (len(OVERLOADED_BODY), OVERLOADED_BODY)
+)
+# Connections waiting for their 503, and how long each may take
+MAX_REJECTS = 64
+REJECT_TIMEOUT = 1.0
+
+def tls_settings() -> Dict[str, Any]:
+    """`server.handshake_timeout` and `server.max_handshakes` merged over the defaults."""
+    settings = dict(DEFAULT_TLS)
+    settings.update({k: v for k, v in config.config.server().items() if k in DEFAULT_TLS})
+    return settings
+
+def _merge_pool_settings(snapshot: config.ConfigSnapshot) -> Dict[str, Any]:
+    settings = dict(DEFAULT_WORKER_POOL)
+    settings.update({k: v for k, v in snapshot.server.get("pool", {}).items() if k in DEFAULT_WORKER_POOL})
+    return settings
+
+def worker_pool_settings() -> Dict[str, Any]:
+    """`server.pool` merged over the defaults."""
+    return config.config.snapshot().derive("server_pool", _merge_pool_settings)
+
+def record_handshake(start: float, resumed: bool) -> None:
+    metrics.observe("ai_proxy_tls_handshake_seconds", (("resumed", "true" if resumed else "false"),), time.perf_counter() - start)
+
+def record_handshake_failure(reason: str) -> None:
+    metrics.inc("ai_proxy_tls_handshake_failures_total", (("reason", reason),))
+
+def handshake(sock: ssl.SSLSocket, slots: threading.BoundedSemaphore, timeout: float) -> bool:
+    """Complete the TLS handshake of an accepted connection; False when it failed or timed out."""
+    start = time.perf_counter()
+    if not slots.acquire(timeout=timeout):
+        record_handshake_failure("busy")
+        return False
+
+    try:
+        sock.settimeout(timeout)
+        sock.do_handshake()
+        sock.settimeout(None)
+    except socket.timeout:
+        record_handshake_failure("timeout")
+        return False
+    except (ssl.SSLError, OSError):
+        record_handshake_failure("error")
+        return False
+    finally:
+        slots.release()
+
+    record_handshake(start, sock.session_reused)
+    return True
 
 class ReuseAddrHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    TLS connections are accepted without a handshake; each one is completed in the
+    connection's own thread so a slow client never holds up `accept`.
+    """
     allow_reuse_address = True
+    # Listen backlog; the socketserver default of 5 resets connections under a burst
+    request_queue_size = socket.SOMAXCONN
+    handshake_timeout: float = DEFAULT_TLS["handshake_timeout"]
+    handshake_slots = threading.BoundedSemaphore(DEFAULT_TLS["max_handshakes"])
+
+    def finish_request(self, request: Any, client_address: Any) -> None:
+        if isinstance(request, ssl.SSLSocket) and not handshake(request, self.handshake_slots, self.handshake_timeout):
+            return
+        super().finish_request(request, client_address)
+
+    def keepalive_timeout(self, timeout: float) -> float:
+        """How long a handler waits for the next request on a kept-alive connection."""
+        return timeout
+
+    @contextlib.contextmanager
+    def idle(self, connection: socket.socket) -> Iterator[None]:
+        """Wraps the wait for the next request on a kept-alive connection."""
+        yield
+
+class PoolHTTPServer(ReuseAddrHTTPServer):
+    """
+    Serves connections from a fixed number of worker threads instead of a thread each.
+    Accepted connections wait in a bounded queue. When it is full, a connection is
+    answered with 503 from a separate thread (`overflow: "reject"`), or accepting stops
+    until a worker is free so new clients wait in the listen backlog (`"block"`).
+    Kept-alive connections keep their worker while they wait for their next request;
+    only when queued connections outnumber the free workers is the longest idle one closed.
+    Closing the server lets the workers finish the connections they have.
+    """
+
+    def __init__(self, server_address: Any, handler: Type[http.server.BaseHTTPRequestHandler], settings: Dict[str, Any], bind_and_activate: bool = True) -> None:
+        self.settings = settings
+        super().__init__(server_address, handler, bind_and_activate)
+
+        self._closing = False
+        self._idle_lock = threading.Lock()
+        self._idle: Dict[int, socket.socket] = {}
+        # Workers serving a connection, idle kept-alive ones included; guarded by `_idle_lock`
+        self._busy = 0
+        self._connections: queue.Queue[Optional[Tuple[Any, Any, float]]] = queue.Queue(int(settings["queue_size"]))
+        self._rejects: queue.Queue[Any] = queue.Queue(MAX_REJECTS)
+        self._workers: List[threading.Thread] = []
+        for i in range(int(settings["workers"])):
+            worker = threading.Thread(target=self._work, name=f"worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        metrics.inc("ai_proxy_pool_workers", (), len(self._workers))
+        threading.Thread(target=self._reject_loop, name="rejecter", daemon=True).start()
+
+    def process_request(self, request: Any, client_address: Any) -> None:
+        item = (request, client_address, time.perf_counter())
+        if self.settings["overflow"] == "block":
+            while True:
+                if self._closing:
+                    return self.shutdown_request(request)
+                try:
+                    self._connections.put(item, timeout=0.5)
+                    break
+                except queue.Full:
+                    pass
+        else:
+            try:
+                self._connections.put_nowait(item)
+            except queue.Full:
+                return self.reject(request)
+        metrics.inc("ai_proxy_pool_queued")
+        if self._starved():
+            self._release_idle()
+
+    def _work(self) -> None:
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+            request, client_address, queued = item
+            metrics.inc("ai_proxy_pool_queued", (), -1)
+            metrics.observe("ai_proxy_pool_queue_wait_seconds", (), time.perf_counter() - queued)
+            metrics.inc("ai_proxy_pool_busy_workers")
+            with self._idle_lock:
+                self._busy += 1
+            try:
+                self.process_request_thread(request, client_address)
+            finally:
+                with self._idle_lock:
+                    self._busy -= 1
+                metrics.inc("ai_proxy_pool_busy_workers", (), -1)
+
+    def _starved(self) -> bool:
+        """Whether queued connections outnumber the workers free to take them."""
+        with self._idle_lock:
+            return self._connections.qsize() > len(self._workers) - self._busy
+
+    def reject(self, request: Any) -> None:
+        metrics.inc("ai_proxy_pool_rejected_total")
+        try:
+            self._rejects.put_nowait(request)
+        except queue.Full:
+            self.shutdown_request(request)
+
+    def _reject_loop(self) -> None:
+        while True:
+            request = self._rejects.get()
+            if request is None:
+                return
+            try:
+                request.settimeout(REJECT_TIMEOUT)
+                if isinstance(request, ssl.SSLSocket):
+                    request.do_handshake()
+                request.sendall(OVERLOADED_RESPONSE)
+                # Read what the client sent so closing does not reset the connection before it reads the 503
+                request.recv(64 * 1024)
+            except (ssl.SSLError, OSError):
+                pass
+            finally:
+                self.shutdown_request(request)
+
+    def keepalive_timeout(self, timeout: float) -> float:
+        if self._closing or self._starved():
+            return 0.0
+        return min(timeout, float(self.settings["idle_timeout"]))
+
+    @contextlib.contextmanager
+    def idle(self, connection: socket.socket) -> Iterator[None]:
+        with self._idle_lock:
+            self._idle[id(connection)] = connection
+        try:
+            yield
+        finally:
+            with self._idle_lock:
+                self._idle.pop(id(connection), None)
+
+    def _release_idle(self) -> None:
+        """Close the longest idle kept-alive connection so its worker takes a queued one."""
+        with self._idle_lock:
+            if not self._idle:
+                return
+            connection = self._idle.pop(next(iter(self._idle)))
+        try:
+            # Ends the worker's wait as if the client had closed; the plain socket method
+            # leaves the TLS state of an SSLSocket alone
+            socket.socket.shutdown(connection, socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def server_close(self) -> None:
+        """Stop accepting, then wait up to `shutdown_timeout` for the workers to finish."""
+        self._closing = True
+        super().server_close()
+        while self._idle:
+            self._release_idle()
+
+        deadline = time.monotonic() + float(self.settings["shutdown_timeout"])
+        try:
+            for _ in self._workers:
+                self._connections.put(None, timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Full:
+            pass
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        self._rejects.put(None)
+
+
+def create_ssl_context(certfile: str, keyfile: Optional[str] = None) -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    # load_cert_chain accepts keyfile optional if cert contains key
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    # Session tickets (TLS 1.3) and the server session cache (TLS 1.2) let returning clients resume
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = 2
+    context.set_alpn_protocols(["http/1.1"])
+    return context
+
 
+def create_server(port: int, handler: Type[http.server.BaseHTTPRequestHandler], reuse_port: bool = False) -> ReuseAddrHTTPServer:
+    """
+    A worker pool server for the "pool" engine, else one thread per connection.
+    `reuse_port` binds with `SO_REUSEPORT` so several processes can share the port.
+    """
+    if config.config.engine() == "pool":
+        httpd: ReuseAddrHTTPServer = PoolHTTPServer(("", port), handler, worker_pool_settings(), bind_and_activate=False)
+    else:
+        httpd = ReuseAddrHTTPServer(("", port), handler, bind_and_activate=False)
+    httpd.allow_reuse_port = reuse_port
+    try:
+        httpd.server_bind()
+        httpd.server_activate()
+    except Exception:
+        httpd.server_close()
+        raise
+    return httpd
 
-def start(port: int, handler: Type[http.server.BaseHTTPRequestHandler], certfile: Optional[str] = None, keyfile: Optional[str] = None) -> None:
-    with ReuseAddrHTTPServer(("", port), handler) as httpd:
+def start(port: int, handler: Type[http.server.BaseHTTPRequestHandler], certfile: Optional[str] = None, keyfile: Optional[str] = None, reuse_port: bool = False) -> None:
+    with create_server(port, handler, reuse_port) as httpd:
         if certfile:
-            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            # load_cert_chain accepts keyfile optional if cert contains key
-            context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-            httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+            context = create_ssl_context(certfile, keyfile)
+            settings = tls_settings()
+            httpd.handshake_timeout = float(settings["handshake_timeout"])
+            httpd.handshake_slots = threading.BoundedSemaphore(int(settings["max_handshakes"]))
+            httpd.socket = context.wrap_socket(httpd.socket, server_side=True, do_handshake_on_connect=False)
             proto = 'https'
         else:
             proto = 'http'
@@ -23,4 +296,4 @@ def start(port: int, handler: Type[http.server.BaseHTTPRequestHandler], certfile
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nShutting down server...")
-            httpd.shutdown()
\ No newline at end of file
+            httpd.shutdown()
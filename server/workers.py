@@ -0,0 +1,215 @@
+"""
+Multi-process mode (`--workers N`).
+
+One process serves about one core of JSON and TLS work because of the GIL. The
+supervisor starts N worker processes that each bind the proxy port with `SO_REUSEPORT`,
+so the kernel spreads new connections across them, and each runs its own server
+engine. The certificate, the hosts file and the admin server stay in the supervisor. A
+worker that exits is started again, at once if it had been running for a while and
+after a growing delay while it keeps failing at startup.
+
+`/metrics` asks every worker for its values over a pipe and adds them up; what a worker
+counted since the last scrape is lost when it dies. Other state (the memory cache,
+admission buckets, coalescing, embedding batches) is per worker; `cache.disk` gives the
+workers one shared cache. Closing the pipe tells a worker to shut down.
+"""
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import config
+import metrics
+from clients.openai import registry
+from server import aio, server
+from server.handler import ProxyHandler
+
+logger = logging.getLogger(__name__)
+
+# Delay before restarting a worker that failed within STABLE_AFTER seconds, doubled up to
+# MAX_RESTART_DELAY while it keeps failing
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+STABLE_AFTER = 10.0
+# How long a scrape waits for a worker's values
+COLLECT_TIMEOUT = 1.0
+# How long workers get to finish their connections when the supervisor stops
+STOP_TIMEOUT = 35.0
+
+Values = Dict[Tuple[str, metrics.Labels], Any]
+
+def supported() -> bool:
+    return hasattr(socket, "SO_REUSEPORT")
+
+def _interrupt_once(signum: int, frame: Any) -> None:
+    # Ctrl+C reaches the workers and the supervisor closes their pipes: shut down once
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+def _answer_scrapes(conn: multiprocessing.connection.Connection) -> None:
+    while True:
+        try:
+            seq = conn.recv()
+            conn.send((seq, metrics.snapshot()))
+        except (EOFError, OSError):
+            # The supervisor stopped or died; a real signal also wakes a waiting event loop
+            os.kill(os.getpid(), signal.SIGINT)
+            return
+
+def run(port: int, certfile: Optional[str], keyfile: Optional[str], conn: multiprocessing.connection.Connection) -> None:
+    """Entry point of a worker process."""
+    signal.signal(signal.SIGINT, _interrupt_once)
+    config.config.watch()
+    threading.Thread(target=_answer_scrapes, args=(conn,), name="scrapes", daemon=True).start()
+    try:
+        if config.config.engine() == "asyncio":
+            aio.start(port, certfile=certfile, keyfile=keyfile, reuse_port=True)
+        else:
+            server.start(port, ProxyHandler, certfile=certfile, keyfile=keyfile, reuse_port=True)
+    finally:
+        registry.close()
+
+def _counters(values: Values) -> Values:
+    return {key: value for key, value in values.items() if metrics.METRICS[key[0]][0] != "gauge"}
+
+class Worker:
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.process: Optional[Any] = None
+        self.conn: Optional[multiprocessing.connection.Connection] = None
+        self.started = 0.0
+        self.delay = RESTART_DELAY
+        self.restart_at = 0.0
+        # Guards the pipe, which scrapes use from the admin server's threads
+        self.lock = threading.Lock()
+        self.seq = itertools.count()
+        self.values: Values = {}
+
+    def collect(self) -> Values:
+        """The worker's current values, or the last ones it sent when it does not answer in time."""
+        with self.lock:
+            conn = self.conn
+            if conn is None:
+                return {}
+            try:
+                seq = next(self.seq)
+                conn.send(seq)
+                deadline = time.monotonic() + COLLECT_TIMEOUT
+                # Replies to earlier scrapes that timed out are skipped
+                while conn.poll(max(0.0, deadline - time.monotonic())):
+                    reply_seq, values = conn.recv()
+                    if reply_seq == seq:
+                        self.values = values
+                        break
+            except (EOFError, OSError):
+                pass
+            return self.values
+
+class Supervisor:
+    def __init__(self, count: int, port: int, certfile: Optional[str], keyfile: Optional[str]) -> None:
+        # Spawned rather than forked, as the supervisor runs threads (admin, config watcher)
+        self._context = multiprocessing.get_context("spawn")
+        self.workers = [Worker(i) for i in range(count)]
+        self.port = port
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self._lock = threading.Lock()
+        self._retired: Values = {}
+
+    def _start(self, worker: Worker) -> None:
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=run,
+            args=(self.port, self.certfile, self.keyfile, child_conn),
+            name=f"ai-proxy-worker-{worker.index}",
+        )
+        process.start()
+        child_conn.close()
+        with worker.lock:
+            worker.process, worker.conn, worker.values = process, conn, {}
+        worker.started = time.monotonic()
+
+    def _exited(self, worker: Worker) -> None:
+        process = worker.process
+        assert process is not None
+        with worker.lock:
+            if worker.conn is not None:
+                worker.conn.close()
+            worker.process, worker.conn = None, None
+            values, worker.values = worker.values, {}
+        # Counters of a dead worker stay in the totals; its gauges go with it
+        with self._lock:
+            metrics.merge(self._retired, _counters(values))
+        metrics.inc("ai_proxy_worker_restarts_total")
+
+        now = time.monotonic()
+        if now - worker.started >= STABLE_AFTER:
+            worker.delay = RESTART_DELAY
+            worker.restart_at = now
+        else:
+            worker.restart_at = now + worker.delay
+            worker.delay = min(worker.delay * 2, MAX_RESTART_DELAY)
+        logger.warning("worker %d (pid %s) exited with code %s, restarting in %.0fs", worker.index, process.pid, process.exitcode, worker.restart_at - now)
+
+    def collect(self) -> Values:
+        """Values of all workers, for `metrics.add_source`."""
+        with self._lock:
+            totals: Values = {}
+            metrics.merge(totals, self._retired)
+        for worker in self.workers:
+            metrics.merge(totals, worker.collect())
+        return totals
+
+    def serve_forever(self) -> None:
+        for worker in self.workers:
+            self._start(worker)
+
+        while True:
+            sentinels = [w.process.sentinel for w in self.workers if w.process is not None]
+            pending = [w.restart_at for w in self.workers if w.process is None]
+            timeout = max(0.0, min(pending) - time.monotonic()) if pending else None
+            multiprocessing.connection.wait(sentinels, timeout)
+
+            for worker in self.workers:
+                if worker.process is not None and not worker.process.is_alive():
+                    self._exited(worker)
+                if worker.process is None and time.monotonic() >= worker.restart_at:
+                    self._start(worker)
+
+    def stop(self) -> None:
+        """Tell every worker to shut down and wait for them, killing those that take too long."""
+        processes = []
+        for worker in self.workers:
+            with worker.lock:
+                if worker.conn is not None:
+                    worker.conn.close()
+                    worker.conn = None
+            if worker.process is not None:
+                processes.append(worker.process)
+
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+def start(count: int, port: int, certfile: Optional[str] = None, keyfile: Optional[str] = None) -> None:
+    """Run `count` worker processes on `port` until interrupted."""
+    supervisor = Supervisor(count, port, certfile, keyfile)
+    metrics.add_source(supervisor.collect)
+
+    print(f"Serving on port {port} with {count} worker processes")
+    try:
+        supervisor.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down workers...")
+    finally:
+        supervisor.stop()
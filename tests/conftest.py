@@ -0,0 +1,61 @@
+"""
+Shared fixtures. `config` reads `config.json` from the working directory when it is
+imported, so the tests run from a temporary directory and set the config they need with
+`use_config`.
+"""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+os.chdir(tempfile.mkdtemp(prefix="ai-proxy-tests-"))
+
+import config  # noqa: E402
+
+@pytest.fixture
+def use_config() -> Iterator[Callable[[Dict[str, Any]], None]]:
+    """Serve the test from a snapshot of the given config data."""
+    previous = config.config._snapshot
+
+    def apply(data: Dict[str, Any]) -> None:
+        config.validate(data)
+        config.config._snapshot = config.ConfigSnapshot(data)
+
+    yield apply
+    config.config._snapshot = previous
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def mock_upstream() -> Iterator[Callable[..., str]]:
+    """Start `benchmarks.mock_upstream` in a process of its own; returns its base URL."""
+    processes: List[subprocess.Popen] = []
+
+    def start(*args: str) -> str:
+        port = free_port()
+        process = subprocess.Popen([sys.executable, "-m", "benchmarks.mock_upstream", "--port", str(port), *args], cwd=ROOT, stdout=subprocess.DEVNULL)
+        processes.append(process)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                return f"http://127.0.0.1:{port}/v1"
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("mock upstream did not start")
+
+    yield start
+    for process in processes:
+        process.kill()
+        process.wait()
@@ -0,0 +1,24 @@
+import pytest
+
+from routes.admission import TokenBucket
+
+def test_bucket_starts_full() -> None:
+    bucket = TokenBucket(120)
+    assert bucket.tokens == 120
+    assert bucket.wait_time(120) == 0.0
+
+def test_wait_time_follows_the_refill_rate() -> None:
+    bucket = TokenBucket(60)
+    bucket.tokens = 0.5
+    # One token per second
+    assert bucket.wait_time(2) == pytest.approx(1.5)
+
+def test_refill_is_continuous_and_capped() -> None:
+    bucket = TokenBucket(60)
+    bucket.tokens = 0
+    bucket.refill(bucket.stamp + 2.5)
+    assert bucket.tokens == pytest.approx(2.5)
+    assert bucket.wait_time(2) == 0.0
+
+    bucket.refill(bucket.stamp + 3600)
+    assert bucket.tokens == 60
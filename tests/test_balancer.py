@@ -0,0 +1,111 @@
+import time
+from typing import Any, Dict, List
+
+import pytest
+
+from clients.balancer import Balancer, Upstream, balancer_settings
+
+def make(count: int = 2, **settings: Any) -> Balancer:
+    upstreams = [Upstream(f"http://upstream-{i}/v1", "k") for i in range(count)]
+    return Balancer(upstreams, balancer_settings(settings))
+
+@pytest.fixture
+def probes(monkeypatch) -> List[Upstream]:
+    """Record the probes of upstreams due back instead of sending them."""
+    probed: List[Upstream] = []
+    monkeypatch.setattr(Balancer, "_probe", lambda self, upstream: probed.append(upstream))
+    return probed
+
+def fail(balancer: Balancer, upstream: Upstream, status: int, times: int = 1, retry_after: Any = None) -> None:
+    for _ in range(times):
+        upstream.outstanding += 1
+        balancer.release(upstream, status, retry_after)
+
+def picks(balancer: Balancer, count: int = 8) -> Dict[str, int]:
+    seen: Dict[str, int] = {}
+    for _ in range(count):
+        lease = balancer.acquire()
+        assert lease is not None
+        seen[lease.upstream.base_url] = seen.get(lease.upstream.base_url, 0) + 1
+        lease.abandon()
+    return seen
+
+def test_upstream_is_ejected_after_max_failures() -> None:
+    balancer = make(max_failures=2)
+    bad, good = balancer.upstreams
+    fail(balancer, bad, 500)
+    assert not bad.ejected_until
+
+    fail(balancer, bad, 502)
+    assert bad.ejected_until > time.monotonic()
+    assert picks(balancer) == {good.base_url: 8}
+
+def test_success_resets_the_failure_count() -> None:
+    balancer = make(max_failures=2)
+    upstream = balancer.upstreams[0]
+    fail(balancer, upstream, 500)
+    fail(balancer, upstream, 200)
+    fail(balancer, upstream, 500)
+    assert upstream.failures == 1 and not upstream.ejected_until
+
+def test_cooldown_doubles_and_is_capped() -> None:
+    balancer = make(1, max_failures=1, cooldown=10, max_cooldown=25)
+    upstream = balancer.upstreams[0]
+    cooldowns = []
+    for _ in range(3):
+        fail(balancer, upstream, 500)
+        cooldowns.append(upstream.ejected_until - time.monotonic())
+        upstream.ejected_until = 0.0
+    assert [round(c) for c in cooldowns] == [10, 20, 25]
+
+    fail(balancer, upstream, 503, retry_after=4.0)
+    assert round(upstream.ejected_until - time.monotonic()) == 4
+
+def test_circuit_opens_when_every_upstream_is_out(probes) -> None:
+    balancer = make(1, max_failures=1, cooldown=10)
+    upstream = balancer.upstreams[0]
+    fail(balancer, upstream, 500)
+
+    assert balancer.acquire() is None
+    assert round(balancer.retry_after()) == 10
+    assert probes == []
+
+    # Due back: probed in the background, still not handed out until the probe succeeds
+    upstream.ejected_until = time.monotonic() - 1
+    assert balancer.acquire() is None
+    assert probes == [upstream]
+
+def test_fail_open_keeps_sending_to_the_upstream_due_back_first(probes) -> None:
+    balancer = make(max_failures=1, fail_open=True)
+    first, second = balancer.upstreams
+    fail(balancer, first, 500)
+    fail(balancer, second, 500)
+    first.ejected_until = second.ejected_until + 5
+
+    lease = balancer.acquire()
+    assert lease is not None and lease.upstream is second
+    assert balancer.retry_after() is None
+
+def test_429_throttles_without_counting_a_failure() -> None:
+    balancer = make(max_failures=1, throttle=1.0)
+    limited, other = balancer.upstreams
+    fail(balancer, limited, 429, retry_after=30.0)
+
+    assert limited.failures == 0 and not limited.ejected_until
+    assert round(limited.throttled_until - time.monotonic()) == 30
+    assert picks(balancer) == {other.base_url: 8}
+
+def test_throttled_upstream_is_used_when_no_other_is_free() -> None:
+    balancer = make(max_failures=1, throttle=1.0, max_cooldown=5)
+    limited, other = balancer.upstreams
+    other.max_concurrency = 1
+    other.outstanding = 1
+    fail(balancer, limited, 429)
+    assert round(limited.throttled_until - time.monotonic()) == 1
+
+    lease = balancer.acquire()
+    assert lease is not None and lease.upstream is limited
+
+    # Retry-After is capped by `max_cooldown`
+    fail(balancer, limited, 429, retry_after=60.0)
+    assert round(limited.throttled_until - time.monotonic()) == 5
@@ -0,0 +1,41 @@
+import json
+
+from routes import body
+from routes.body import RequestBody, encode, parse
+
+RAW = b'{"model": "a", "messages": [{"role": "user", "content": "say \\"hi\\" {"}], "stream": true}'
+
+def test_values_are_parsed_on_access_and_raw_bytes_forwarded() -> None:
+    request = RequestBody(RAW)
+    assert list(request) == ["model", "messages", "stream"]
+    assert request["messages"] == [{"role": "user", "content": 'say "hi" {'}]
+    assert request["stream"] is True
+    assert encode(request) is RAW
+
+def test_replace_splices_only_the_value() -> None:
+    request = RequestBody(RAW).replace("model", "gpt-4o-mini")
+    assert request.raw == RAW.replace(b'"a"', b'"gpt-4o-mini"', 1)
+    # Spans after the replaced value are shifted with it
+    assert request["stream"] is True
+    assert dict(request) == {**json.loads(RAW), "model": "gpt-4o-mini"}
+
+def test_replace_adds_a_missing_key() -> None:
+    request = RequestBody(b'{"stream": false}').replace("model", "m")
+    assert json.loads(request.raw) == {"model": "m", "stream": False}
+    assert request["model"] == "m" and request["stream"] is False
+
+    assert json.loads(RequestBody(b"{ }").replace("model", "m").raw) == {"model": "m"}
+
+def test_escaped_backslash_before_quote_ends_the_string() -> None:
+    request = RequestBody(b'{"path": "C:\\\\", "model": "m"}')
+    assert request["path"] == "C:\\"
+    assert request["model"] == "m"
+
+def test_lazy_parse_falls_back_for_escape_heavy_bodies(use_config, monkeypatch) -> None:
+    use_config({"body": {"lazy": True}})
+    assert isinstance(parse(RAW), RequestBody)
+
+    monkeypatch.setattr(body, "MAX_ESCAPED_QUOTES", 1)
+    parsed = parse(RAW)
+    assert type(parsed) is dict
+    assert parsed == json.loads(RAW)
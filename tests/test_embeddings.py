@@ -0,0 +1,47 @@
+import json
+from typing import Any, Dict, List
+
+from routes.embeddings import Batch, Reply, apportion
+
+def test_apportion_adds_up_exactly() -> None:
+    assert apportion(10, [1, 1, 1]) == [3, 4, 3]
+    assert apportion(7, [5, 1, 1]) == [5, 1, 1]
+    assert sum(apportion(1001, [3, 7, 11, 13])) == 1001
+    assert apportion(0, [2, 3]) == [0, 0]
+
+def batch(*callers: List[str]) -> Batch:
+    result = Batch({"model": "m", "input": []})
+    for inputs in callers:
+        result.add(list(inputs), len(inputs))
+    return result
+
+def embeddings_reply(inputs: List[str], usage: Dict[str, Any]) -> Reply:
+    data = [{"object": "embedding", "index": i, "embedding": [float(i)], "input": text} for i, text in enumerate(inputs)]
+    body = {"object": "list", "model": "m", "data": list(reversed(data)), "usage": usage}
+    return Reply(200, "application/json", json.dumps(body).encode())
+
+def test_split_gives_each_caller_its_items_and_usage() -> None:
+    replies = batch(["a"], ["b", "c", "d"]).split(embeddings_reply(["a", "b", "c", "d"], {"prompt_tokens": 8, "total_tokens": 8}))
+
+    bodies = [json.loads(reply.body) for reply in replies]  # type: ignore[union-attr]
+    assert [[(item["index"], item["input"]) for item in body["data"]] for body in bodies] == [
+        [(0, "a")],
+        [(0, "b"), (1, "c"), (2, "d")],
+    ]
+    assert [body["usage"] for body in bodies] == [
+        {"prompt_tokens": 2, "total_tokens": 2},
+        {"prompt_tokens": 6, "total_tokens": 6},
+    ]
+
+def test_split_of_failed_batches() -> None:
+    two = batch(["a"], ["b"])
+    rejected = Reply(400, "application/json", b'{"error": "bad input"}')
+    # A client error may come from one caller's input: each is retried alone
+    assert two.split(rejected) == [None, None]
+
+    for status in (429, 500):
+        failed = Reply(status, "application/json", b"{}")
+        assert two.split(failed) == [failed, failed]
+
+    assert two.split(embeddings_reply(["a"], {})) == [None, None]
+    assert batch(["a"]).split(rejected) == [rejected]
@@ -0,0 +1,39 @@
+from typing import NamedTuple
+
+from server import handler
+from server.handler import RouteTable
+
+class Route(NamedTuple):
+    path: str
+    name: str = ""
+
+def test_match_exact_path_and_argument() -> None:
+    table = RouteTable([Route("/v1/models")])
+    route = table.routes["/v1/models"]
+    assert table.match("/v1/models") == (route, None)
+    assert table.match("/v1/models/gpt-4o") == (route, "gpt-4o")
+    # The rest may contain slashes, as fine-tuned model ids do
+    assert table.match("/v1/models/ft:gpt/org") == (route, "ft:gpt/org")
+
+def test_match_misses() -> None:
+    table = RouteTable([Route("/v1/models")])
+    assert table.match("/v1/models/") == (None, None)
+    assert table.match("/v1/modelsx") == (None, None)
+    assert table.match("/v2/models") == (None, None)
+    assert table.match("/") == (None, None)
+
+def test_first_route_for_a_path_wins() -> None:
+    table = RouteTable([Route("/v1", "first"), Route("/v1", "second")])
+    assert table.match("/v1/files")[0] == Route("/v1", "first")
+
+def test_resolve_by_method() -> None:
+    route, arg = handler.resolve("GET", "/v1/models/m")
+    assert route is handler.model_routes[0] and arg == "m"
+
+    route, arg = handler.resolve("POST", "//v1//chat/completions")
+    assert route is handler.chat_routes[0] and arg is None
+
+    # Anything else under /v1 is forwarded with its path and query
+    route, arg = handler.resolve("POST", "/v1/audio/speech?format=mp3")
+    assert route is handler.proxy_routes[0] and arg == "audio/speech?format=mp3"
+    assert handler.resolve("GET", "/health") == (None, None)
@@ -0,0 +1,57 @@
+import http.client
+import json
+import threading
+import time
+from typing import List
+
+from server.handler import ProxyHandler
+from server.server import DEFAULT_WORKER_POOL, PoolHTTPServer
+
+WORKERS = 4
+MAX_HEDGES = 2
+# Threads started once per process: the rejecter, the client watcher and the hedge timer
+SHARED_THREADS = 3
+
+def proxy_threads() -> int:
+    """Live threads, leaving out the test's own."""
+    return sum(1 for thread in threading.enumerate() if not thread.name.startswith("test-"))
+
+def post(port: int, statuses: List[int]) -> None:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        body = json.dumps({"model": "m", "messages": [{"role": "user", "content": "hi"}]})
+        connection.request("POST", "/v1/chat/completions", body, {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        response.read()
+        statuses.append(response.status)
+    finally:
+        connection.close()
+
+def test_threads_stay_bounded_under_burst(use_config, mock_upstream) -> None:
+    upstream = mock_upstream("--latency", "0.2")
+    use_config({
+        "openai": {"api_key": "k", "base_url": upstream, "models": ["m"]},
+        "server": {"engine": "pool"},
+        # Every request is slow enough to be hedged, as far as `max_hedges` allows
+        "hedging": {"enabled": True, "delay": 0.05, "budget": 1.0, "max_hedges": MAX_HEDGES},
+    })
+    before = proxy_threads()
+    httpd = PoolHTTPServer(("127.0.0.1", 0), ProxyHandler, {**DEFAULT_WORKER_POOL, "workers": WORKERS, "queue_size": 64})
+    threading.Thread(target=httpd.serve_forever, name="test-acceptor", daemon=True).start()
+    port = httpd.server_address[1]
+
+    statuses: List[int] = []
+    clients = [threading.Thread(target=post, args=(port, statuses), name=f"test-client-{i}") for i in range(32)]
+    peak = 0
+    try:
+        for client in clients:
+            client.start()
+        while any(client.is_alive() for client in clients):
+            peak = max(peak, proxy_threads())
+            time.sleep(0.01)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    assert statuses == [200] * len(clients)
+    assert peak - before <= WORKERS + MAX_HEDGES + SHARED_THREADS
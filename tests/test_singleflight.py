@@ -0,0 +1,66 @@
+from typing import Any, List
+
+from routes import singleflight
+from routes.singleflight import Flight, follow
+
+class BrokenFile:
+    def write(self, data: bytes) -> int:
+        raise BrokenPipeError()
+
+    def flush(self) -> None:
+        pass
+
+class FollowerRequest:
+    def __init__(self) -> None:
+        self.wfile = BrokenFile()
+        self.close_connection = False
+        self.sent: List[Any] = []
+
+    def send_response(self, code: int, message: Any = None) -> None:
+        self.sent.append(code)
+
+    def send_header(self, keyword: str, value: str) -> None:
+        pass
+
+    def end_headers(self) -> None:
+        pass
+
+def test_late_joiners_get_everything_buffered() -> None:
+    flight = Flight()
+    flight.append(b"a")
+    flight.append(b"b")
+    reader = flight.attach()
+    assert reader is not None
+    flight.finish()
+    assert flight.wait_chunks(reader, 0) == ([b"a", b"b"], True)
+
+def test_full_flight_drops_written_chunks_and_turns_joiners_away(monkeypatch) -> None:
+    monkeypatch.setattr(singleflight, "MAX_BUFFER", 4)
+    flight = Flight()
+    reader = flight.attach()
+    assert reader is not None
+    flight.append(b"aa")
+    assert flight.wait_chunks(reader, 0) == ([b"aa"], False)
+    flight.append(b"bbb")
+
+    assert flight.full
+    assert flight.attach() is None
+    # Only the chunk the follower has not written yet is kept
+    assert flight.wait_chunks(reader, 1) == ([b"bbb"], False)
+    assert flight.chunks == [b"bbb"] and flight.offset == 1
+
+    flight.detach(reader)
+    flight.append(b"c")
+    assert flight.chunks == [] and flight.size == 0
+
+def test_follower_that_left_only_detaches_itself() -> None:
+    flight = Flight()
+    reader = flight.attach()
+    assert reader is not None
+    flight.start(200, [])
+    flight.append(b"data")
+    request = FollowerRequest()
+
+    assert follow(flight, reader, request)  # type: ignore[arg-type]
+    assert request.close_connection
+    assert not flight.done
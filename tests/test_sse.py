@@ -0,0 +1,32 @@
+from routes.sse import EventStreamTail
+
+USAGE_EVENT = b'data: {"choices": [], "usage": {"total_tokens": 3}}'
+
+def test_crlf_events_are_found() -> None:
+    tail = EventStreamTail()
+    tail.feed(b'data: {"choices": []}\r\n\r\n' + USAGE_EVENT + b"\r\n\r\ndata: [DONE]\r\n\r\n")
+    assert tail.done
+    assert tail.usage() == {"total_tokens": 3}
+
+def test_crlf_split_across_feeds() -> None:
+    tail = EventStreamTail()
+    tail.feed(USAGE_EVENT + b"\r")
+    assert tail.last_data is None
+    tail.feed(b"\n\r")
+    assert tail.last_data is None
+    tail.feed(b"\n")
+    assert tail.last_data == USAGE_EVENT
+
+    tail.feed(b"data: [DONE]\r\n\r")
+    assert not tail.done
+    tail.feed(b"\n")
+    assert tail.done
+    assert tail.usage() == {"total_tokens": 3}
+
+def test_partial_event_waits_for_its_boundary() -> None:
+    tail = EventStreamTail()
+    tail.feed(b'data: {"choices": []}\n\ndata: {"usage": ')
+    assert tail.last_data == b'data: {"choices": []}'
+    tail.feed(b'{"total_tokens": 5}}\n\n')
+    assert tail.usage() == {"total_tokens": 5}
+    assert not tail.done